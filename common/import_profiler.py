@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Measures how long each module takes to import, including the time spent
+finding it. Set IMPORT_PROFILE_DIR to have the zygote and the launcher write
+a profile for every process at startup, or run
+  python -m common.import_profiler selfdrive.controls.controlsd
+for a cold import of one process."""
+import os
+import sys
+import time
+
+IMPORT_PROFILE_DIR = os.getenv("IMPORT_PROFILE_DIR")
+
+
+class ImportProfiler():
+  def __init__(self):
+    self.cumulative = {}
+    self.own = {}
+    self.stack = []  # time spent in the imports nested in each module being executed
+
+  def start(self):
+    if self not in sys.meta_path:
+      sys.meta_path.insert(0, self)
+    return self
+
+  def stop(self):
+    if self in sys.meta_path:
+      sys.meta_path.remove(self)
+
+  def find_spec(self, fullname, path, target=None):
+    t = time.monotonic()
+    spec = None
+    for finder in sys.meta_path:
+      if finder is self or not hasattr(finder, 'find_spec'):
+        continue
+      spec = finder.find_spec(fullname, path, target)
+      if spec is not None:
+        break
+    dt = time.monotonic() - t
+
+    self.own[fullname] = self.own.get(fullname, 0.) + dt
+    self.cumulative[fullname] = self.cumulative.get(fullname, 0.) + dt
+    if len(self.stack):
+      self.stack[-1] += dt
+
+    # builtin and frozen loaders are classes shared by all their modules, leave them alone
+    if spec is not None and spec.loader is not None and not isinstance(spec.loader, type) and \
+       hasattr(spec.loader, 'exec_module'):
+      spec.loader.exec_module = self.timed(fullname, spec.loader.exec_module)
+    return spec
+
+  def timed(self, fullname, exec_module):
+    def wrapper(module):
+      self.stack.append(0.)
+      t = time.monotonic()
+      try:
+        return exec_module(module)
+      finally:
+        dt = time.monotonic() - t
+        nested = self.stack.pop()
+        self.cumulative[fullname] = self.cumulative.get(fullname, 0.) + dt
+        self.own[fullname] = self.own.get(fullname, 0.) + dt - nested
+        if len(self.stack):
+          self.stack[-1] += dt
+    return wrapper
+
+  def report(self):
+    lines = ["cumulative_ms     own_ms  module"]
+    for name, t in sorted(self.cumulative.items(), key=lambda x: -x[1]):
+      lines.append(f"{t * 1e3:13.1f} {self.own[name] * 1e3:10.1f}  {name}")
+    return "\n".join(lines) + "\n"
+
+  def dump(self, path):
+    with open(path, "w") as f:
+      f.write(self.report())
+
+
+def start_from_env():
+  """Returns a running profiler if IMPORT_PROFILE_DIR is set."""
+  if IMPORT_PROFILE_DIR is None:
+    return None
+  return ImportProfiler().start()
+
+
+def dump_to_env(profiler, name):
+  if profiler is None:
+    return
+  profiler.stop()
+  os.makedirs(IMPORT_PROFILE_DIR, exist_ok=True)
+  profiler.dump(os.path.join(IMPORT_PROFILE_DIR, f"{name}.txt"))
+
+
+if __name__ == "__main__":
+  import importlib
+
+  profiler = ImportProfiler().start()
+  for mod in sys.argv[1:]:
+    importlib.import_module(mod)
+  profiler.stop()
+  print(profiler.report(), end="")
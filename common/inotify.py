@@ -0,0 +1,75 @@
+import os
+import struct
+from collections import namedtuple
+from cffi import FFI
+
+# The EON/termux build of Python doesn't ship an inotify module either, go through libc like common.xattr.
+ffi = FFI()
+ffi.cdef("""
+int inotify_init1(int flags);
+int inotify_add_watch(int fd, const char *pathname, uint32_t mask);
+int inotify_rm_watch(int fd, int wd);
+""")
+libc = ffi.dlopen(None)
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+InotifyEvent = namedtuple('InotifyEvent', ['wd', 'mask', 'cookie', 'name'])
+
+
+class Inotify():
+  def __init__(self, flags=IN_NONBLOCK | IN_CLOEXEC):
+    self.fd = libc.inotify_init1(flags)
+    if self.fd == -1:
+      raise OSError(ffi.errno, f"{os.strerror(ffi.errno)}: inotify_init1({flags})")
+
+  def fileno(self):
+    return self.fd
+
+  def add_watch(self, path, mask):
+    wd = libc.inotify_add_watch(self.fd, path.encode(), mask)
+    if wd == -1:
+      raise OSError(ffi.errno, f"{os.strerror(ffi.errno)}: inotify_add_watch({path}, {mask})")
+    return wd
+
+  def rm_watch(self, wd):
+    if libc.inotify_rm_watch(self.fd, wd) == -1:
+      raise OSError(ffi.errno, f"{os.strerror(ffi.errno)}: inotify_rm_watch({wd})")
+
+  def read(self, size=64 * 1024):
+    """Returns the pending events, or an empty list if there are none and the fd is non-blocking."""
+    try:
+      buf = os.read(self.fd, size)
+    except BlockingIOError:
+      return []
+
+    events = []
+    offset = 0
+    while offset < len(buf):
+      wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(buf, offset)
+      offset += _EVENT_HEADER.size
+      name = buf[offset:offset + name_len].rstrip(b'\0').decode()
+      offset += name_len
+      events.append(InotifyEvent(wd, mask, cookie, name))
+    return events
+
+  def close(self):
+    if self.fd != -1:
+      os.close(self.fd)
+      self.fd = -1
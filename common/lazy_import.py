@@ -0,0 +1,20 @@
+import sys
+import importlib.util
+
+
+def lazy_import(name):
+  """Returns module name, which is only executed once one of its attributes is used.
+  For heavy modules that most runs of a process never touch."""
+  if name in sys.modules:
+    return sys.modules[name]
+
+  spec = importlib.util.find_spec(name)
+  if spec is None:
+    raise ImportError(f"No module named {name!r}", name=name)
+
+  loader = importlib.util.LazyLoader(spec.loader)
+  spec.loader = loader
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[name] = module
+  loader.exec_module(module)
+  return module
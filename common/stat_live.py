@@ -1,4 +1,4 @@
-import numpy as np
+from math import sqrt
 
 class RunningStat():
   # tracks realtime mean and standard deviation without storing any data
@@ -46,7 +46,7 @@ class RunningStat():
       return 0
 
   def std(self):
-    return np.sqrt(self.variance())
+    return sqrt(self.variance())
 
   def params_to_save(self):
     return [self.M, self.S, self.n]
@@ -9,6 +9,7 @@ import time
 import traceback
 import subprocess
 import sys
+import numpy as np
 from .dfu import PandaDFU  # pylint: disable=import-error
 from .esptool import ESPROM, CesantaFlasher  # noqa pylint: disable=import-error
 from .flash_release import flash_release  # noqa pylint: disable=import-error
@@ -31,22 +32,75 @@ def build_st(target, mkfile="Makefile", clean=True):
   cmd = 'cd %s && %s && make -f %s %s' % (os.path.join(BASEDIR, "board"), clean_cmd, mkfile, target)
   _ = subprocess.check_output(cmd, stderr=subprocess.STDOUT, shell=True)
 
-def parse_can_buffer(dat):
-  ret = []
-  for j in range(0, len(dat), 0x10):
-    ddat = dat[j:j + 0x10]
-    f1, f2 = struct.unpack("II", ddat[0:8])
-    extended = 4
-    if f1 & extended:
-      address = f1 >> 3
-    else:
-      address = f1 >> 21
-    dddat = ddat[8:8 + (f2 & 0xF)]
-    if DEBUG:
+# USB/SPI CAN frame: RIR/TIR, length | bus << 4 | bus time << 16, 8 data bytes
+CAN_FRAME_DTYPE = np.dtype([('f1', '<u4'), ('f2', '<u4'), ('dat', 'u1', (8,))])
+
+class CanFrames(object):
+  """Columns of a buffer of CAN frames, decoded in one go. Indexing and iterating
+  give the (address, busTime, dat, src) tuples parse_can_buffer returns."""
+  def __init__(self, address, bus_time, length, src, dat):
+    self.address = address
+    self.bus_time = bus_time
+    self.length = length
+    self.src = src
+    self.dat = dat  # (n, 8) uint8, valid up to length
+
+  def __len__(self):
+    return len(self.address)
+
+  def __getitem__(self, i):
+    length = int(self.length[i])
+    return (int(self.address[i]), int(self.bus_time[i]), self.dat[i, :length].tobytes(), int(self.src[i]))
+
+  def __iter__(self):
+    raw = self.dat.tobytes()
+    dat = [raw[i:i + length] for i, length in zip(range(0, len(raw), 8), self.length.tolist())]
+    return zip(self.address.tolist(), self.bus_time.tolist(), dat, self.src.tolist())
+
+def parse_can_frames(dat):
+  frames = np.frombuffer(dat, dtype=CAN_FRAME_DTYPE, count=len(dat) // CAN_FRAME_DTYPE.itemsize)
+  f1, f2 = frames['f1'], frames['f2']
+  extended = 4
+  address = np.where(f1 & extended, f1 >> 3, f1 >> 21)
+  ret = CanFrames(address, f2 >> 16, np.minimum(f2 & 0xF, 8), (f2 >> 4) & 0xFF, frames['dat'])
+  if DEBUG:
+    for address, _, dddat, _ in ret:
       print(f"  R 0x{address:x}: 0x{dddat.hex()}")
-    ret.append((address, f2 >> 16, dddat, (f2 >> 4) & 0xFF))
   return ret
 
+def parse_can_buffer(dat):
+  return list(parse_can_frames(dat))
+
+def pack_can_frames(address, dat, length, bus):
+  """Packs columns of CAN frames to send, dat is (n, 8) uint8 and valid up to length."""
+  address = np.asarray(address, dtype=np.uint32)
+  length = np.asarray(length, dtype=np.uint32)
+  assert np.all(length <= 8)
+
+  transmit = 1
+  extended = 4
+  frames = np.zeros(len(address), dtype=CAN_FRAME_DTYPE)
+  frames['f1'] = np.where(address >= 0x800, (address << 3) | transmit | extended, (address << 21) | transmit)
+  frames['f2'] = length | (np.asarray(bus, dtype=np.uint32) << 4)
+  frames['dat'] = np.where(np.arange(8) < length[:, None], dat, 0)
+  return frames.tobytes()
+
+_CAN_FRAME = struct.Struct("<II8s")
+
+def pack_can_buffer(arr):
+  # packing rows one by one is faster than building columns from them
+  snd = bytearray(len(arr) * _CAN_FRAME.size)
+  transmit = 1
+  extended = 4
+  for i, (addr, _, dat, bus) in enumerate(arr):
+    assert len(dat) <= 8
+    if addr >= 0x800:
+      rir = (addr << 3) | transmit | extended
+    else:
+      rir = (addr << 21) | transmit
+    _CAN_FRAME.pack_into(snd, i * _CAN_FRAME.size, rir, len(dat) | (bus << 4), dat)
+  return bytes(snd)
+
 class PandaWifiStreaming(object):
   def __init__(self, ip="192.168.0.10", port=1338):
     self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -482,28 +536,23 @@ class Panda(object):
   CAN_SEND_TIMEOUT_MS = 10
 
   def can_send_many(self, arr, timeout=CAN_SEND_TIMEOUT_MS):
-    snds = []
-    transmit = 1
-    extended = 4
-    for addr, _, dat, bus in arr:
-      assert len(dat) <= 8
-      if DEBUG:
+    if DEBUG:
+      for addr, _, dat, _ in arr:
         print(f"  W 0x{addr:x}: 0x{dat.hex()}")
-      if addr >= 0x800:
-        rir = (addr << 3) | transmit | extended
-      else:
-        rir = (addr << 21) | transmit
-      snd = struct.pack("II", rir, len(dat) | (bus << 4)) + dat
-      snd = snd.ljust(0x10, b'\x00')
-      snds.append(snd)
+    self._can_send_buffer(pack_can_buffer(arr), timeout)
 
+  def can_send_frames(self, address, dat, length, bus, timeout=CAN_SEND_TIMEOUT_MS):
+    # columns like can_recv_frames returns, see pack_can_frames
+    self._can_send_buffer(pack_can_frames(address, dat, length, bus), timeout)
+
+  def _can_send_buffer(self, snd, timeout):
     while True:
       try:
         if self.wifi:
-          for s in snds:
-            self._handle.bulkWrite(3, s)
+          for i in range(0, len(snd), 0x10):
+            self._handle.bulkWrite(3, snd[i:i + 0x10])
         else:
-          self._handle.bulkWrite(3, b''.join(snds), timeout=timeout)
+          self._handle.bulkWrite(3, snd, timeout=timeout)
         break
       except (usb1.USBErrorIO, usb1.USBErrorOverflow):
         print("CAN: BAD SEND MANY, RETRYING")
@@ -511,7 +560,7 @@ class Panda(object):
   def can_send(self, addr, dat, bus, timeout=CAN_SEND_TIMEOUT_MS):
     self.can_send_many([[addr, None, dat, bus]], timeout=timeout)
 
-  def can_recv(self):
+  def _can_recv_buffer(self):
     dat = bytearray()
     while True:
       try:
@@ -520,7 +569,13 @@ class Panda(object):
       except (usb1.USBErrorIO, usb1.USBErrorOverflow):
         print("CAN: BAD RECV, RETRYING")
         time.sleep(0.1)
-    return parse_can_buffer(dat)
+    return dat
+
+  def can_recv(self):
+    return parse_can_buffer(self._can_recv_buffer())
+
+  def can_recv_frames(self):
+    return parse_can_frames(self._can_recv_buffer())
 
   def can_clear(self, bus):
     """Clears all messages from the specified internal CAN ringbuffer as
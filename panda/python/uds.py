@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
+import asyncio
+import math
 import time
 import struct
 from collections import deque
-from typing import Callable, NamedTuple, Tuple, List, Deque, Generator, Optional, cast
+from typing import Any, Callable, NamedTuple, Tuple, List, Deque, Dict, Generator, Optional, cast
 from enum import IntEnum
 
 class SERVICE_TYPE(IntEnum):
@@ -501,66 +503,191 @@ def get_rx_addr_for_tx_addr(tx_addr):
   raise ValueError("invalid tx_addr: {}".format(tx_addr))
 
 
+def is_functional_response(tx_addr: int, addr: int) -> bool:
+  if tx_addr == 0x7DF:
+    return addr >= 0x7E8 and addr <= 0x7EF
+  return addr >= 0x18DAF100 and addr <= 0x18DAF1FF
+
+
+# tester present with the positive response suppressed, sent to keep idle sessions open
+TESTER_PRESENT_KEEPALIVE = bytes([0x02, SERVICE_TYPE.TESTER_PRESENT, 0x80]).ljust(8, b"\x00")
+ASYNC_POLL_INTERVAL = 0.001
+
+
+class UdsRequest():
+  """A request queued on a UdsClient. It's sent once the ones queued before it on the same client
+  are answered, result() returns the response data or raises like the blocking service calls."""
+  def __init__(self, client: 'UdsClient', service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None,
+               parse: Callable[[bytes], Any] = None):
+    self._client = client
+    self.service_type = service_type
+    self.subfunction = subfunction
+    self.data = data
+    self._parse = parse
+    self._isotp_msg = None  # type: Optional[IsoTpMessage]
+    self._deadline = math.inf
+    self._result = None  # type: Any
+    self._exception = None  # type: Optional[BaseException]
+    self.done = False
+
+  def _finish(self, result: Any = None, exception: BaseException = None) -> None:
+    self._result = result
+    self._exception = exception
+    self.done = True
+
+  def _start(self, now: float) -> None:
+    req = bytes([self.service_type])
+    if self.subfunction is not None:
+      req += bytes([self.subfunction])
+    if self.data is not None:
+      req += self.data
+
+    # non-blocking, the client's update checks the timeout
+    self._isotp_msg = IsoTpMessage(self._client._can_client, 0, self._client.debug)
+    self._deadline = now + self._client.timeout
+    try:
+      self._isotp_msg.send(req)
+    except Exception as e:
+      self._finish(exception=e)
+
+  def _update(self, now: float) -> None:
+    try:
+      while not self.done:
+        resp = cast(IsoTpMessage, self._isotp_msg).recv()
+        if resp is None:
+          if now > self._deadline:
+            raise MessageTimeoutError("timeout waiting for response")
+          return
+
+        dat = self._client._uds_response(self.service_type, self.subfunction, resp)
+        if dat is None:
+          # response pending, wait another timeout for the response
+          self._deadline = now + self._client.timeout
+          continue
+        self._finish(result=dat if self._parse is None else self._parse(dat))
+    except Exception as e:
+      self._finish(exception=e)
+
+  def _poll(self) -> None:
+    if self._client._manager is not None:
+      self._client._manager.poll()
+    else:
+      self._client._update(time.monotonic())
+
+  def result(self) -> Any:
+    """Waits for the response, polling the manager of the client (or the client alone) meanwhile."""
+    while not self.done:
+      self._poll()
+    if self._exception is not None:
+      raise self._exception
+    return self._result
+
+  async def _wait(self) -> Any:
+    while not self.done:
+      self._poll()
+      if not self.done:
+        await asyncio.sleep(ASYNC_POLL_INTERVAL)
+    return self.result()
+
+  def __await__(self):
+    return self._wait().__await__()
+
+
 class UdsClient():
-  def __init__(self, panda, tx_addr: int, rx_addr: int = None, bus: int = 0, timeout: float = 1, debug: bool = False):
+  def __init__(self, panda, tx_addr: int, rx_addr: int = None, bus: int = 0, timeout: float = 1, debug: bool = False,
+               tester_present_interval: float = None, manager: 'UdsSessionManager' = None):
     self.bus = bus
     self.tx_addr = tx_addr
     self.rx_addr = rx_addr if rx_addr is not None else get_rx_addr_for_tx_addr(tx_addr)
     self.timeout = timeout
     self.debug = debug
-    self._can_client = CanClient(panda.can_send, panda.can_recv, self.tx_addr, self.rx_addr, self.bus, debug=self.debug)
+    self.tester_present_interval = tester_present_interval
+
+    # clients of a session manager get the frames it received for them instead of reading the panda
+    self._manager = manager
+    self._rx_frames = []  # type: List[Tuple[int, int, bytes, int]]
+    self._requests = deque()  # type: Deque[UdsRequest]
+    self._request = None  # type: Optional[UdsRequest]
+    self._last_tx = time.monotonic()
+    can_recv = panda.can_recv if manager is None else self._take_rx_frames
+    self._can_client = CanClient(panda.can_send, can_recv, self.tx_addr, self.rx_addr, self.bus, debug=self.debug)
+
+  def _take_rx_frames(self) -> List[Tuple[int, int, bytes, int]]:
+    frames, self._rx_frames = self._rx_frames, []
+    return frames
+
+  def submit(self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None,
+             parse: Callable[[bytes], Any] = None) -> UdsRequest:
+    """Queues a request without waiting for its response. parse is applied to the response data."""
+    req = UdsRequest(self, service_type, subfunction, data, parse)
+    self._requests.append(req)
+    return req
+
+  def _update(self, now: float) -> None:
+    """Advances the current request, starts the next one queued when it's done and keeps the
+    session alive with tester present when idle."""
+    if self._request is not None:
+      self._request._update(now)
+      if self._request.done:
+        # the session timer of the ECU restarts with its response
+        self._request = None
+        self._last_tx = now
+
+    while self._request is None and len(self._requests):
+      self._request = self._requests.popleft()
+      self._last_tx = now
+      self._request._start(now)
+      if self._request.done:
+        self._request = None
+
+    if self._request is None and self.tester_present_interval is not None and \
+       now - self._last_tx >= self.tester_present_interval:
+      if self.debug:
+        print("UDS-TX: tester present keepalive")
+      self._can_client.send([TESTER_PRESENT_KEEPALIVE])
+      self._last_tx = now
+
+  def _uds_response(self, service_type: SERVICE_TYPE, subfunction: Optional[int], resp: bytes) -> Optional[bytes]:
+    """Returns the data of a positive response, None if the response is pending."""
+    resp_sid = resp[0] if len(resp) > 0 else None
+
+    # negative response
+    if resp_sid == 0x7F:
+      service_id = resp[1] if len(resp) > 1 else -1
+      try:
+        service_desc = SERVICE_TYPE(service_id).name
+      except BaseException:
+        service_desc = 'NON_STANDARD_SERVICE'
+      error_code = resp[2] if len(resp) > 2 else -1
+      try:
+        error_desc = _negative_response_codes[error_code]
+      except BaseException:
+        error_desc = resp[3:].hex()
+      # wait for another message if response pending
+      if error_code == 0x78:
+        if self.debug:
+          print("UDS-RX: response pending")
+        return None
+      raise NegativeResponseError('{} - {}'.format(service_desc, error_desc), service_id, error_code)
 
-  # generic uds request
-  def _uds_request(self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
-    req = bytes([service_type])
-    if subfunction is not None:
-      req += bytes([subfunction])
-    if data is not None:
-      req += data
+    # positive response
+    if service_type + 0x40 != resp_sid:
+      resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
+      raise InvalidServiceIdError('invalid response service id: {}'.format(resp_sid_hex))
 
-    # send request, wait for response
-    isotp_msg = IsoTpMessage(self._can_client, self.timeout, self.debug)
-    isotp_msg.send(req)
-    while True:
-      resp = isotp_msg.recv()
-
-      if resp is None:
-        continue
-
-      resp_sid = resp[0] if len(resp) > 0 else None
-
-      # negative response
-      if resp_sid == 0x7F:
-        service_id = resp[1] if len(resp) > 1 else -1
-        try:
-          service_desc = SERVICE_TYPE(service_id).name
-        except BaseException:
-          service_desc = 'NON_STANDARD_SERVICE'
-        error_code = resp[2] if len(resp) > 2 else -1
-        try:
-          error_desc = _negative_response_codes[error_code]
-        except BaseException:
-          error_desc = resp[3:].hex()
-        # wait for another message if response pending
-        if error_code == 0x78:
-          if self.debug:
-            print("UDS-RX: response pending")
-          continue
-        raise NegativeResponseError('{} - {}'.format(service_desc, error_desc), service_id, error_code)
-
-      # positive response
-      if service_type + 0x40 != resp_sid:
-        resp_sid_hex = hex(resp_sid) if resp_sid is not None else None
-        raise InvalidServiceIdError('invalid response service id: {}'.format(resp_sid_hex))
+    if subfunction is not None:
+      resp_sfn = resp[1] if len(resp) > 1 else None
+      if subfunction != resp_sfn:
+        resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
+        raise InvalidSubFunctioneError(f'invalid response subfunction: {resp_sfn_hex:x}')
 
-      if subfunction is not None:
-        resp_sfn = resp[1] if len(resp) > 1 else None
-        if subfunction != resp_sfn:
-          resp_sfn_hex = hex(resp_sfn) if resp_sfn is not None else None
-          raise InvalidSubFunctioneError(f'invalid response subfunction: {resp_sfn_hex:x}')
+    # return data (exclude service id and sub-function id)
+    return resp[(1 if subfunction is None else 2):]
 
-      # return data (exclude service id and sub-function id)
-      return resp[(1 if subfunction is None else 2):]
+  # generic uds request
+  def _uds_request(self, service_type: SERVICE_TYPE, subfunction: int = None, data: bytes = None) -> bytes:
+    # send request after the ones already queued, wait for response
+    return self.submit(service_type, subfunction, data).result()
 
   # services
   def diagnostic_session_control(self, session_type: SESSION_TYPE):
@@ -648,13 +775,18 @@ class UdsClient():
     self._uds_request(SERVICE_TYPE.LINK_CONTROL, subfunction=link_control_type, data=data)
 
   def read_data_by_identifier(self, data_identifier_type: DATA_IDENTIFIER_TYPE):
+    return self.submit_read_data_by_identifier(data_identifier_type).result()
+
+  def submit_read_data_by_identifier(self, data_identifier_type: DATA_IDENTIFIER_TYPE) -> UdsRequest:
     # TODO: support list of identifiers
+    def parse(resp):
+      resp_id = struct.unpack('!H', resp[0:2])[0] if len(resp) >= 2 else None
+      if resp_id != data_identifier_type:
+        raise ValueError('invalid response data identifier: {}'.format(hex(resp_id)))
+      return resp[2:]
+
     data = struct.pack('!H', data_identifier_type)
-    resp = self._uds_request(SERVICE_TYPE.READ_DATA_BY_IDENTIFIER, subfunction=None, data=data)
-    resp_id = struct.unpack('!H', resp[0:2])[0] if len(resp) >= 2 else None
-    if resp_id != data_identifier_type:
-      raise ValueError('invalid response data identifier: {}'.format(hex(resp_id)))
-    return resp[2:]
+    return self.submit(SERVICE_TYPE.READ_DATA_BY_IDENTIFIER, subfunction=None, data=data, parse=parse)
 
   def read_memory_by_address(self, memory_address: int, memory_size: int, memory_address_bytes: int = 4, memory_size_bytes: int = 1):
     if memory_address_bytes < 1 or memory_address_bytes > 4:
@@ -855,3 +987,66 @@ class UdsClient():
 
   def request_transfer_exit(self):
     self._uds_request(SERVICE_TYPE.REQUEST_TRANSFER_EXIT, subfunction=None)
+
+
+class UdsSessionManager():
+  """Owns the CAN receive path of one panda bus for many UdsClients. Every poll reads the panda once
+  and hands each frame to the client waiting for its address, so requests to different ECUs run
+  concurrently and the ones queued on the same client are sent back to back as each is answered.
+
+  Requests are driven from poll, which UdsRequest.result() and awaiting a request call. Tester
+  present keepalives are sent from poll too, keep polling while sessions need to stay open."""
+  def __init__(self, panda, bus: int = 0, debug: bool = False):
+    self.panda = panda
+    self.bus = bus
+    self.debug = debug
+    self.clients = []  # type: List[UdsClient]
+    self._rx_clients = {}  # type: Dict[int, UdsClient]
+    self._functional_clients = []  # type: List[UdsClient]
+
+  def client(self, tx_addr: int, rx_addr: int = None, timeout: float = 1, tester_present_interval: float = None) -> UdsClient:
+    client = UdsClient(self.panda, tx_addr, rx_addr, self.bus, timeout, self.debug, tester_present_interval, manager=self)
+    if client.rx_addr is None:
+      self._functional_clients.append(client)
+    elif client.rx_addr in self._rx_clients:
+      raise ValueError('rx_addr already used by another client: {}'.format(hex(client.rx_addr)))
+    else:
+      self._rx_clients[client.rx_addr] = client
+    self.clients.append(client)
+    return client
+
+  def _recv(self) -> None:
+    while True:
+      msgs = self.panda.can_recv()
+      for msg in msgs or []:
+        rx_addr, rx_bus = msg[0], msg[3]
+        if rx_bus != self.bus:
+          continue
+
+        # frames for idle clients are stale once their next request is sent
+        client = self._rx_clients.get(rx_addr)
+        if client is not None:
+          if client._request is not None:
+            client._rx_frames.append(msg)
+          continue
+        for client in self._functional_clients:
+          if client._request is not None and is_functional_response(client.tx_addr, rx_addr):
+            client._rx_frames.append(msg)
+      # break when non-full buffer is processed
+      if len(msgs) < 254:
+        return
+
+  def poll(self) -> None:
+    """Receives the frames waiting on the bus and advances the requests of every client."""
+    self._recv()
+    now = time.monotonic()
+    for client in self.clients:
+      client._update(now)
+
+  def gather(self, requests: List[UdsRequest], return_exceptions: bool = False) -> List[Any]:
+    """Polls until all requests are answered and returns their results in order."""
+    while not all(r.done for r in requests):
+      self.poll()
+    if return_exceptions:
+      return [r._exception if r._exception is not None else r._result for r in requests]
+    return [r.result() for r in requests]
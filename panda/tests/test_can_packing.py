@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import random
+import struct
+import unittest
+import numpy as np
+
+from panda.python import parse_can_frames, parse_can_buffer, pack_can_frames, pack_can_buffer
+
+NUM_BUFFERS = 2000
+
+
+# the per frame implementations these replaced
+def parse_can_buffer_loop(dat):
+  ret = []
+  for j in range(0, len(dat), 0x10):
+    ddat = dat[j:j + 0x10]
+    f1, f2 = struct.unpack("II", ddat[0:8])
+    extended = 4
+    if f1 & extended:
+      address = f1 >> 3
+    else:
+      address = f1 >> 21
+    dddat = ddat[8:8 + (f2 & 0xF)]
+    ret.append((address, f2 >> 16, dddat, (f2 >> 4) & 0xFF))
+  return ret
+
+
+def pack_can_buffer_loop(arr):
+  snds = []
+  transmit = 1
+  extended = 4
+  for addr, _, dat, bus in arr:
+    assert len(dat) <= 8
+    if addr >= 0x800:
+      rir = (addr << 3) | transmit | extended
+    else:
+      rir = (addr << 21) | transmit
+    snd = struct.pack("II", rir, len(dat) | (bus << 4)) + dat
+    snd = snd.ljust(0x10, b'\x00')
+    snds.append(snd)
+  return b''.join(snds)
+
+
+def random_buffer(rnd):
+  """Whole 16 byte frames like the panda sends, with random words so also lengths over 8."""
+  return bytearray(rnd.getrandbits(8) for _ in range(0x10 * rnd.choice([0, 1, 2, rnd.randint(0, 256)])))
+
+
+def random_frames(rnd):
+  arr = []
+  for _ in range(rnd.choice([0, 1, rnd.randint(0, 256)])):
+    addr = rnd.choice([rnd.randint(0, 0x7ff), rnd.randint(0x800, 0x1fffffff)])
+    dat = bytes(rnd.getrandbits(8) for _ in range(rnd.randint(0, 8)))
+    arr.append([addr, rnd.randint(0, 0xffff), dat, rnd.randint(0, 3)])
+  return arr
+
+
+class TestCanPacking(unittest.TestCase):
+  def test_parse(self):
+    rnd = random.Random(0)
+    for _ in range(NUM_BUFFERS):
+      dat = random_buffer(rnd)
+      expected = parse_can_buffer_loop(dat)
+      self.assertEqual(parse_can_buffer(dat), expected)
+      self.assertEqual(parse_can_buffer(bytes(dat)), expected)
+
+      frames = parse_can_frames(dat)
+      self.assertEqual(len(frames), len(expected))
+      self.assertEqual(list(frames), expected)
+      self.assertEqual([frames[i] for i in range(len(frames))], expected)
+      self.assertEqual(frames.address.tolist(), [f[0] for f in expected])
+      self.assertEqual(frames.bus_time.tolist(), [f[1] for f in expected])
+      self.assertEqual(frames.length.tolist(), [len(f[2]) for f in expected])
+      self.assertEqual(frames.src.tolist(), [f[3] for f in expected])
+
+  def test_pack(self):
+    rnd = random.Random(1)
+    for _ in range(NUM_BUFFERS):
+      arr = random_frames(rnd)
+      expected = pack_can_buffer_loop(arr)
+      self.assertEqual(pack_can_buffer(arr), expected)
+
+      # columns, with garbage after each frame's length
+      n = len(arr)
+      dat = np.frombuffer(bytes(rnd.getrandbits(8) for _ in range(8 * n)), dtype=np.uint8).reshape(n, 8).copy()
+      for i, (_, _, d, _) in enumerate(arr):
+        dat[i, :len(d)] = np.frombuffer(d, dtype=np.uint8)
+      packed = pack_can_frames([a[0] for a in arr], dat, [len(a[2]) for a in arr], [a[3] for a in arr])
+      self.assertEqual(packed, expected)
+
+      # and back, without the bus time
+      self.assertEqual(parse_can_buffer(expected), [(a[0], 0, a[2], a[3]) for a in arr])
+
+  def test_pack_too_long(self):
+    arr = [[0x200, 0, b"\x00" * 9, 0]]
+    for pack in [pack_can_buffer, pack_can_buffer_loop]:
+      with self.assertRaises(AssertionError):
+        pack(arr)
+    with self.assertRaises(AssertionError):
+      pack_can_frames([0x200], np.zeros((1, 8), dtype=np.uint8), [9], [0])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,13 +1,48 @@
 import os
+import hashlib
 from cffi import FFI
 
 TEMPLATE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'templates'))
 
+# Bump when the code generators change in a way that alters their output,
+# this invalidates all cached generated code.
+GENERATOR_VERSION = 1
+HASH_PREFIX = "// rednose codegen hash: "
 
-def write_code(folder, name, code, header):
+
+def code_hash(*model):
+  """Hash of a symbolic model and the generator version. Sympy objects
+  print deterministically, so hashing their string form is enough."""
+  import sympy as sp
+  h = hashlib.sha1()
+  h.update(f"{GENERATOR_VERSION} {sp.__version__}".encode())
+  for m in model:
+    h.update(str(m).encode())
+  return h.hexdigest()
+
+
+def template_code(name):
+  with open(os.path.join(TEMPLATE_DIR, name)) as f:
+    return f.read()
+
+
+def code_is_cached(folder, name, digest):
+  code_fn = os.path.join(folder, f"{name}.cpp")
+  header_fn = os.path.join(folder, f"{name}.h")
+  if not os.path.exists(header_fn) or not os.path.exists(code_fn):
+    return False
+
+  with open(code_fn) as f:
+    return f.readline().rstrip("\n") == HASH_PREFIX + digest
+
+
+def write_code(folder, name, code, header, digest=None):
   if not os.path.exists(folder):
     os.mkdir(folder)
 
+  if digest is not None:
+    code = HASH_PREFIX + digest + "\n" + code
+
   open(os.path.join(folder, f"{name}.cpp"), 'w').write(code)
   open(os.path.join(folder, f"{name}.h"), 'w').write(header)
 
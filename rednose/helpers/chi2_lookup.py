@@ -2,6 +2,8 @@ import os
 
 import numpy as np
 
+_TABLE = None
+
 
 def gen_chi2_ppf_lookup(max_dim=200):
   from scipy.stats import chi2
@@ -13,8 +15,10 @@ def gen_chi2_ppf_lookup(max_dim=200):
 
 
 def chi2_ppf(p, dim):
-  table = np.load(os.path.dirname(os.path.realpath(__file__)) + '/chi2_lookup_table.npy')
-  result = np.interp(p, np.arange(.01, .99, .01), table[dim])
+  global _TABLE
+  if _TABLE is None:
+    _TABLE = np.load(os.path.dirname(os.path.realpath(__file__)) + '/chi2_lookup_table.npy')
+  result = np.interp(p, np.arange(.01, .99, .01), _TABLE[dim])
   return result
 
 
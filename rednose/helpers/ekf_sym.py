@@ -1,20 +1,39 @@
-import os
 from bisect import bisect_right
 
 import numpy as np
-import sympy as sp
 from numpy import dot
+# the lapack routines behind scipy.linalg.cho_factor, cho_solve and solve_triangular, without
+# their argument checks, which cost more than the solves for the few dimensions of an observation
+from scipy.linalg.lapack import dpotrf, dpotrs, dtrtrs
 
-from rednose.helpers.sympy_helpers import sympy_into_c
-from rednose.helpers import (TEMPLATE_DIR, load_code, write_code)
+from rednose.helpers import (code_hash, code_is_cached, load_code,
+                              template_code, write_code)
 from rednose.helpers.chi2_lookup import chi2_ppf
 
 
-def solve(a, b):
-  if a.shape[0] == 1 and a.shape[1] == 1:
-    return b / a[0][0]
-  else:
-    return np.linalg.solve(a, b)
+def cholesky(S):
+  """Lower cholesky factor L of S, its upper triangle is left as is. None if S isn't positive definite."""
+  if S.shape == (1, 1):
+    return np.sqrt(S) if S[0][0] > 0 else None
+  L, info = dpotrf(S, lower=1, clean=0)
+  return L if info == 0 else None
+
+
+def cho_solve_or_solve(S, L, b):
+  """S^-1 b given the cholesky factor of S, with a general solve if S has none."""
+  if S.shape == (1, 1):
+    return b / S[0][0]
+  if L is None:
+    return np.linalg.solve(S, b)
+  return dpotrs(L, b, lower=1)[0]
+
+
+def mahalanobis(S, L, y):
+  """y^T S^-1 y, which with S = L L^T is the squared norm of L^-1 y."""
+  if L is None:
+    return y.T.dot(np.linalg.solve(S, y))
+  w = dtrtrs(L, y, lower=1)[0]
+  return w.T.dot(w)
 
 
 def null(H, eps=1e-12):
@@ -26,12 +45,26 @@ def null(H, eps=1e-12):
 
 
 def gen_code(folder, name, f_sym, dt_sym, x_sym, obs_eqs, dim_x, dim_err, eskf_params=None, msckf_params=None,  # pylint: disable=dangerous-default-value
-             maha_test_kinds=[], global_vars=None):
+             maha_test_kinds=[], global_vars=None, extra_routines=None):
   # optional state transition matrix, H modifier
   # and err_function if an error-state kalman filter (ESKF)
   # is desired. Best described in "Quaternion kinematics
   # for the error-state Kalman filter" by Joan Sola
 
+  # extra_routines are additional (name, expr, args) sympy functions
+  # that are compiled into the same library
+
+  # skip differentiation and code generation if the model didn't change
+  ekf_template = template_code("ekf_c.c")
+  digest = code_hash(f_sym, dt_sym, x_sym, obs_eqs, dim_x, dim_err, eskf_params, msckf_params,
+                     maha_test_kinds, global_vars, extra_routines, ekf_template)
+  if code_is_cached(folder, name, digest):
+    return
+
+  # sympy is only needed to generate code, keep it out of the filters' imports
+  import sympy as sp
+  from rednose.helpers.sympy_helpers import sympy_into_c
+
   if eskf_params:
     err_eqs = eskf_params[0]
     inv_err_eqs = eskf_params[1]
@@ -108,6 +141,9 @@ def gen_code(folder, name, f_sym, dt_sym, x_sym, obs_eqs, dim_x, dim_err, eskf_p
     if msckf and kind in feature_track_kinds:
       sympy_functions.append(('He_%d' % kind, He_sym, [x_sym, ea_sym]))
 
+  if extra_routines is not None:
+    sympy_functions += extra_routines
+
   # Generate and wrap all th c code
   header, code = sympy_into_c(sympy_functions, global_vars)
   extra_header = "#define DIM %d\n" % dim_x
@@ -137,7 +173,7 @@ def gen_code(folder, name, f_sym, dt_sym, x_sym, obs_eqs, dim_x, dim_err, eskf_p
     extra_header += "\nvoid update_%d(double *, double *, double *, double *, double *);" % kind
 
   code += '\nextern "C"{\n' + extra_header + "\n}\n"
-  code += "\n" + open(os.path.join(TEMPLATE_DIR, "ekf_c.c")).read()
+  code += "\n" + ekf_template
   code += '\nextern "C"{\n' + extra_post + "\n}\n"
 
   if global_vars is not None:
@@ -152,7 +188,7 @@ def gen_code(folder, name, f_sym, dt_sym, x_sym, obs_eqs, dim_x, dim_err, eskf_p
 
   header += "\n" + extra_header
 
-  write_code(folder, name, code, header)
+  write_code(folder, name, code, header, digest)
 
 
 class EKF_sym():
@@ -178,6 +214,10 @@ class EKF_sym():
     # tested for outlier rejection
     self.maha_test_kinds = maha_test_kinds
 
+    # chi-square thresholds per (observation dimension, confidence), looked
+    # up on first use, the table lookup is too slow to do for every test
+    self.maha_thresholds = {}
+
     self.global_vars = global_vars
 
     # process noise
@@ -240,7 +280,8 @@ class EKF_sym():
 
     if self.global_vars is not None:
       for var in self.global_vars:
-        fun_name = f"set_{var.name}"
+        # sympy symbols when generating code, their names are enough at runtime
+        fun_name = f"set_{var if isinstance(var, str) else var.name}"
         setattr(self, fun_name, getattr(lib, fun_name))
 
     # wrap the C++ predict function
@@ -509,23 +550,26 @@ class EKF_sym():
     self.H_mod(x, H_mod)
     H = H.dot(H_mod)
 
+    # Outlier resilient weighting as described in:
+    # "A Kalman Filter for Robust Outlier Detection - Jo-Anne Ting, ..."
+    weight = 1  # (1.5)/(1 + np.sum(y**2)/np.sum(R))
+
+    HP = dot(H, P)
+    S = dot(HP, H.T) + R / weight
+    L = cholesky(S)
+
     # Do mahalobis distance test
     # currently just runs on msckf observations
     # could run on anything if needed
     if self.msckf and kind in self.maha_test_kinds:
-      a = np.linalg.inv(H.dot(P).dot(H.T) + R)
-      maha_dist = y.T.dot(a.dot(y))
-      if maha_dist > chi2_ppf(0.95, y.shape[0]):
+      if mahalanobis(S, L, y) > self.maha_threshold(y.shape[0]):
         R = 10e16 * R
+        S = dot(HP, H.T) + R / weight
+        L = cholesky(S)
 
     # *** same below this line ***
 
-    # Outlier resilient weighting as described in:
-    # "A Kalman Filter for Robust Outlier Detection - Jo-Anne Ting, ..."
-    weight = 1  # (1.5)/(1 + np.sum(y**2)/np.sum(R))
-
-    S = dot(dot(H, P), H.T) + R / weight
-    K = solve(S, dot(H, P.T)).T
+    K = cho_solve_or_solve(S, L, dot(H, P.T)).T
     I_KH = np.eye(P.shape[0]) - dot(K, H)
 
     # update actual state
@@ -537,7 +581,13 @@ class EKF_sym():
     self.err_function(x, delta_x, x_new)
     return x_new, P, y.flatten()
 
-  def maha_test(self, x, P, kind, z, R, extra_args=[], maha_thresh=0.95):  # pylint: disable=dangerous-default-value
+  def maha_threshold(self, dim, confidence=0.95):
+    key = (dim, confidence)
+    if key not in self.maha_thresholds:
+      self.maha_thresholds[key] = chi2_ppf(confidence, dim)
+    return self.maha_thresholds[key]
+
+  def _residual(self, x, P, kind, z, extra_args):
     # init vars
     z = z.reshape((-1, 1))
     h = np.zeros(z.shape, dtype=np.float64)
@@ -554,14 +604,50 @@ class EKF_sym():
     H_mod = np.zeros((x.shape[0], P.shape[0]), dtype=np.float64)
     self.H_mod(x, H_mod)
     H = H.dot(H_mod)
+    return y, H
+
+  def maha_test(self, x, P, kind, z, R, extra_args=[], maha_thresh=0.95):  # pylint: disable=dangerous-default-value
+    y, H = self._residual(x, P, kind, z, extra_args)
 
-    a = np.linalg.inv(H.dot(P).dot(H.T) + R)
-    maha_dist = y.T.dot(a.dot(y))
-    if maha_dist > chi2_ppf(maha_thresh, y.shape[0]):
+    S = H.dot(P).dot(H.T) + R
+    maha_dist = mahalanobis(S, cholesky(S), y)
+    if maha_dist > self.maha_threshold(y.shape[0], maha_thresh):
       return False
     else:
       return True
 
+  def maha_test_batch(self, x, P, kind, z, R, extra_args=None, maha_thresh=0.95):
+    """Mahalanobis gating of many candidate observations of the same kind
+    against the same state. Returns a boolean array, True where the observation passes.
+
+    Args:
+      z         (vec [n,dim_z]): Measurements
+      R  (mat [n,dim_z, dim_z]): Measurement Noise
+      extra_args    (list, [n]): Values used in H computations
+    """
+    if len(z) == 0:
+      return np.zeros(0, dtype=bool)
+    if extra_args is None:
+      extra_args = [[]] * len(z)
+
+    ys, HPHTs = [], []
+    for z_i, extra_args_i in zip(z, extra_args):
+      z_i = np.array(z_i, dtype=np.float64, order='F')
+      extra_args_i = np.array(extra_args_i, dtype=np.float64, order='F')
+      y, H = self._residual(x, P, kind, z_i, extra_args_i)
+      ys.append(y)
+      HPHTs.append(H.dot(P).dot(H.T))
+
+    # stacked cholesky for all candidates at once, falling back to one at a time when
+    # one of them isn't positive definite
+    S = np.array(HPHTs) + np.asarray(R, dtype=np.float64)
+    try:
+      L = np.linalg.cholesky(S)
+      maha_dist = [np.sum(dtrtrs(L_i, y, lower=1)[0]**2) for L_i, y in zip(L, ys)]
+    except np.linalg.LinAlgError:
+      maha_dist = [mahalanobis(S_i, cholesky(S_i), y) for S_i, y in zip(S, ys)]
+    return np.array(maha_dist).reshape(-1) <= self.maha_threshold(ys[0].shape[0], maha_thresh)
+
   def rts_smooth(self, estimates, norm_quats=False):
     '''
     Returns rts smoothed results of
@@ -1,11 +1,11 @@
 #!/usr/bin/env python3
 
-import os
 import sys
 
 import numpy as np
 
-from rednose.helpers import TEMPLATE_DIR, load_code, write_code
+from rednose.helpers import (code_hash, code_is_cached, load_code,
+                              template_code, write_code)
 from rednose.helpers.sympy_helpers import quat_matrix_l, rot_matrix
 
 
@@ -29,16 +29,21 @@ class FeatureHandler():
 
   @staticmethod
   def generate_code(generated_dir, K=5):
+    filename = f"{FeatureHandler.name}_{K}"
+    template = template_code("feature_handler.c")
+    digest = code_hash(K, template)
+    if code_is_cached(generated_dir, filename, digest):
+      return
+
     # Wrap c code for slow matching
     c_header = "\nvoid merge_features(double *tracks, double *features, long long *empty_idxs);"
 
     c_code = "#include <math.h>\n"
     c_code += "#include <string.h>\n"
     c_code += "#define K %d\n" % K
-    c_code += "\n" + open(os.path.join(TEMPLATE_DIR, "feature_handler.c")).read()
+    c_code += "\n" + template
 
-    filename = f"{FeatureHandler.name}_{K}"
-    write_code(generated_dir, filename, c_code, c_header)
+    write_code(generated_dir, filename, c_code, c_header, digest)
 
   def __init__(self, generated_dir, K=5):
     self.MAX_TRACKS = 6000
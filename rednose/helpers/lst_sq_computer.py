@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
-import os
+import inspect
 import sys
 
 import numpy as np
 import sympy as sp
 
-from rednose.helpers import TEMPLATE_DIR, load_code, write_code
+from rednose.helpers import (code_hash, code_is_cached, load_code,
+                              template_code, write_code)
 from rednose.helpers.sympy_helpers import quat_rotate, sympy_into_c, rot_matrix, rotations_from_quats
 
 
@@ -47,18 +48,24 @@ class LstSqComputer():
 
   @staticmethod
   def generate_code(generated_dir, K=4):
+    filename = f"{LstSqComputer.name}_{K}"
+    template = template_code("compute_pos.c")
+    # the residual model is fully defined by K and its generating function
+    digest = code_hash(K, inspect.getsource(generate_residual), template)
+    if code_is_cached(generated_dir, filename, digest):
+      return
+
     sympy_functions = generate_residual(K)
     header, code = sympy_into_c(sympy_functions)
 
     code += "\n#define KDIM %d\n" % K
-    code += "\n" + open(os.path.join(TEMPLATE_DIR, "compute_pos.c")).read()
+    code += "\n" + template
 
     header += """
     void compute_pos(double *to_c, double *in_poses, double *in_img_positions, double *param, double *pos);
     """
 
-    filename = f"{LstSqComputer.name}_{K}"
-    write_code(generated_dir, filename, code, header)
+    write_code(generated_dir, filename, code, header, digest)
 
   def __init__(self, generated_dir, K=4, MIN_DEPTH=2, MAX_DEPTH=500):
     self.to_c = rot_matrix(-np.pi / 2, -np.pi / 2, 0)
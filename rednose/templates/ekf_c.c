@@ -84,21 +84,27 @@ void update(double *in_x, double *in_P, Hfun h_fun, Hfun H_fun, Hfun Hea_fun, do
   DEM H_mod(in_H_mod);
   XEM H_err = H * H_mod;
 
+  // Outlier resilient weighting
+  double weight = 1;//(1.5)/(1 + y.squaredNorm()/R.sum());
+
+  // innovation covariance, its cholesky factorization is shared
+  // by the mahalanobis test and the kalman gain
+  XXM HP = H_err * P;
+  XXM S = (HP * H_err.transpose()) + R/weight;
+  Eigen::LLT<XXM> S_llt(S);
+
   // Do mahalobis distance test
   if (MAHA_TEST){
-    XXM a = (H_err * P * H_err.transpose() + R).inverse();
-    double maha_dist = y.transpose() * a * y;
+    double maha_dist = y.dot(S_llt.solve(y));
     if (maha_dist > MAHA_THRESHOLD){
       R = 1.0e16 * R;
+      S = (HP * H_err.transpose()) + R/weight;
+      S_llt.compute(S);
     }
   }
 
-  // Outlier resilient weighting
-  double weight = 1;//(1.5)/(1 + y.squaredNorm()/R.sum());
-
   // kalman gains and I_KH
-  XXM S = ((H_err * P) * H_err.transpose()) + R/weight;
-  XEM KT = S.fullPivLu().solve(H_err * P.transpose());
+  XEM KT = S_llt.solve(H_err * P.transpose());
   //EZM K = KT.transpose(); TODO: WHY DOES THIS NOT COMPILE?
   //EZM K = S.fullPivLu().solve(H_err * P.transpose()).transpose();
   //std::cout << "Here is the matrix rot:\n" << K << std::endl;
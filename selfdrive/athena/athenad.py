@@ -10,15 +10,15 @@ import select
 import socket
 import threading
 import time
-from collections import namedtuple
+from collections import deque, namedtuple
 from functools import partial
 from typing import Any
 
-import requests
 from jsonrpc import JSONRPCResponseManager, dispatcher
 from websocket import ABNF, WebSocketTimeoutException, create_connection
 
 import cereal.messaging as messaging
+from cereal import log
 from cereal.services import service_list
 from common import android
 from common.api import Api
@@ -26,18 +26,28 @@ from common.basedir import PERSIST
 from common.params import Params
 from common.realtime import sec_since_boot
 from selfdrive.loggerd.config import ROOT
+from selfdrive.loggerd.upload_session import UploadSession
 from selfdrive.swaglog import cloudlog
 
 ATHENA_HOST = os.getenv('ATHENA_HOST', 'wss://athena.comma.ai')
 HANDLER_THREADS = int(os.getenv('HANDLER_THREADS', "4"))
 LOCAL_PORT_WHITELIST = set([8022])
+MAX_SUBSCRIPTIONS = 8
+BINARY_QUEUE_SIZE = 100
 
 dispatcher["echo"] = lambda s: s
 payload_queue: Any = queue.Queue()
 response_queue: Any = queue.Queue()
+# binary subscription messages, the oldest are dropped when the websocket can't keep up
+binary_queue: Any = deque(maxlen=BINARY_QUEUE_SIZE)
+send_event = threading.Event()
 upload_queue: Any = queue.Queue()
 cancelled_uploads: Any = set()
 UploadItem = namedtuple('UploadItem', ['path', 'url', 'headers', 'created_at', 'id'])
+upload_session = UploadSession()
+Subscription = namedtuple('Subscription', ['end_event', 'binary'])
+subscriptions: Any = {}
+subscriptions_lock = threading.Lock()
 
 
 def handle_long_poll(ws):
@@ -67,16 +77,39 @@ def handle_long_poll(ws):
 
 def jsonrpc_handler(end_event):
   dispatcher["startLocalProxy"] = partial(startLocalProxy, end_event)
+  dispatcher["subscribe"] = partial(subscribe, end_event)
   while not end_event.is_set():
     try:
       data = payload_queue.get(timeout=1)
       response = JSONRPCResponseManager.handle(data, dispatcher)
-      response_queue.put_nowait(response)
+      send_response(response)
     except queue.Empty:
       pass
     except Exception as e:
       cloudlog.exception("athena jsonrpc handler failed")
-      response_queue.put_nowait(json.dumps({"error": str(e)}))
+      send_response(json.dumps({"error": str(e)}))
+
+
+def send_response(response):
+  response_queue.put_nowait(response)
+  send_event.set()
+
+
+def send_binary(dat):
+  binary_queue.append(dat)
+  send_event.set()
+
+
+def next_response():
+  """Responses go out before binary subscription messages, None when there's nothing to send."""
+  try:
+    return response_queue.get_nowait()
+  except queue.Empty:
+    pass
+  try:
+    return binary_queue.popleft()
+  except IndexError:
+    return None
 
 
 def upload_handler(end_event):
@@ -94,12 +127,47 @@ def upload_handler(end_event):
 
 
 def _do_upload(upload_item):
-  with open(upload_item.path, "rb") as f:
-    size = os.fstat(f.fileno()).st_size
-    return requests.put(upload_item.url,
-                        data=f,
-                        headers={**upload_item.headers, 'Content-Length': str(size)},
-                        timeout=10)
+  return upload_session.put(upload_item.path, upload_item.url, upload_item.headers)
+
+
+class CachedSubscriber():
+  """Conflating socket for one service, kept open between calls, and its latest message."""
+
+  def __init__(self, service):
+    self.lock = threading.Lock()
+    self.sock = messaging.sub_sock(service, conflate=True)
+    freq = service_list[service].frequency
+    # a message less than one period old is as fresh as waiting for the next one
+    self.max_age = 1. / freq if freq > 0 else 0.
+    self.latest = None
+    self.latest_dict = None
+
+  def get(self, timeout):
+    with self.lock:
+      dat = self.sock.receive(non_blocking=True)
+      if dat is None and (self.latest is None or sec_since_boot() - self.latest.logMonoTime * 1e-9 > self.max_age):
+        self.sock.setTimeout(timeout)
+        dat = self.sock.receive()
+        if dat is None:
+          raise TimeoutError
+
+      if dat is not None:
+        self.latest = log.Event.from_bytes(dat)
+        self.latest_dict = None
+      if self.latest_dict is None:
+        self.latest_dict = self.latest.to_dict()
+      return self.latest_dict
+
+
+cached_subscribers: Any = {}
+cached_subscribers_lock = threading.Lock()
+
+
+def get_cached_subscriber(service):
+  with cached_subscribers_lock:
+    if service not in cached_subscribers:
+      cached_subscribers[service] = CachedSubscriber(service)
+    return cached_subscribers[service]
 
 
 # security: user should be able to request any message from their car
@@ -108,13 +176,68 @@ def getMessage(service=None, timeout=1000):
   if service is None or service not in service_list:
     raise Exception("invalid service")
 
-  socket = messaging.sub_sock(service, timeout=timeout)
-  ret = messaging.recv_one(socket)
+  return get_cached_subscriber(service).get(timeout)
+
+
+def subscription_handler(sub_id, service, decimation, binary, end_event, global_end_event):
+  sock = messaging.sub_sock(service, timeout=100)
+  count = 0
+  try:
+    while not (end_event.is_set() or global_end_event.is_set()):
+      dat = sock.receive()
+      if dat is None:
+        continue
+      count += 1
+      if count % decimation != 0:
+        continue
+
+      if binary:
+        send_binary(dat)
+      else:
+        send_response(json.dumps({
+          "jsonrpc": "2.0",
+          "method": "subscription",
+          "params": {"id": sub_id, "service": service, "message": log.Event.from_bytes(dat).to_dict()},
+        }, default=str))
+  except Exception:
+    cloudlog.exception("athenad.subscription_handler.exception")
+  finally:
+    with subscriptions_lock:
+      subscriptions.pop(sub_id, None)
+
+
+def subscribe(global_end_event, service=None, decimation=1, binary=False):
+  """Streams every decimation-th message of service over the websocket until unsubscribed
+  or disconnected. Binary subscriptions send the raw capnp Event, others a JSON-RPC notification.
+  Binary frames don't carry the subscription id, so only one binary subscription is allowed."""
+  if service is None or service not in service_list:
+    raise Exception("invalid service")
+  if int(decimation) < 1:
+    raise Exception("invalid decimation")
+
+  sub_id = hashlib.sha1(f"{service}{time.time()}{random.random()}".encode()).hexdigest()
+  end_event = threading.Event()
+  with subscriptions_lock:
+    if len(subscriptions) >= MAX_SUBSCRIPTIONS:
+      raise Exception("too many subscriptions")
+    if binary and any(s.binary for s in subscriptions.values()):
+      raise Exception("only one binary subscription allowed")
+    subscriptions[sub_id] = Subscription(end_event, bool(binary))
 
-  if ret is None:
-    raise TimeoutError
+  threading.Thread(target=subscription_handler,
+                   args=(sub_id, service, int(decimation), binary, end_event, global_end_event)).start()
+  return {"success": 1, "id": sub_id}
 
-  return ret.to_dict()
+
+@dispatcher.add_method
+def unsubscribe(subscription_id):
+  with subscriptions_lock:
+    subscription = subscriptions.get(subscription_id)
+  if subscription is None:
+    return 404
+
+  subscription.end_event.set()
+  return {"success": 1}
 
 
 @dispatcher.add_method
@@ -310,10 +433,19 @@ def ws_recv(ws, end_event):
 def ws_send(ws, end_event):
   while not end_event.is_set():
     try:
-      response = response_queue.get(timeout=1)
-      ws.send(response.json)
-    except queue.Empty:
-      pass
+      # cleared before looking, a response queued after that sets it again
+      send_event.clear()
+      response = next_response()
+      if response is None:
+        send_event.wait(1)
+        continue
+
+      if isinstance(response, bytes):
+        ws.send(response, ABNF.OPCODE_BINARY)
+      elif isinstance(response, str):
+        ws.send(response)
+      else:
+        ws.send(response.json)
     except Exception:
       cloudlog.exception("athenad.ws_send.exception")
       end_event.set()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+import threading
+import time
+import unittest
+from unittest import mock
+
+import cereal.messaging as messaging
+from selfdrive.athena import athenad
+
+
+class FakeSock():
+  """A sub socket that hands out msgs, receive() without non_blocking waits for the next one."""
+  def __init__(self, msgs=()):
+    self.msgs = list(msgs)
+    self.blocking_receives = 0
+
+  def setTimeout(self, timeout):
+    pass
+
+  def receive(self, non_blocking=False):
+    if not non_blocking:
+      self.blocking_receives += 1
+    return self.msgs.pop(0) if len(self.msgs) else None
+
+
+def fake_subscription_handler(sub_id, service, decimation, binary, end_event, global_end_event):
+  end_event.wait(10)
+  with athenad.subscriptions_lock:
+    athenad.subscriptions.pop(sub_id, None)
+
+
+def thermal(log_mono_time):
+  msg = messaging.new_message('thermal')
+  msg.logMonoTime = int(log_mono_time * 1e9)
+  return msg.to_bytes()
+
+
+class TestSubscriptions(unittest.TestCase):
+  def setUp(self):
+    self.end_event = threading.Event()
+    patcher = mock.patch.object(athenad, "subscription_handler", fake_subscription_handler)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def tearDown(self):
+    for sub_id in list(athenad.subscriptions):
+      athenad.unsubscribe(sub_id)
+    self.wait_for(0)
+
+  def wait_for(self, count):
+    t = time.monotonic()
+    while len(athenad.subscriptions) != count and time.monotonic() - t < 5:
+      time.sleep(0.01)
+    self.assertEqual(len(athenad.subscriptions), count)
+
+  def subscribe(self, **kwargs):
+    return athenad.subscribe(self.end_event, "thermal", **kwargs)["id"]
+
+  def test_invalid(self):
+    with self.assertRaises(Exception):
+      athenad.subscribe(self.end_event, "notaservice")
+    with self.assertRaises(Exception):
+      athenad.subscribe(self.end_event, "thermal", decimation=0)
+    self.assertEqual(athenad.unsubscribe("notasubscription"), 404)
+    self.assertEqual(len(athenad.subscriptions), 0)
+
+  def test_max_subscriptions(self):
+    sub_ids = [self.subscribe() for _ in range(athenad.MAX_SUBSCRIPTIONS)]
+    with self.assertRaises(Exception):
+      self.subscribe()
+
+    # a slot frees up once the subscription's thread is done
+    self.assertEqual(athenad.unsubscribe(sub_ids[0]), {"success": 1})
+    self.wait_for(athenad.MAX_SUBSCRIPTIONS - 1)
+    self.subscribe()
+
+  def test_one_binary(self):
+    sub_id = self.subscribe(binary=True)
+    with self.assertRaises(Exception):
+      self.subscribe(binary=True)
+    self.subscribe()
+
+    athenad.unsubscribe(sub_id)
+    self.wait_for(1)
+    self.subscribe(binary=True)
+
+
+class TestBinaryQueue(unittest.TestCase):
+  def setUp(self):
+    athenad.binary_queue.clear()
+
+  def tearDown(self):
+    athenad.binary_queue.clear()
+    while athenad.next_response() is not None:
+      pass
+
+  def test_drop_oldest(self):
+    msgs = [b"%d" % i for i in range(athenad.BINARY_QUEUE_SIZE + 10)]
+    sock = FakeSock(msgs)
+    end_event = threading.Event()
+
+    def receive(non_blocking=False):
+      if not len(sock.msgs):
+        end_event.set()
+      return FakeSock.receive(sock, non_blocking)
+    sock.receive = receive
+
+    athenad.subscriptions["sub"] = athenad.Subscription(end_event, True)
+    with mock.patch.object(messaging, "sub_sock", return_value=sock):
+      athenad.subscription_handler("sub", "thermal", 1, True, end_event, threading.Event())
+    self.assertNotIn("sub", athenad.subscriptions)
+
+    # responses aren't held up or dropped by binary messages
+    athenad.send_response("response")
+    sent = []
+    while True:
+      response = athenad.next_response()
+      if response is None:
+        break
+      sent.append(response)
+    self.assertEqual(sent, ["response"] + msgs[-athenad.BINARY_QUEUE_SIZE:])
+
+
+class TestCachedSubscriber(unittest.TestCase):
+  def subscriber(self, sock):
+    with mock.patch.object(messaging, "sub_sock", return_value=sock):
+      return athenad.CachedSubscriber("thermal")
+
+  def test_max_age(self):
+    sock = FakeSock([thermal(100.)])
+    sub = self.subscriber(sock)
+    self.assertEqual(sub.max_age, 0.5)
+
+    with mock.patch.object(athenad, "sec_since_boot", return_value=100.1):
+      self.assertEqual(sub.get(1000)["logMonoTime"], int(100e9))
+      self.assertEqual(sock.blocking_receives, 0)
+      # less than a period old, no need to wait for the next one
+      self.assertEqual(sub.get(1000)["logMonoTime"], int(100e9))
+      self.assertEqual(sock.blocking_receives, 0)
+
+    with mock.patch.object(athenad, "sec_since_boot", return_value=101.):
+      sock.msgs.append(thermal(100.9))
+      self.assertEqual(sub.get(1000)["logMonoTime"], int(100.9e9))
+      self.assertEqual(sock.blocking_receives, 0)
+
+    with mock.patch.object(athenad, "sec_since_boot", return_value=102.):
+      # stale, waits for the next one and times out without one
+      with self.assertRaises(TimeoutError):
+        sub.get(1000)
+      self.assertEqual(sock.blocking_receives, 1)
+
+  def test_no_message(self):
+    sub = self.subscriber(FakeSock())
+    with self.assertRaises(TimeoutError):
+      sub.get(1000)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -1,13 +1,14 @@
 import os
+from functools import lru_cache
 from common.params import Params
-from common.basedir import BASEDIR
 from selfdrive.version import comma_remote, tested_branch
-from selfdrive.car.fingerprints import eliminate_incompatible_cars, all_known_cars
+from selfdrive.car.fingerprints import ALL_CARS_MASK, all_known_cars, cars_to_mask, mask_to_cars, compatible_cars_mask
 from selfdrive.car.vin import get_vin, VIN_UNKNOWN
 from selfdrive.car.fw_versions import get_fw_versions, match_fw_to_car
 from selfdrive.swaglog import cloudlog
 import cereal.messaging as messaging
 from selfdrive.car import gen_empty_fingerprint
+from selfdrive.car.car_registry import get_registry
 
 from cereal import car, log
 EventName = car.CarEvent.EventName
@@ -32,51 +33,35 @@ def get_startup_event(car_recognized, controller_available):
   return event
 
 
-def load_interfaces(brand_names):
-  ret = {}
-  for brand_name in brand_names:
-    path = ('selfdrive.car.%s' % brand_name)
-    CarInterface = __import__(path + '.interface', fromlist=['CarInterface']).CarInterface
+@lru_cache(maxsize=None)
+def load_interface(brand_name):
+  # imports from directory selfdrive/car/<name>/, only for the brand that's used
+  modules = get_registry()['brands'][brand_name]
+  CarInterface = __import__(modules['interface'], fromlist=['CarInterface']).CarInterface
 
-    if os.path.exists(BASEDIR + '/' + path.replace('.', '/') + '/carstate.py'):
-      CarState = __import__(path + '.carstate', fromlist=['CarState']).CarState
-    else:
-      CarState = None
-
-    if os.path.exists(BASEDIR + '/' + path.replace('.', '/') + '/carcontroller.py'):
-      CarController = __import__(path + '.carcontroller', fromlist=['CarController']).CarController
-    else:
-      CarController = None
+  if modules['carstate'] is not None:
+    CarState = __import__(modules['carstate'], fromlist=['CarState']).CarState
+  else:
+    CarState = None
 
-    for model_name in brand_names[brand_name]:
-      ret[model_name] = (CarInterface, CarController, CarState)
-  return ret
+  if modules['carcontroller'] is not None:
+    CarController = __import__(modules['carcontroller'], fromlist=['CarController']).CarController
+  else:
+    CarController = None
 
+  return CarInterface, CarController, CarState
 
-def _get_interface_names():
-  # read all the folders in selfdrive/car and return a dict where:
-  # - keys are all the car names that which we have an interface for
-  # - values are lists of spefic car models for a given car
-  brand_names = {}
-  for car_folder in [x[0] for x in os.walk(BASEDIR + '/selfdrive/car')]:
-    try:
-      brand_name = car_folder.split('/')[-1]
-      model_names = __import__('selfdrive.car.%s.values' % brand_name, fromlist=['CAR']).CAR
-      model_names = [getattr(model_names, c) for c in model_names.__dict__.keys() if not c.startswith("__")]
-      brand_names[brand_name] = model_names
-    except (ImportError, IOError):
-      pass
 
-  return brand_names
+def get_interface(model_name):
+  return load_interface(get_registry()['models'][model_name])
 
 
-# imports from directory selfdrive/car/<name>/
-interface_names = _get_interface_names()
-interfaces = load_interfaces(interface_names)
+TOYOTA_CARS_MASK = cars_to_mask(c for c in all_known_cars() if "TOYOTA" in c or "LEXUS" in c)
 
 
 def only_toyota_left(candidate_cars):
-  return all(("TOYOTA" in c or "LEXUS" in c) for c in candidate_cars) and len(candidate_cars) > 0
+  # candidate_cars is a mask of fingerprints.all_known_cars()
+  return candidate_cars != 0 and candidate_cars & ~TOYOTA_CARS_MASK == 0
 
 
 # **** for use live only ****
@@ -112,7 +97,7 @@ def fingerprint(logcan, sendcan, has_relay):
   Params().put("CarVin", vin)
 
   finger = gen_empty_fingerprint()
-  candidate_cars = {i: all_known_cars() for i in [0]}  # attempt fingerprint on bus 0 only
+  candidate_cars = {i: ALL_CARS_MASK for i in [0]}  # attempt fingerprint on bus 0 only
   frame = 0
   frame_fingerprint = 10  # 0.1s
   car_fingerprint = None
@@ -129,10 +114,10 @@ def fingerprint(logcan, sendcan, has_relay):
       # (ideally should be done for all cars but we can't for Honda Bosch)
       if can.src in range(0, 4):
         finger[can.src][can.address] = len(can.dat)
-      for b in candidate_cars:
-        if (can.src == b or (only_toyota_left(candidate_cars[b]) and can.src == 2)) and \
-           can.address < 0x800 and can.address not in [0x7df, 0x7e0, 0x7e8]:
-          candidate_cars[b] = eliminate_incompatible_cars(can, candidate_cars[b])
+      if can.address < 0x800 and can.address not in [0x7df, 0x7e0, 0x7e8]:
+        for b in candidate_cars:
+          if can.src == b or (can.src == 2 and only_toyota_left(candidate_cars[b])):
+            candidate_cars[b] &= compatible_cars_mask(can.address, len(can.dat))
 
     # if we only have one car choice and the time since we got our first
     # message has elapsed, exit
@@ -140,13 +125,13 @@ def fingerprint(logcan, sendcan, has_relay):
       # Toyota needs higher time to fingerprint, since DSU does not broadcast immediately
       if only_toyota_left(candidate_cars[b]):
         frame_fingerprint = 100  # 1s
-      if len(candidate_cars[b]) == 1:
+      if candidate_cars[b] != 0 and candidate_cars[b] & (candidate_cars[b] - 1) == 0:
         if frame > frame_fingerprint:
           # fingerprint done
-          car_fingerprint = candidate_cars[b][0]
+          car_fingerprint = mask_to_cars(candidate_cars[b])[0]
 
     # bail if no cars left or we've been waiting for more than 2s
-    failed = all(len(cc) == 0 for cc in candidate_cars.values()) or frame > 200
+    failed = all(cc == 0 for cc in candidate_cars.values()) or frame > 200
     succeeded = car_fingerprint is not None
     done = failed or succeeded
 
@@ -174,7 +159,7 @@ def get_car(logcan, sendcan, has_relay=False):
     cloudlog.warning("car doesn't match any fingerprints: %r", fingerprints)
     candidate = "mock"
 
-  CarInterface, CarController, CarState = interfaces[candidate]
+  CarInterface, CarController, CarState = get_interface(candidate)
   car_params = CarInterface.get_params(candidate, fingerprints, has_relay, car_fw)
   car_params.carVin = vin
   car_params.carFw = car_fw
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Registry of the car brands in selfdrive/car: the models of each brand, read from the CAR class of
+its values.py without importing it, and the modules of its interface. It's generated at build time
+into car_registry.json, along with the hash of the sources it was generated from, so picking a
+car's interface doesn't walk selfdrive/car or import every brand. A missing or stale registry is
+regenerated on load."""
+import ast
+import hashlib
+import json
+import os
+import sys
+from functools import lru_cache
+
+from common.basedir import BASEDIR
+
+CAR_DIR = os.path.join(BASEDIR, 'selfdrive/car')
+REGISTRY_PATH = os.path.join(CAR_DIR, 'car_registry.json')
+INTERFACE_MODULES = ['interface', 'carstate', 'carcontroller']
+
+
+def _brand_names():
+  return sorted(e.name for e in os.scandir(CAR_DIR) if e.is_dir() and os.path.isfile(os.path.join(e.path, 'values.py')))
+
+
+def source_hash(brand_names=None):
+  """Hash of the values.py of every brand and of which of its interface modules exist."""
+  h = hashlib.sha1()
+  for brand_name in brand_names if brand_names is not None else _brand_names():
+    brand_dir = os.path.join(CAR_DIR, brand_name)
+    h.update(brand_name.encode() + b'\0')
+    for module in INTERFACE_MODULES:
+      h.update(b'1' if os.path.isfile(os.path.join(brand_dir, module + '.py')) else b'0')
+    with open(os.path.join(brand_dir, 'values.py'), 'rb') as f:
+      h.update(f.read())
+  return h.hexdigest()
+
+
+def _model_names(values_path):
+  with open(values_path) as f:
+    tree = ast.parse(f.read(), values_path)
+
+  models = []
+  for node in tree.body:
+    if isinstance(node, ast.ClassDef) and node.name == 'CAR':
+      for stmt in node.body:
+        if isinstance(stmt, ast.Assign) and isinstance(stmt.value, ast.Constant) and isinstance(stmt.value.value, str):
+          models.append(stmt.value.value)
+  return models
+
+
+def build_registry():
+  brand_names = _brand_names()
+  registry = {'hash': source_hash(brand_names), 'brands': {}, 'models': {}}
+  for brand_name in brand_names:
+    brand_dir = os.path.join(CAR_DIR, brand_name)
+    registry['brands'][brand_name] = {m: 'selfdrive.car.%s.%s' % (brand_name, m) if os.path.isfile(os.path.join(brand_dir, m + '.py')) else None
+                                      for m in INTERFACE_MODULES}
+    for model_name in _model_names(os.path.join(brand_dir, 'values.py')):
+      registry['models'][model_name] = brand_name
+  return registry
+
+
+def load_registry(path=REGISTRY_PATH):
+  try:
+    with open(path) as f:
+      registry = json.load(f)
+  except (OSError, ValueError):
+    registry = None
+
+  if registry is None or registry.get('hash') != source_hash():
+    from selfdrive.swaglog import cloudlog
+    cloudlog.warning("car registry %s missing or stale, regenerating", path)
+    registry = build_registry()
+  return registry
+
+
+@lru_cache(maxsize=None)
+def get_registry():
+  return load_registry()
+
+
+def write_registry(path=REGISTRY_PATH):
+  registry = build_registry()
+  with open(path, 'w') as f:
+    json.dump(registry, f, indent=2, sort_keys=True)
+  return registry
+
+
+if __name__ == "__main__":
+  write_registry(sys.argv[1] if len(sys.argv) > 1 else REGISTRY_PATH)
@@ -1,16 +1,14 @@
-import os
-from common.basedir import BASEDIR
+from selfdrive.car.car_registry import get_registry
 
 
 def get_attr_from_cars(attr, result=dict, combine_brands=True):
-  # read all the folders in selfdrive/car and return a dict where:
+  # read the values of all the brands in the car registry and return a dict where:
   # - keys are all the car models
   # - values are attr values from all car folders
   result = result()
 
-  for car_folder in [x[0] for x in os.walk(BASEDIR + '/selfdrive/car')]:
+  for car_name in get_registry()['brands']:
     try:
-      car_name = car_folder.split('/')[-1]
       values = __import__('selfdrive.car.%s.values' % car_name, fromlist=[attr])
       if hasattr(values, attr):
         attr_values = getattr(values, attr)
@@ -40,12 +38,77 @@ IGNORED_FINGERPRINTS = get_attr_from_cars('IGNORED_FINGERPRINTS', list)
 
 _DEBUG_ADDRESS = {1880: 8}   # reserved for debug purposes
 
+# bit i of a candidate mask is the i-th car of all_known_cars()
+_CARS = list(_FINGERPRINTS.keys())
+_CAR_BITS = {car_name: 1 << i for i, car_name in enumerate(_CARS)}
+ALL_CARS_MASK = sum(bit for car_name, bit in _CAR_BITS.items() if car_name not in IGNORED_FINGERPRINTS)
+
+
+def _build_fingerprint_index():
+  # (address, length) -> mask of the cars with a fingerprint containing it
+  index = {}
+  for car_name, bit in _CAR_BITS.items():
+    if car_name in IGNORED_FINGERPRINTS:
+      continue
+
+    for fingerprint in _FINGERPRINTS[car_name]:
+      for adr_len in list(fingerprint.items()) + list(_DEBUG_ADDRESS.items()):  # add alien debug address
+        index[adr_len] = index.get(adr_len, 0) | bit
+  return index
+
+
+_FINGERPRINT_INDEX = _build_fingerprint_index()
+
+
 def is_valid_for_fingerprint(msg, car_fingerprint):
   adr = msg.address
   # ignore addresses that are more than 11 bits
   return (adr in car_fingerprint and car_fingerprint[adr] == len(msg.dat)) or adr >= 0x800
 
 
+def compatible_cars_mask(address, length):
+  """Returns the mask of cars that could have sent a message with this address and length."""
+  # ignore addresses that are more than 11 bits
+  if address >= 0x800:
+    return ALL_CARS_MASK
+  return _FINGERPRINT_INDEX.get((address, length), 0)
+
+
+def cars_to_mask(cars):
+  mask = 0
+  for car_name in cars:
+    mask |= _CAR_BITS.get(car_name, 0)
+  return mask
+
+
+def mask_to_cars(mask):
+  """Returns the cars in mask, in the order of all_known_cars()."""
+  cars = []
+  while mask:
+    bit = mask & -mask
+    cars.append(_CARS[bit.bit_length() - 1])
+    mask ^= bit
+  return cars
+
+
+def eliminate_incompatible_cars_mask(msgs, mask):
+  """Removes cars that could not have sent all of msgs.
+
+     Inputs:
+      msgs: An iterable of (address, length) pairs of messages from the car.
+      mask: A mask of cars to consider.
+
+     Returns:
+      The mask of the subset of cars that could have sent msgs.
+  """
+  for address, length in msgs:
+    if not mask:
+      break
+    if address < 0x800:
+      mask &= _FINGERPRINT_INDEX.get((address, length), 0)
+  return mask & ALL_CARS_MASK
+
+
 def eliminate_incompatible_cars(msg, candidate_cars):
   """Removes cars that could not have sent msg.
 
@@ -56,22 +119,8 @@ def eliminate_incompatible_cars(msg, candidate_cars):
      Returns:
       A list containing the subset of candidate_cars that could have sent msg.
   """
-  compatible_cars = []
-
-  for car_name in candidate_cars:
-    if car_name in IGNORED_FINGERPRINTS:
-      continue
-
-    car_fingerprints = _FINGERPRINTS[car_name]
-
-    for fingerprint in car_fingerprints:
-      fingerprint.update(_DEBUG_ADDRESS)  # add alien debug address
-
-      if is_valid_for_fingerprint(msg, fingerprint):
-        compatible_cars.append(car_name)
-        break
-
-  return compatible_cars
+  mask = compatible_cars_mask(msg.address, len(msg.dat))
+  return [car_name for car_name in candidate_cars if _CAR_BITS.get(car_name, 0) & mask]
 
 
 def all_known_cars():
@@ -108,41 +108,74 @@ def chunks(l, n=128):
     yield l[i:i + n]
 
 
-def match_fw_to_car(fw_versions):
-  candidates = FW_VERSIONS
-  invalid = []
+ESSENTIAL_ECUS = [Ecu.engine, Ecu.eps, Ecu.esp, Ecu.fwdRadar, Ecu.fwdCamera, Ecu.vsa, Ecu.electricBrakeBooster]
+
+
+def is_required_ecu(ecu_type, candidate):
+  """Whether candidate can't match without a response from this ECU."""
+  if ecu_type == Ecu.esp and candidate in [TOYOTA.RAV4, TOYOTA.COROLLA, TOYOTA.HIGHLANDER]:
+    return False
+
+  # TODO: COROLLA_TSS2 engine can show on two different addresses
+  if ecu_type == Ecu.engine and candidate in [TOYOTA.COROLLA_TSS2, TOYOTA.CHR]:
+    return False
+
+  # ignore non essential ecus
+  return ecu_type in ESSENTIAL_ECUS
+
+
+class FwDatabase():
+  """FW versions of all cars compiled into masks of candidates, bit i is the i-th car."""
+  def __init__(self, fw_versions):
+    self.cars = list(fw_versions.keys())
+    self.all_cars = (1 << len(self.cars)) - 1
+    self.ecu_masks = {}  # (addr, sub_addr) -> cars that expect a version from this ECU
+    self.required_masks = {}  # (addr, sub_addr) -> cars that don't match without it
+    self.version_masks = {}  # (addr, sub_addr, version) -> cars that expect this version
+
+    for i, (candidate, fws) in enumerate(fw_versions.items()):
+      bit = 1 << i
+      expected = {}
+      for (ecu_type, addr, sub_addr), versions in fws.items():
+        a = (addr, sub_addr)
+        expected[a] = expected[a] & set(versions) if a in expected else set(versions)
+        self.ecu_masks[a] = self.ecu_masks.get(a, 0) | bit
+        if is_required_ecu(ecu_type, candidate):
+          self.required_masks[a] = self.required_masks.get(a, 0) | bit
 
+      for a, versions in expected.items():
+        for version in versions:
+          self.version_masks[a + (version,)] = self.version_masks.get(a + (version,), 0) | bit
+
+  def match(self, fw_versions_dict):
+    """Returns the cars matching a dict of (addr, sub_addr) to the version found."""
+    candidates = self.all_cars
+    for a, ecu_mask in self.ecu_masks.items():
+      version = fw_versions_dict.get(a, None)
+      if version is None:
+        candidates &= ~self.required_masks.get(a, 0)
+      else:
+        candidates &= ~ecu_mask | self.version_masks.get(a + (version,), 0)
+
+    return {car_name for i, car_name in enumerate(self.cars) if candidates >> i & 1}
+
+
+FW_DATABASE = FwDatabase(FW_VERSIONS)
+
+
+def match_fw_to_car(fw_versions):
   fw_versions_dict = {}
   for fw in fw_versions:
     addr = fw.address
     sub_addr = fw.subAddress if fw.subAddress != 0 else None
     fw_versions_dict[(addr, sub_addr)] = fw.fwVersion
 
-  for candidate, fws in candidates.items():
-    for ecu, expected_versions in fws.items():
-      ecu_type = ecu[0]
-      addr = ecu[1:]
-      found_version = fw_versions_dict.get(addr, None)
-      ESSENTIAL_ECUS = [Ecu.engine, Ecu.eps, Ecu.esp, Ecu.fwdRadar, Ecu.fwdCamera, Ecu.vsa, Ecu.electricBrakeBooster]
-      if ecu_type == Ecu.esp and candidate in [TOYOTA.RAV4, TOYOTA.COROLLA, TOYOTA.HIGHLANDER] and found_version is None:
-        continue
+  return FW_DATABASE.match(fw_versions_dict)
 
-      # TODO: COROLLA_TSS2 engine can show on two different addresses
-      if ecu_type == Ecu.engine and candidate in [TOYOTA.COROLLA_TSS2, TOYOTA.CHR] and found_version is None:
-        continue
 
-      # ignore non essential ecus
-      if ecu_type not in ESSENTIAL_ECUS and found_version is None:
-        continue
-
-      if found_version not in expected_versions:
-        invalid.append(candidate)
-        break
-
-  return set(candidates.keys()) - set(invalid)
-
-
-def get_fw_versions(logcan, sendcan, bus, extra=None, timeout=0.1, debug=False, progress=False):
+def build_query_plan(versions):
+  """Given {brand: {car: {(ecu, addr, sub_addr): [versions]}}}, returns the ECU type of every
+  address and the (request, response, addrs, first) queries that get_fw_versions sends, in order."""
   ecu_types = {}
 
   # Extract ECU adresses to query from fingerprints
@@ -150,16 +183,11 @@ def get_fw_versions(logcan, sendcan, bus, extra=None, timeout=0.1, debug=False,
   addrs = []
   parallel_addrs = []
 
-  versions = get_attr_from_cars('FW_VERSIONS', combine_brands=False)
-  if extra is not None:
-    versions.update(extra)
-
   for brand, brand_versions in versions.items():
     for c in brand_versions.values():
       for ecu_type, addr, sub_addr in c.keys():
         a = (brand, addr, sub_addr)
-        if a not in ecu_types:
-          ecu_types[(addr, sub_addr)] = ecu_type
+        ecu_types[(addr, sub_addr)] = ecu_type
 
         if sub_addr is None:
           if a not in parallel_addrs:
@@ -170,19 +198,43 @@ def get_fw_versions(logcan, sendcan, bus, extra=None, timeout=0.1, debug=False,
 
   addrs.insert(0, parallel_addrs)
 
-  fw_versions = {}
-  for i, addr in enumerate(tqdm(addrs, disable=not progress)):
+  queries = []
+  for i, addr in enumerate(addrs):
     for addr_chunk in chunks(addr):
       for brand, request, response in REQUESTS:
-        try:
-          addrs = [(a, s) for (b, a, s) in addr_chunk if b in (brand, 'any')]
-
-          if addrs:
-            query = IsoTpParallelQuery(sendcan, logcan, bus, addrs, request, response, debug=debug)
-            t = 2 * timeout if i == 0 else timeout
-            fw_versions.update(query.get_data(t))
-        except Exception:
-          cloudlog.warning(f"FW query exception: {traceback.format_exc()}")
+        query_addrs = [(a, s) for (b, a, s) in addr_chunk if b in (brand, 'any')]
+        if query_addrs:
+          queries.append((request, response, query_addrs, i == 0))
+
+  return ecu_types, queries
+
+
+_query_plan = None
+
+
+def get_fw_versions(logcan, sendcan, bus, extra=None, timeout=0.1, debug=False, progress=False):
+  global _query_plan
+
+  if extra is None:
+    if _query_plan is None:
+      _query_plan = build_query_plan(get_attr_from_cars('FW_VERSIONS', combine_brands=False))
+    ecu_types, queries = _query_plan
+  else:
+    versions = get_attr_from_cars('FW_VERSIONS', combine_brands=False)
+    versions.update(extra)
+    ecu_types, queries = build_query_plan(versions)
+
+  # All queries run at once, except those to the same ECU which are sent one after the other
+  query = IsoTpParallelQuery(sendcan, logcan, bus, [], None, None, debug=debug)
+  for request, response, addrs, first in queries:
+    query.add_query(addrs, request, response, 2 * timeout if first else timeout)
+
+  try:
+    with tqdm(total=query.num_steps, disable=not progress) as pbar:
+      query.get_data(timeout, step_callback=pbar.update)
+  except Exception:
+    cloudlog.warning(f"FW query exception: {traceback.format_exc()}")
+  fw_versions = query.results
 
   # Build capnp list to put into CarParams
   car_fw = []
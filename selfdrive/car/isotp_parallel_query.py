@@ -1,129 +1,313 @@
+import math
 import time
-from collections import defaultdict
-from functools import partial
+from collections import deque
 
 import cereal.messaging as messaging
 from selfdrive.swaglog import cloudlog
 from selfdrive.boardd.boardd import can_list_to_can_capnp
-from panda.python.uds import CanClient, IsoTpMessage, FUNCTIONAL_ADDRS, get_rx_addr_for_tx_addr
+from panda.python.uds import FUNCTIONAL_ADDRS, get_rx_addr_for_tx_addr
 
 
-class IsoTpParallelQuery():
-  def __init__(self, sendcan, logcan, bus, addrs, request, response, functional_addr=False, debug=False):
-    self.sendcan = sendcan
-    self.logcan = logcan
+def isotp_separation_time(st_min):
+  """STmin byte of a flow control frame in seconds."""
+  if st_min <= 0x7F:
+    return st_min / 1000.
+  if 0xF1 <= st_min <= 0xF9:
+    return (st_min - 0xF0) / 10000.
+  # reserved values mean the longest time
+  return 0.127
+
+
+def is_functional_response(functional_addr, addr):
+  if functional_addr == 0x7DF:
+    return 0x7E8 <= addr <= 0x7EF
+  return 0x18DAF100 <= addr <= 0x18DAF1FF
+
+
+class IsoTpSession():
+  """All the queries to one ECU tx address, sent one after the other. The ISO-TP transfers are
+  driven by the frames received for the ECU and by time, nothing blocks."""
+  def __init__(self, query, tx_addr, bus, functional_addr=False, debug=False):
+    self.query = query
+    self.addr = tx_addr
     self.bus = bus
-    self.request = request
-    self.response = response
     self.debug = debug
-    self.functional_addr = functional_addr
+    self.functional = functional_addr and tx_addr in FUNCTIONAL_ADDRS
+    self.steps = deque()
 
-    self.real_addrs = []
-    for a in addrs:
-      if isinstance(a, tuple):
-        self.real_addrs.append(a)
-      else:
-        self.real_addrs.append((a, None))
+    self.step = None
+    self.sub_addr = None
+    self.tx_addr = tx_addr
+    self.rx_addr = get_rx_addr_for_tx_addr(tx_addr)
+    self.tx_queue = deque()
+    self.tx_next = math.inf
+    self.tx_last = -math.inf
+    self.deadline = math.inf
 
-    self.msg_addrs = {tx_addr: get_rx_addr_for_tx_addr(tx_addr[0]) for tx_addr in self.real_addrs}
-    self.msg_buffer = defaultdict(list)
+  def add_step(self, sub_addr, request, response, timeout):
+    self.steps.append((sub_addr, request, response, timeout))
 
-  def rx(self):
-    """Drain can socket and sort messages into buffers based on address"""
-    can_packets = messaging.drain_sock(self.logcan, wait_for_one=True)
+  @property
+  def done(self):
+    return self.step is None and len(self.steps) == 0
 
-    for packet in can_packets:
-      for msg in packet.can:
-        if msg.src == self.bus:
-          if self.functional_addr:
-            if (0x7E8 <= msg.address <= 0x7EF) or (0x18DAF100 <= msg.address <= 0x18DAF1FF):
-              fn_addr = next(a for a in FUNCTIONAL_ADDRS if msg.address - a <= 32)
-              self.msg_buffer[fn_addr].append((msg.address, msg.busTime, msg.dat, msg.src))
-          elif msg.address in self.msg_addrs.values():
-            self.msg_buffer[msg.address].append((msg.address, msg.busTime, msg.dat, msg.src))
-
-  def _can_tx(self, tx_addr, dat, bus):
-    """Helper function to send single message"""
-    msg = [tx_addr, 0, dat, bus]
-    self.sendcan.send(can_list_to_can_capnp([msg], msgtype='sendcan'))
-
-  def _can_rx(self, addr, sub_addr=None):
-    """Helper function to retrieve message with specified address and subadress from buffer"""
-    keep_msgs = []
-
-    if sub_addr is None:
-      msgs = self.msg_buffer[addr]
+  def next_step(self, now):
+    if self.step is not None:
+      self.query.step_done()
+    self.step = None
+    self.deadline = math.inf
+    if len(self.steps) == 0:
+      return
+
+    self.step = self.steps.popleft()
+    self.sub_addr, self.request, self.response, timeout = self.step
+    self.max_len = 8 if self.sub_addr is None else 7
+    self.counter = 0
+    self.deadline = now + timeout
+
+    # functional requests switch to the first ECU to respond
+    self.tx_addr = self.addr
+    self.rx_addr = get_rx_addr_for_tx_addr(self.addr)
+    self.send(self.request[0], now)
+
+  def accepts(self, addr, dat):
+    if self.step is None or len(dat) == 0:
+      return False
+    if self.functional and self.rx_addr is None:
+      if not is_functional_response(self.addr, addr):
+        return False
+      self.tx_addr = addr - 8 if self.addr == 0x7DF else 0x18DA00F1 + (addr << 8 & 0xFF00)
+      self.rx_addr = addr
+      if self.debug:
+        print(f"switch to physical addr {hex(addr)}")
+    return addr == self.rx_addr and (self.sub_addr is None or dat[0] == self.sub_addr)
+
+  def _tx(self, dat):
+    if self.sub_addr is not None:
+      dat = bytes([self.sub_addr]) + dat
+    if self.debug:
+      print(f"CAN-TX: {hex(self.tx_addr)} - 0x{bytes.hex(dat)}")
+    self.query.tx_frames.append([self.tx_addr, 0, dat, self.bus])
+
+  def send(self, dat, now):
+    if self.debug:
+      print(f"ISO-TP: REQUEST - 0x{bytes.hex(dat)}")
+    self.tx_dat = dat
+    self.tx_idx = 0
+    self.tx_queue = deque()
+    self.tx_block = 0  # frames left before waiting for flow control again, 0 is unlimited
+    self.tx_sep = 0.
+    self.tx_next = math.inf  # time of the next consecutive frame, inf while waiting for flow control
+
+    self.rx_dat = b""
+    self.rx_len = 0
+    self.rx_idx = 0
+
+    if len(dat) < self.max_len:
+      # single frame (send all bytes)
+      self._tx((bytes([len(dat)]) + dat).ljust(self.max_len, b"\x00"))
     else:
-      # Filter based on subadress
-      msgs = []
-      for m in self.msg_buffer[addr]:
-        first_byte = m[2][0]
-        if first_byte == sub_addr:
-          msgs.append(m)
-        else:
-          keep_msgs.append(m)
+      # first frame, the rest as consecutive frames after the flow control
+      num_bytes = self.max_len - 1
+      self._tx(bytes([0x10 | (len(dat) >> 8 & 0xF), len(dat) & 0xFF]) + dat[:self.max_len - 2])
+      for i in range(self.max_len - 2, len(dat), num_bytes):
+        self.tx_idx += 1
+        self.tx_queue.append((bytes([0x20 | (self.tx_idx & 0xF)]) + dat[i:i + num_bytes]).ljust(self.max_len, b"\x00"))
 
-    self.msg_buffer[addr] = keep_msgs
-    return msgs
+  def update(self, now):
+    """Sends the consecutive frames that are due and times out the current step."""
+    while len(self.tx_queue) and self.tx_next <= now:
+      self._tx(self.tx_queue.popleft())
+      self.tx_last = now
+      self.tx_next = now + self.tx_sep
+      if self.tx_block > 0:
+        self.tx_block -= 1
+        if self.tx_block == 0:
+          self.tx_next = math.inf
 
-  def _drain_rx(self):
-    messaging.drain_sock(self.logcan)
-    self.msg_buffer = defaultdict(list)
+    if self.step is not None and now > self.deadline:
+      if self.debug:
+        print(f"ISO-TP: TIMEOUT - {hex(self.addr)} {self.sub_addr}")
+      self.next_step(now)
 
-  def get_data(self, timeout):
-    self._drain_rx()
+  def next_event(self):
+    if len(self.tx_queue):
+      return min(self.tx_next, self.deadline)
+    return self.deadline
 
-    # Create message objects
-    msgs = {}
-    request_counter = {}
-    request_done = {}
-    for tx_addr, rx_addr in self.msg_addrs.items():
-      # rx_addr not set when using functional tx addr
-      id_addr = rx_addr or tx_addr[0]
-      sub_addr = tx_addr[1]
+  def rx(self, dat, now):
+    if self.sub_addr is not None:
+      # cut off sub addr in first byte
+      dat = dat[1:]
+    if len(dat) == 0:
+      return
 
-      can_client = CanClient(self._can_tx, partial(self._can_rx, id_addr, sub_addr=sub_addr), tx_addr[0], rx_addr,
-                             self.bus, sub_addr=sub_addr, debug=self.debug)
+    try:
+      response = self._isotp_rx_next(dat, now)
+    except (ValueError, IndexError) as e:
+      cloudlog.warning(f"iso-tp query {hex(self.addr)} error: {e!r}")
+      self.next_step(now)
+      return
 
-      max_len = 8 if sub_addr is None else 7
+    if response is None:
+      return
 
-      msg = IsoTpMessage(can_client, timeout=0, max_len=max_len, debug=self.debug)
-      msg.send(self.request[0])
+    if self.debug:
+      print(f"ISO-TP: RESPONSE - 0x{bytes.hex(response)}")
+    expected_response = self.response[self.counter]
+    if response[:len(expected_response)] != expected_response:
+      cloudlog.warning(f"iso-tp query bad response: 0x{bytes.hex(response)}")
+      self.next_step(now)
+    elif self.counter + 1 < len(self.request):
+      self.counter += 1
+      self.send(self.request[self.counter], now)
+    else:
+      self.query.results[(self.addr, self.sub_addr)] = response[len(expected_response):]
+      self.next_step(now)
 
-      msgs[tx_addr] = msg
-      request_counter[tx_addr] = 0
-      request_done[tx_addr] = False
+  def _isotp_rx_next(self, rx_data, now):
+    """Returns the response once it's complete."""
+    frame_type = rx_data[0] >> 4
 
-    results = {}
-    start_time = time.time()
-    while True:
-      self.rx()
+    # single rx_frame
+    if frame_type == 0x0:
+      return rx_data[1:1 + (rx_data[0] & 0xF)]
 
-      if all(request_done.values()):
-        break
+    # first rx_frame
+    if frame_type == 0x1:
+      self.rx_len = ((rx_data[0] & 0x0F) << 8) + rx_data[1]
+      self.rx_dat = rx_data[2:]
+      self.rx_idx = 0
+      # send flow control message (send all bytes)
+      self._tx(b"\x30\x00\x00".ljust(self.max_len, b"\x00"))
+      return None
+
+    # consecutive rx frame
+    if frame_type == 0x2:
+      if self.rx_len == 0:
+        raise ValueError("consecutive frame with no active frame")
+      self.rx_idx += 1
+      if self.rx_idx & 0xF != rx_data[0] & 0xF:
+        raise ValueError("invalid consecutive frame index")
+      self.rx_dat += rx_data[1:1 + self.rx_len - len(self.rx_dat)]
+      if len(self.rx_dat) == self.rx_len:
+        self.rx_len = 0
+        return self.rx_dat
+      return None
+
+    # flow control
+    if frame_type == 0x3:
+      if len(self.tx_queue) == 0:
+        raise ValueError("flow control with no active frame")
+      if rx_data[0] == 0x30:
+        self.tx_block = rx_data[1]
+        self.tx_sep = isotp_separation_time(rx_data[2])
+        # the separation time also applies across blocks
+        self.tx_next = max(now, self.tx_last + self.tx_sep)
+        self.update(now)
+      elif rx_data[0] == 0x32:
+        raise ValueError("flow-control overflow/abort")
+      elif rx_data[0] != 0x31:
+        raise ValueError("flow-control transfer state indicator invalid")
+      # 0x31 is wait, do nothing until next flow control message
+      return None
+
+    return None
 
-      for tx_addr, msg in msgs.items():
-        dat = msg.recv()
 
-        if not dat:
+class IsoTpParallelQuery():
+  """Sends ISO-TP requests to many ECUs at once. More queries can be added with add_query, they
+  all run concurrently except those to the same ECU address, which run in the order they're added.
+
+  The socket is polled, get_data wakes up for received CAN, consecutive frames that are due and
+  timeouts, and returns as soon as every ECU answered or timed out."""
+  def __init__(self, sendcan, logcan, bus, addrs, request, response, functional_addr=False, debug=False, poller=None):
+    self.sendcan = sendcan
+    self.logcan = logcan
+    self.bus = bus
+    self.debug = debug
+    self.functional_addr = functional_addr
+
+    if poller is None:
+      poller = messaging.Poller()
+      poller.registerSocket(logcan)
+    self.poller = poller
+
+    self.sessions = {}
+    self.results = {}
+    self.tx_frames = []
+    self.step_callback = None
+
+    if len(addrs):
+      self.add_query(addrs, request, response)
+
+  def add_query(self, addrs, request, response, timeout=None):
+    """Queues request, the list of messages to send one after the other, for addrs. timeout
+    defaults to the one given to get_data, and counts from the query's first request."""
+    for a in addrs:
+      tx_addr, sub_addr = a if isinstance(a, tuple) else (a, None)
+      if tx_addr not in self.sessions:
+        self.sessions[tx_addr] = IsoTpSession(self, tx_addr, self.bus, self.functional_addr, self.debug)
+      self.sessions[tx_addr].add_step(sub_addr, request, response, timeout)
+
+  @property
+  def num_steps(self):
+    return sum(len(s.steps) for s in self.sessions.values())
+
+  def step_done(self):
+    if self.step_callback is not None:
+      self.step_callback(1)
+
+  def _flush_tx(self):
+    if len(self.tx_frames):
+      self.sendcan.send(can_list_to_can_capnp(self.tx_frames, msgtype='sendcan'))
+      self.tx_frames = []
+
+  def _rx(self, now, rx_sessions, functional_sessions):
+    for packet in messaging.drain_sock(self.logcan):
+      for msg in packet.can:
+        if msg.src != self.bus:
           continue
 
-        counter = request_counter[tx_addr]
-        expected_response = self.response[counter]
-        response_valid = dat[:len(expected_response)] == expected_response
-
-        if response_valid:
-          if counter + 1 < len(self.request):
-            msg.send(self.request[counter + 1])
-            request_counter[tx_addr] += 1
-          else:
-            results[tx_addr] = dat[len(expected_response):]
-            request_done[tx_addr] = True
+        session = rx_sessions.get(msg.address)
+        if session is not None:
+          if session.accepts(msg.address, msg.dat):
+            session.rx(msg.dat, now)
         else:
-          request_done[tx_addr] = True
-          cloudlog.warning(f"iso-tp query bad response: 0x{bytes.hex(dat)}")
+          for session in functional_sessions:
+            if session.accepts(msg.address, msg.dat):
+              session.rx(msg.dat, now)
+              break
+
+  def get_data(self, timeout, step_callback=None):
+    """Returns a dict of (addr, sub_addr) to the response data, of the last query answered."""
+    self.step_callback = step_callback
+    messaging.drain_sock(self.logcan)
+
+    now = time.monotonic()
+    for session in self.sessions.values():
+      session.steps = deque((sub_addr, request, response, timeout if t is None else t)
+                            for sub_addr, request, response, t in session.steps)
+      session.next_step(now)
+    self._flush_tx()
+
+    rx_sessions = {s.rx_addr: s for s in self.sessions.values() if not s.functional}
+    functional_sessions = [s for s in self.sessions.values() if s.functional]
+    while True:
+      now = time.monotonic()
+      for session in self.sessions.values():
+        session.update(now)
+      self._flush_tx()
 
-      if time.time() - start_time > timeout:
+      active = [s for s in self.sessions.values() if not s.done]
+      if len(active) == 0:
         break
 
-    return results
+      wait = min(s.next_event() for s in active) - time.monotonic()
+      if wait > 0 and len(self.poller.poll(math.ceil(wait * 1000))) == 0:
+        continue
+
+      self._rx(time.monotonic(), rx_sessions, functional_sessions)
+      self._flush_tx()
+
+    return self.results
@@ -2,7 +2,7 @@
 import unittest
 import importlib
 from selfdrive.car.fingerprints import all_known_cars
-from selfdrive.car.car_helpers import interfaces
+from selfdrive.car.car_helpers import get_interface
 from selfdrive.car.fingerprints import _FINGERPRINTS as FINGERPRINTS
 
 from cereal import car
@@ -16,7 +16,7 @@ class TestCarInterfaces(unittest.TestCase):
       print(car_name)
       fingerprint = FINGERPRINTS[car_name][0]
 
-      CarInterface, CarController, CarState = interfaces[car_name]
+      CarInterface, CarController, CarState = get_interface(car_name)
       fingerprints = {
         0: fingerprint,
         1: fingerprint,
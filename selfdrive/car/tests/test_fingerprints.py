@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import random
+import unittest
+from collections import namedtuple
+
+from selfdrive.car.fingerprints import _FINGERPRINTS, IGNORED_FINGERPRINTS, _DEBUG_ADDRESS, ALL_CARS_MASK, \
+                                       all_known_cars, cars_to_mask, compatible_cars_mask, eliminate_incompatible_cars, \
+                                       eliminate_incompatible_cars_mask, is_valid_for_fingerprint, mask_to_cars
+
+CanMsg = namedtuple('CanMsg', ['address', 'dat'])
+
+
+def eliminate_incompatible_cars_loop(msg, candidate_cars):
+  """eliminate_incompatible_cars as a loop over every fingerprint of every candidate"""
+  compatible_cars = []
+  for car_name in candidate_cars:
+    if car_name in IGNORED_FINGERPRINTS:
+      continue
+
+    for fingerprint in _FINGERPRINTS[car_name]:
+      fingerprint = dict(fingerprint)
+      fingerprint.update(_DEBUG_ADDRESS)
+      if is_valid_for_fingerprint(msg, fingerprint):
+        compatible_cars.append(car_name)
+        break
+  return compatible_cars
+
+
+class TestFingerprints(unittest.TestCase):
+  def random_msgs(self, rnd, fingerprints, count):
+    msgs = []
+    for _ in range(count):
+      r = rnd.random()
+      if r < 0.05:
+        address, length = rnd.choice([rnd.randint(0x800, 0xfff), rnd.randint(0x800, 0x1fffffff)]), rnd.randint(0, 8)
+      elif r < 0.1:
+        address, length = rnd.choice(list(_DEBUG_ADDRESS.items()))
+      else:
+        address, length = rnd.choice(list(rnd.choice(fingerprints).items()))
+        if rnd.random() < 0.05:
+          length = rnd.randint(0, 8)
+      msgs.append(CanMsg(address, b"\x00" * length))
+    return msgs
+
+  def test_matches_loop(self):
+    rnd = random.Random(0)
+    cars = all_known_cars()
+    ignored = [fp for car_name in IGNORED_FINGERPRINTS for fp in _FINGERPRINTS[car_name]]
+    self.assertGreater(len(ignored), 0)
+
+    for car_name in cars + IGNORED_FINGERPRINTS:
+      for fingerprint in _FINGERPRINTS[car_name]:
+        for _ in range(5):
+          # mostly one car's messages, some from the other cars
+          fingerprints = [fingerprint] * 10 + [rnd.choice(ignored)] + [rnd.choice(_FINGERPRINTS[rnd.choice(cars)])]
+          msgs = self.random_msgs(rnd, fingerprints, rnd.randint(1, 100))
+
+          candidates = cars
+          mask = ALL_CARS_MASK
+          for msg in msgs:
+            candidates = eliminate_incompatible_cars_loop(msg, candidates)
+            mask &= compatible_cars_mask(msg.address, len(msg.dat))
+            self.assertEqual(mask_to_cars(mask), candidates)
+
+          self.assertEqual(eliminate_incompatible_cars(msgs[-1], cars), eliminate_incompatible_cars_loop(msgs[-1], cars))
+          # also starting from a mask with the ignored cars
+          for start_mask in [ALL_CARS_MASK, cars_to_mask(cars)]:
+            batch_mask = eliminate_incompatible_cars_mask(((msg.address, len(msg.dat)) for msg in msgs), start_mask)
+            self.assertEqual(mask_to_cars(batch_mask), candidates)
+
+  def test_fingerprints(self):
+    # every car's own fingerprint leaves it as a candidate, the ignored ones never
+    for car_name, fingerprints in _FINGERPRINTS.items():
+      for fingerprint in fingerprints:
+        mask = eliminate_incompatible_cars_mask(fingerprint.items(), ALL_CARS_MASK)
+        self.assertEqual(car_name in mask_to_cars(mask), car_name not in IGNORED_FINGERPRINTS)
+
+    # extended addresses are ignored, but don't bring back the ignored cars
+    self.assertEqual(eliminate_incompatible_cars_mask([(0x800, 8)], cars_to_mask(all_known_cars())), ALL_CARS_MASK)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+import time
+import unittest
+from collections import deque
+
+import cereal.messaging as messaging
+from cereal import log
+from selfdrive.car.isotp_parallel_query import IsoTpParallelQuery
+from selfdrive.car.vin import VIN_REQUEST, VIN_RESPONSE
+from selfdrive.car.fw_versions import HYUNDAI_VERSION_REQUEST_MULTI, HYUNDAI_VERSION_RESPONSE, UDS_VERSION_REQUEST, \
+                                      UDS_VERSION_RESPONSE, SHORT_TESTER_PRESENT_REQUEST, SHORT_TESTER_PRESENT_RESPONSE, \
+                                      TOYOTA_VERSION_REQUEST, TOYOTA_VERSION_RESPONSE
+
+BUS = 1
+
+
+class SimulatedEcu():
+  """Answers ISO-TP requests with the positive response and version of a table. Multi frame
+  requests get a flow control with block size and separation time, multi frame responses wait
+  for ours."""
+  def __init__(self, can, tx_addr, rx_addr, responses, sub_addr=None, block_size=2, st_min=5):
+    self.can = can
+    self.tx_addr = tx_addr
+    self.rx_addr = rx_addr
+    self.responses = responses
+    self.sub_addr = sub_addr
+    self.max_len = 8 if sub_addr is None else 7
+    self.block_size = block_size
+    self.st_min = st_min
+    self.rx_dat = b""
+    self.rx_len = 0
+    self.rx_times = []  # of the frames of the last multi frame request
+    self.tx_frames = []
+
+  def _tx(self, dat):
+    if self.sub_addr is not None:
+      dat = bytes([self.sub_addr]) + dat
+    self.can.rx_frames.append((self.rx_addr, dat))
+
+  def _respond(self, request):
+    if request not in self.responses:
+      return
+    resp = self.responses[request]
+    if len(resp) < self.max_len:
+      self._tx((bytes([len(resp)]) + resp).ljust(self.max_len, b"\x00"))
+    else:
+      self._tx(bytes([0x10 | len(resp) >> 8, len(resp) & 0xFF]) + resp[:self.max_len - 2])
+      idx = 0
+      for i in range(self.max_len - 2, len(resp), self.max_len - 1):
+        idx += 1
+        self.tx_frames.append((bytes([0x20 | idx & 0xF]) + resp[i:i + self.max_len - 1]).ljust(self.max_len, b"\x00"))
+
+  def rx(self, dat):
+    if self.sub_addr is not None:
+      if dat[0] != self.sub_addr:
+        return
+      dat = dat[1:]
+
+    frame_type = dat[0] >> 4
+    if frame_type == 0:
+      self._respond(dat[1:1 + dat[0]])
+    elif frame_type == 1:
+      self.rx_len = (dat[0] & 0xF) << 8 | dat[1]
+      self.rx_dat = dat[2:]
+      self.rx_times = [time.monotonic()]
+      self._tx(bytes([0x30, self.block_size, self.st_min]).ljust(self.max_len, b"\x00"))
+    elif frame_type == 2:
+      self.rx_times.append(time.monotonic())
+      self.rx_dat += dat[1:1 + self.rx_len - len(self.rx_dat)]
+      if len(self.rx_dat) == self.rx_len:
+        self._respond(self.rx_dat)
+      elif self.block_size and (len(self.rx_times) - 1) % self.block_size == 0:
+        self._tx(bytes([0x30, self.block_size, self.st_min]).ljust(self.max_len, b"\x00"))
+    elif frame_type == 3:
+      for frame in self.tx_frames:
+        self._tx(frame)
+      self.tx_frames = []
+
+
+class FakeCan():
+  """sendcan and can sockets and a poller, with the ECUs on the other side of the bus."""
+  def __init__(self):
+    self.ecus = {}
+    self.rx_frames = []
+    self.packets = deque()
+    self.sent = 0
+
+  def add_ecu(self, ecu, tx_addrs=None):
+    for tx_addr in tx_addrs or [ecu.tx_addr]:
+      self.ecus.setdefault(tx_addr, []).append(ecu)
+
+  def send(self, dat):
+    for msg in log.Event.from_bytes(dat).sendcan:
+      self.sent += 1
+      for ecu in self.ecus.get(msg.address, []):
+        ecu.rx(msg.dat)
+    if len(self.rx_frames):
+      packet = messaging.new_message('can', len(self.rx_frames))
+      for i, (addr, dat) in enumerate(self.rx_frames):
+        packet.can[i] = {'address': addr, 'dat': dat, 'src': BUS}
+      self.packets.append(packet.to_bytes())
+      self.rx_frames = []
+
+  def receive(self, non_blocking=False):
+    return self.packets.popleft() if len(self.packets) else None
+
+  def poll(self, timeout):
+    if len(self.packets) == 0:
+      time.sleep(timeout / 1000.)
+    return [self] if len(self.packets) else []
+
+
+class TestIsoTpParallelQuery(unittest.TestCase):
+  def setUp(self):
+    self.can = FakeCan()
+
+  def query(self, addrs, request, response, **kwargs):
+    return IsoTpParallelQuery(self.can, self.can, BUS, addrs, request, response, poller=self.can, **kwargs)
+
+  def test_parallel_ecus(self):
+    versions = {0x7e0 + i: b"ECU%d VERSION" % i for i in range(4)}
+    for addr, version in versions.items():
+      self.can.add_ecu(SimulatedEcu(self.can, addr, addr + 8, {UDS_VERSION_REQUEST: UDS_VERSION_RESPONSE + version}))
+
+    timeout = 0.2
+    t = time.monotonic()
+    results = self.query(list(versions) + [0x7d0], [UDS_VERSION_REQUEST], [UDS_VERSION_RESPONSE]).get_data(timeout)
+    self.assertEqual(results, {(addr, None): version for addr, version in versions.items()})
+    # done once the missing ECU times out, not after a timeout per ECU
+    self.assertLess(time.monotonic() - t, 2 * timeout)
+
+  def test_done_when_all_answered(self):
+    self.can.add_ecu(SimulatedEcu(self.can, 0x7e0, 0x7e8, {UDS_VERSION_REQUEST: UDS_VERSION_RESPONSE + b"\x01\x02"}))
+
+    t = time.monotonic()
+    results = self.query([0x7e0], [UDS_VERSION_REQUEST], [UDS_VERSION_RESPONSE]).get_data(1.)
+    self.assertEqual(results, {(0x7e0, None): b"\x01\x02"})
+    self.assertLess(time.monotonic() - t, 0.5)
+
+  def test_flow_control(self):
+    # multi frame requests with a block size and separation time, and a multi frame response
+    version = b"HYUNDAI LONG VERSION STRING"
+    long_request = UDS_VERSION_REQUEST + bytes(range(30))
+    responses = {HYUNDAI_VERSION_REQUEST_MULTI: HYUNDAI_VERSION_RESPONSE + version, long_request: UDS_VERSION_RESPONSE + version}
+    ecu = SimulatedEcu(self.can, 0x7d4, 0x7dc, responses, block_size=2, st_min=10)
+    self.can.add_ecu(ecu)
+
+    results = self.query([0x7d4], [HYUNDAI_VERSION_REQUEST_MULTI], [HYUNDAI_VERSION_RESPONSE]).get_data(0.5)
+    self.assertEqual(results, {(0x7d4, None): version})
+
+    results = self.query([0x7d4], [long_request], [UDS_VERSION_RESPONSE]).get_data(0.5)
+    self.assertEqual(results, {(0x7d4, None): version})
+    # consecutive frames, within and across blocks
+    self.assertEqual(len(ecu.rx_times), 5)
+    for t0, t1 in zip(ecu.rx_times[1:], ecu.rx_times[2:]):
+      self.assertGreaterEqual(t1 - t0, 0.0095)
+
+  def test_request_sequence(self):
+    responses = {SHORT_TESTER_PRESENT_REQUEST: SHORT_TESTER_PRESENT_RESPONSE, TOYOTA_VERSION_REQUEST: TOYOTA_VERSION_RESPONSE + b"\x018965B1255000\x00\x00\x00\x00"}
+    self.can.add_ecu(SimulatedEcu(self.can, 0x7a1, 0x7a9, responses))
+
+    results = self.query([0x7a1], [SHORT_TESTER_PRESENT_REQUEST, TOYOTA_VERSION_REQUEST],
+                         [SHORT_TESTER_PRESENT_RESPONSE, TOYOTA_VERSION_RESPONSE]).get_data(0.2)
+    self.assertEqual(results, {(0x7a1, None): b"\x018965B1255000\x00\x00\x00\x00"})
+
+  def test_sub_addresses(self):
+    for sub_addr in [0x6d, 0xb4]:
+      self.can.add_ecu(SimulatedEcu(self.can, 0x750, 0x758, {UDS_VERSION_REQUEST: UDS_VERSION_RESPONSE + bytes([sub_addr]) * 10},
+                                    sub_addr=sub_addr))
+
+    query = self.query([], None, None)
+    query.add_query([(0x750, 0x6d), (0x750, 0xb4), (0x750, 0x0f)], [UDS_VERSION_REQUEST], [UDS_VERSION_RESPONSE], 0.1)
+    query.add_query([0x7e0], [UDS_VERSION_REQUEST], [UDS_VERSION_RESPONSE], 0.1)
+    results = query.get_data(0.1)
+    self.assertEqual(results, {(0x750, 0x6d): b"\x6d" * 10, (0x750, 0xb4): b"\xb4" * 10})
+    self.assertEqual(query.num_steps, 0)
+
+  def test_bad_response(self):
+    self.can.add_ecu(SimulatedEcu(self.can, 0x7e0, 0x7e8, {UDS_VERSION_REQUEST: b"\x7f\x22\x31"}))
+    results = self.query([0x7e0], [UDS_VERSION_REQUEST], [UDS_VERSION_RESPONSE]).get_data(0.2)
+    self.assertEqual(results, {})
+
+  def test_functional_vin(self):
+    vin = b"1HGCV1F13JA000000"
+    # answers the functional request, the flow control goes to its physical address
+    self.can.add_ecu(SimulatedEcu(self.can, 0x7e1, 0x7e9, {VIN_REQUEST: VIN_RESPONSE + vin}), tx_addrs=[0x7df, 0x7e1])
+
+    results = self.query([0x7df, 0x18db33f1], [VIN_REQUEST], [VIN_RESPONSE], functional_addr=True).get_data(0.2)
+    self.assertEqual(results, {(0x7df, None): vin})
+
+
+if __name__ == "__main__":
+  unittest.main()
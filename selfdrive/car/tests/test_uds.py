@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+import time
+import unittest
+
+from panda.python.uds import UdsClient, UdsSessionManager, MessageTimeoutError, NegativeResponseError, SERVICE_TYPE, \
+                             SESSION_TYPE, DATA_IDENTIFIER_TYPE, TESTER_PRESENT_KEEPALIVE
+
+BUS = 0
+
+
+class FakePanda():
+  """can_send and can_recv of a panda, with ECUs answering after a delay on the other side of the bus."""
+  def __init__(self):
+    self.ecus = {}
+    self.pending = []  # (time it's received, frame)
+    self.sent = []  # (time, addr, dat)
+
+  def add_ecu(self, ecu):
+    self.ecus[ecu.tx_addr] = ecu
+
+  def can_send(self, addr, dat, bus):
+    now = time.monotonic()
+    self.sent.append((now, addr, bytes(dat)))
+    if addr in self.ecus and bus == BUS:
+      for delay, rx_addr, rx_dat in self.ecus[addr].rx(bytes(dat)):
+        self.pending.append((now + delay, (rx_addr, 0, rx_dat, BUS)))
+
+  def can_recv(self):
+    now = time.monotonic()
+    msgs = [msg for t, msg in self.pending if t <= now]
+    self.pending = [(t, msg) for t, msg in self.pending if t > now]
+    return msgs
+
+
+class SimulatedEcu():
+  """Answers UDS requests from a table after a delay. A response can be a list of (delay, response),
+  to send a response pending first."""
+  def __init__(self, tx_addr, responses, delay=0.):
+    self.tx_addr = tx_addr
+    self.rx_addr = tx_addr + 8
+    self.responses = responses
+    self.delay = delay
+    self.requests = []
+    self.tx_frames = []
+
+  def _frames(self, delay, resp):
+    if len(resp) < 8:
+      return [(delay, self.rx_addr, (bytes([len(resp)]) + resp).ljust(8, b"\x00"))]
+    # the consecutive frames wait for our flow control
+    self.tx_frames = [(bytes([0x20 | idx & 0xF]) + resp[i:i + 7]).ljust(8, b"\x00") for idx, i in enumerate(range(6, len(resp), 7), 1)]
+    return [(delay, self.rx_addr, bytes([0x10 | len(resp) >> 8, len(resp) & 0xFF]) + resp[:6])]
+
+  def rx(self, dat):
+    if dat[0] >> 4 == 3:
+      frames, self.tx_frames = self.tx_frames, []
+      return [(0., self.rx_addr, frame) for frame in frames]
+
+    req = dat[1:1 + dat[0]]
+    self.requests.append(req)
+    resps = self.responses.get(req, [])
+    if isinstance(resps, bytes):
+      resps = [(self.delay, resps)]
+    return [frame for delay, resp in resps for frame in self._frames(delay, resp)]
+
+
+class TestUdsSessionManager(unittest.TestCase):
+  def setUp(self):
+    self.panda = FakePanda()
+    self.manager = UdsSessionManager(self.panda, bus=BUS)
+
+  def add_ecu(self, tx_addr, version, delay):
+    req = bytes([SERVICE_TYPE.READ_DATA_BY_IDENTIFIER]) + DATA_IDENTIFIER_TYPE.APPLICATION_SOFTWARE_IDENTIFICATION.to_bytes(2, 'big')
+    ecu = SimulatedEcu(tx_addr, {req: bytes([SERVICE_TYPE.READ_DATA_BY_IDENTIFIER + 0x40]) + req[1:] + version}, delay)
+    self.panda.add_ecu(ecu)
+    return ecu
+
+  def test_concurrent_clients(self):
+    delay = 0.1
+    versions = {0x7e0: b"ENGINE VERSION 1.0", 0x7e1: b"TRANSMISSION 2"}
+    for addr, version in versions.items():
+      self.add_ecu(addr, version, delay)
+    clients = [self.manager.client(addr, timeout=1) for addr in versions]
+
+    t = time.monotonic()
+    requests = [c.submit_read_data_by_identifier(DATA_IDENTIFIER_TYPE.APPLICATION_SOFTWARE_IDENTIFICATION) for c in clients]
+    self.assertEqual(self.manager.gather(requests), list(versions.values()))
+    # both requests were in flight at once
+    self.assertLess(time.monotonic() - t, 1.5 * delay)
+
+    # requests queued on one client are sent one after the other
+    requests = [clients[0].submit_read_data_by_identifier(DATA_IDENTIFIER_TYPE.APPLICATION_SOFTWARE_IDENTIFICATION) for _ in range(2)]
+    requests.append(clients[1].submit_read_data_by_identifier(DATA_IDENTIFIER_TYPE.APPLICATION_SOFTWARE_IDENTIFICATION))
+    t = time.monotonic()
+    self.assertEqual(self.manager.gather(requests), [versions[0x7e0], versions[0x7e0], versions[0x7e1]])
+    self.assertGreater(time.monotonic() - t, 2 * delay)
+    self.assertLess(time.monotonic() - t, 3 * delay)
+
+    with self.assertRaises(ValueError):
+      self.manager.client(0x7e0)
+
+  def test_response_pending(self):
+    timeout = 0.1
+    req = bytes([SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, SESSION_TYPE.EXTENDED_DIAGNOSTIC])
+    pending = bytes([0x7f, SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, 0x78])
+    # the response comes after the first timeout, but within a timeout of the response pending
+    responses = {req: [(0.7 * timeout, pending), (1.5 * timeout, bytes([0x50, SESSION_TYPE.EXTENDED_DIAGNOSTIC]))]}
+    self.panda.add_ecu(SimulatedEcu(0x7e0, responses))
+    client = self.manager.client(0x7e0, timeout=timeout)
+
+    t = time.monotonic()
+    client.diagnostic_session_control(SESSION_TYPE.EXTENDED_DIAGNOSTIC)
+    self.assertGreater(time.monotonic() - t, 1.5 * timeout)
+
+    # a response pending alone still times out, a timeout after it
+    responses[req] = [(0.5 * timeout, pending)]
+    t = time.monotonic()
+    with self.assertRaises(MessageTimeoutError):
+      client.diagnostic_session_control(SESSION_TYPE.EXTENDED_DIAGNOSTIC)
+    self.assertGreater(time.monotonic() - t, 1.5 * timeout)
+    self.assertLess(time.monotonic() - t, 2.5 * timeout)
+
+    responses[req] = bytes([0x7f, SERVICE_TYPE.DIAGNOSTIC_SESSION_CONTROL, 0x12])
+    with self.assertRaises(NegativeResponseError):
+      client.diagnostic_session_control(SESSION_TYPE.EXTENDED_DIAGNOSTIC)
+
+  def test_timeout(self):
+    timeout = 0.1
+    self.add_ecu(0x7e0, b"VERSION", 0.)
+    clients = [self.manager.client(addr, timeout=timeout) for addr in [0x7e0, 0x7e2]]
+
+    t = time.monotonic()
+    requests = [c.submit_read_data_by_identifier(DATA_IDENTIFIER_TYPE.APPLICATION_SOFTWARE_IDENTIFICATION) for c in clients]
+    results = self.manager.gather(requests, return_exceptions=True)
+    self.assertEqual(results[0], b"VERSION")
+    self.assertIsInstance(results[1], MessageTimeoutError)
+    self.assertGreater(time.monotonic() - t, timeout)
+    self.assertLess(time.monotonic() - t, 2 * timeout)
+    with self.assertRaises(MessageTimeoutError):
+      requests[1].result()
+
+    # the client isn't stuck on the request that timed out
+    self.add_ecu(0x7e2, b"LATE", 0.)
+    self.assertEqual(clients[1].read_data_by_identifier(DATA_IDENTIFIER_TYPE.APPLICATION_SOFTWARE_IDENTIFICATION), b"LATE")
+
+  def test_tester_present_keepalive(self):
+    interval = 0.05
+    self.add_ecu(0x7e0, b"VERSION", 2 * interval)
+    client = self.manager.client(0x7e0, timeout=1, tester_present_interval=interval)
+
+    def keepalives():
+      return [t for t, addr, dat in self.panda.sent if addr == 0x7e0 and dat == TESTER_PRESENT_KEEPALIVE]
+
+    t = time.monotonic()
+    while time.monotonic() - t < 6 * interval:
+      self.manager.poll()
+      time.sleep(0.001)
+    sent = keepalives()
+    self.assertIn(len(sent), [5, 6])
+    for t0, t1 in zip(sent, sent[1:]):
+      self.assertGreaterEqual(t1 - t0, interval)
+      self.assertLess(t1 - t0, 1.5 * interval)
+
+    # not sent while a request is in flight, the request itself keeps the session alive
+    self.panda.sent = []
+    client.read_data_by_identifier(DATA_IDENTIFIER_TYPE.APPLICATION_SOFTWARE_IDENTIFICATION)
+    self.assertEqual(keepalives(), [])
+
+
+class TestUdsClient(unittest.TestCase):
+  def test_without_manager(self):
+    panda = FakePanda()
+    panda.add_ecu(SimulatedEcu(0x7e0, {b"\x22\xf1\x90": b"\x62\xf1\x90" + b"1HGCV1F13JA000000"}, 0.01))
+
+    client = UdsClient(panda, 0x7e0, bus=BUS, timeout=0.1)
+    self.assertEqual(client.read_data_by_identifier(DATA_IDENTIFIER_TYPE.VIN), b"1HGCV1F13JA000000")
+    with self.assertRaises(MessageTimeoutError):
+      UdsClient(panda, 0x7e1, bus=BUS, timeout=0.1).read_data_by_identifier(DATA_IDENTIFIER_TYPE.VIN)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -2,6 +2,7 @@ from cereal import car, log
 from common.realtime import DT_CTRL
 from selfdrive.swaglog import cloudlog
 import copy
+import heapq
 
 
 AlertSize = log.ControlsState.AlertSize
@@ -9,10 +10,26 @@ AlertStatus = log.ControlsState.AlertStatus
 VisualAlert = car.CarControl.HUDControl.VisualAlert
 AudibleAlert = car.CarControl.HUDControl.AudibleAlert
 
+def alert_end_time(alert):
+  return alert.start_time + max(alert.duration_sound, alert.duration_hud_alert, alert.duration_text)
+
 class AlertManager():
 
   def __init__(self):
-    self.activealerts = []
+    # one slot per alert type, re-adding an alert only refreshes its start time
+    self.activealerts = {}
+    self.alert_sources = {}
+    self.alert_order = {}  # first add in a frame wins ties, like a stable sort
+    self.add_count = 0
+
+    # heap of (end time, alert type), an entry is checked against the alert's
+    # current end time when it's popped, so refreshed alerts aren't pushed again
+    self.deadlines = []
+
+    self.current_alert = None
+    self.prev_alert = None
+    self.prev_visible = None
+    self.clear_fields()
 
   def alert_present(self):
     return len(self.activealerts) > 0
@@ -22,28 +39,61 @@ class AlertManager():
       self.add(frame, a, enabled=enabled)
 
   def add(self, frame, alert, enabled=True):
-    added_alert = copy.copy(alert)
-    added_alert.start_time = frame * DT_CTRL
+    start_time = frame * DT_CTRL
+    alert_type = alert.alert_type
 
     # if new alert is higher priority, log it
-    if not self.alert_present() or added_alert.alert_priority > self.activealerts[0].alert_priority:
-      cloudlog.event('alert_add', alert_type=added_alert.alert_type, enabled=enabled)
-
-    self.activealerts.append(added_alert)
-
-    # sort by priority first and then by start_time
-    self.activealerts.sort(key=lambda k: (k.alert_priority, k.start_time), reverse=True)
-
-  def process_alerts(self, frame):
-    cur_time = frame * DT_CTRL
-
-    # first get rid of all the expired alerts
-    self.activealerts = [a for a in self.activealerts if a.start_time +
-                         max(a.duration_sound, a.duration_hud_alert, a.duration_text) > cur_time]
-
-    current_alert = self.activealerts[0] if self.alert_present() else None
-
-    # start with assuming no alerts
+    if self.current_alert is None or alert.alert_priority > self.current_alert.alert_priority:
+      cloudlog.event('alert_add', alert_type=alert_type, enabled=enabled)
+
+    added_alert = self.activealerts.get(alert_type)
+    new_slot = added_alert is None
+    prev_start_time = None if new_slot else added_alert.start_time
+    # a different alert of the same type replaces it, unless this type was already added in this
+    # frame, then the first add's content is kept like the first of the ties in a stable sort
+    if new_slot or (self.alert_sources[alert_type] is not alert and prev_start_time != start_time):
+      added_alert = copy.copy(alert)
+      if self.current_alert is not None and self.current_alert.alert_type == alert_type:
+        self.current_alert = added_alert
+      self.activealerts[alert_type] = added_alert
+      self.alert_sources[alert_type] = alert
+    added_alert.start_time = start_time
+    # re-adding in the same frame keeps the order of the first add
+    if prev_start_time != start_time:
+      self.alert_order[alert_type] = self.add_count
+      self.add_count += 1
+    if new_slot:
+      heapq.heappush(self.deadlines, (alert_end_time(added_alert), alert_type))
+
+    # sorted by priority first and then by start_time, the added alert is
+    # always the most recent one
+    top = self.current_alert
+    if top is None or added_alert.alert_priority > top.alert_priority or \
+       (added_alert.alert_priority == top.alert_priority and start_time > top.start_time):
+      self.current_alert = added_alert
+
+  def expire_alerts(self, cur_time):
+    top_expired = False
+    while len(self.deadlines) and self.deadlines[0][0] <= cur_time:
+      _, alert_type = heapq.heappop(self.deadlines)
+      alert = self.activealerts[alert_type]
+      end_time = alert_end_time(alert)
+      if end_time > cur_time:
+        heapq.heappush(self.deadlines, (end_time, alert_type))
+      else:
+        del self.activealerts[alert_type]
+        del self.alert_sources[alert_type]
+        del self.alert_order[alert_type]
+        if alert is self.current_alert:
+          top_expired = True
+
+    if top_expired:
+      self.current_alert = None
+      if self.alert_present():
+        self.current_alert = max(self.activealerts.values(),
+                                 key=lambda a: (a.alert_priority, a.start_time, -self.alert_order[a.alert_type]))
+
+  def clear_fields(self):
     self.alert_type = ""
     self.alert_text_1 = ""
     self.alert_text_2 = ""
@@ -53,16 +103,40 @@ class AlertManager():
     self.audible_alert = AudibleAlert.none
     self.alert_rate = 0.
 
+  def process_alerts(self, frame):
+    cur_time = frame * DT_CTRL
+
+    # first get rid of all the expired alerts
+    self.expire_alerts(cur_time)
+
+    current_alert = self.current_alert
+    visible = None
+    if current_alert is not None:
+      visible = (current_alert.start_time + current_alert.duration_sound > cur_time,
+                 current_alert.start_time + current_alert.duration_hud_alert > cur_time,
+                 current_alert.start_time + current_alert.duration_text > cur_time)
+
+    # the published fields only change with the top alert or when one of its durations runs out,
+    # not when it's re-added every frame and only its start time advances
+    if current_alert is self.prev_alert and visible == self.prev_visible:
+      return
+    self.prev_alert = current_alert
+    self.prev_visible = visible
+
+    # start with assuming no alerts
+    self.clear_fields()
+
     if current_alert:
       self.alert_type = current_alert.alert_type
+      sound, hud_alert, text = visible
 
-      if current_alert.start_time + current_alert.duration_sound > cur_time:
+      if sound:
         self.audible_alert = current_alert.audible_alert
 
-      if current_alert.start_time + current_alert.duration_hud_alert > cur_time:
+      if hud_alert:
         self.visual_alert = current_alert.visual_alert
 
-      if current_alert.start_time + current_alert.duration_text > cur_time:
+      if text:
         self.alert_text_1 = current_alert.alert_text_1
         self.alert_text_2 = current_alert.alert_text_2
         self.alert_status = current_alert.alert_status
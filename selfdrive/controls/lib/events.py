@@ -1,3 +1,5 @@
+import numpy as np
+
 from cereal import log, car
 
 from common.realtime import DT_CTRL
@@ -32,12 +34,20 @@ class ET:
 
 # get event name from enum
 EVENT_NAME = {v: k for k, v in EventName.schema.enumerants.items()}
+NUM_EVENTS = max(EVENT_NAME.keys()) + 1
 
 class Events:
+  """Active events are kept both as a list, for ordering, and as a bitset
+  indexed by EventName, so type checks are a single AND with the
+  precomputed EVENT_TYPE_MASKS."""
   def __init__(self):
     self.events = []
+    self.mask = 0
     self.static_events = []
-    self.events_prev = dict.fromkeys(EVENTS.keys(), 0)
+    self.static_mask = 0
+    self.events_prev = np.zeros(NUM_EVENTS, dtype=np.int64)
+    self._msg_events = None
+    self._msg = []
 
   @property
   def names(self):
@@ -49,24 +59,35 @@ class Events:
   def add(self, event_name, static=False):
     if static:
       self.static_events.append(event_name)
+      self.static_mask |= 1 << event_name
     self.events.append(event_name)
+    self.mask |= 1 << event_name
 
   def clear(self):
-    self.events_prev = {k: (v+1 if k in self.events else 0) for k, v in self.events_prev.items()}
+    active = np.zeros(NUM_EVENTS, dtype=np.int64)
+    active[self.events] = 1
+    self.events_prev = (self.events_prev + 1) * active
     self.events = self.static_events.copy()
+    self.mask = self.static_mask
 
   def any(self, event_type):
-    for e in self.events:
-      if event_type in EVENTS.get(e, {}).keys():
-        return True
-    return False
+    return (self.mask & EVENT_TYPE_MASKS.get(event_type, 0)) != 0
 
   def create_alerts(self, event_types, callback_args=None):
     if callback_args is None:
       callback_args = []
 
+    types_mask = 0
+    for et in event_types:
+      types_mask |= EVENT_TYPE_MASKS.get(et, 0)
+
     ret = []
+    if not self.mask & types_mask:
+      return ret
+
     for e in self.events:
+      if not (types_mask >> e) & 1:
+        continue
       types = EVENTS[e].keys()
       for et in event_types:
         if et in types:
@@ -81,9 +102,13 @@ class Events:
 
   def add_from_msg(self, events):
     for e in events:
-      self.events.append(e.name.raw)
+      self.add(e.name.raw)
 
   def to_msg(self):
+    # only rebuild the CarEvents when the active events changed
+    if self.events == self._msg_events:
+      return self._msg
+
     ret = []
     for event_name in self.events:
       event = car.CarEvent.new_message()
@@ -91,6 +116,9 @@ class Events:
       for event_type in EVENTS.get(event_name, {}).keys():
         setattr(event, event_type , True)
       ret.append(event)
+
+    self._msg_events = self.events.copy()
+    self._msg = ret
     return ret
 
 class Alert:
@@ -798,3 +826,9 @@ EVENTS = {
   },
 
 }
+
+# bitmask of the events that have an alert of each event type
+EVENT_TYPE_MASKS = {}
+for _name, _alerts in EVENTS.items():
+  for _et in _alerts.keys():
+    EVENT_TYPE_MASKS[_et] = EVENT_TYPE_MASKS.get(_et, 0) | (1 << _name)
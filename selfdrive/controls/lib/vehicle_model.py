@@ -34,14 +34,32 @@ class VehicleModel:
 
     self.cF_orig = CP.tireStiffnessFront
     self.cR_orig = CP.tireStiffnessRear
+
+    self.stiffness_factor = None
+    self.sR = None
     self.update_params(1.0, CP.steerRatio)
 
   def update_params(self, stiffness_factor: float, steer_ratio: float) -> None:
     """Update the vehicle model with a new stiffness factor and steer ratio"""
+    if stiffness_factor == self.stiffness_factor and steer_ratio == self.sR:
+      return
+
+    self.stiffness_factor = stiffness_factor
     self.cF = stiffness_factor * self.cF_orig
     self.cR = stiffness_factor * self.cR_orig
     self.sR = steer_ratio
 
+    # Everything below only depends on the parameters, not on speed
+    self.sf = calc_slip_factor(self)
+    self.curvature_gain = (1. - self.chi) / self.l
+    # A = [[a00 / u, a01 / u - u], [a10 / u, a11 / u]]
+    self.a00 = - (self.cF + self.cR) / self.m
+    self.a01 = - (self.cF * self.aF - self.cR * self.aR) / self.m
+    self.a10 = - (self.cF * self.aF - self.cR * self.aR) / self.j
+    self.a11 = - (self.cF * self.aF**2 + self.cR * self.aR**2) / self.j
+    self.b0 = (self.cF + self.chi * self.cR) / self.m / self.sR
+    self.b1 = (self.cF * self.aF - self.chi * self.cR * self.aR) / self.j / self.sR
+
   def steady_state_sol(self, sa: float, u: float) -> np.ndarray:
     """Returns the steady state solution.
 
@@ -82,8 +100,7 @@ class VehicleModel:
     Returns:
       Curvature factor [1/m]
     """
-    sf = calc_slip_factor(self)
-    return (1. - self.chi) / (1. - sf * u**2) / self.l
+    return self.curvature_gain / (1. - self.sf * u**2)
 
   def get_steer_from_curvature(self, curv: float, u: float) -> float:
     """Calculates the required steering wheel angle for a given curvature
@@ -123,6 +140,45 @@ class VehicleModel:
     """
     return self.calc_curvature(sa, u) * u
 
+  def curvature_and_yaw_rate(self, sa: np.ndarray, u: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Batched curvature and yaw rate response, e.g. over a whole speed vector
+
+    Args:
+      sa: Steering wheel angles [rad], scalar or array broadcastable with u
+      u: Speeds [m/s]
+
+    Returns:
+      A tuple with the curvatures [1/m] and yaw rates [rad/s]
+    """
+    u = np.asarray(u, dtype=np.float64)
+    curvature = self.calc_curvature(np.asarray(sa, dtype=np.float64), u)
+    return curvature, curvature * u
+
+  def steady_state_sol_batch(self, sa: np.ndarray, u: np.ndarray) -> np.ndarray:
+    """Batched steady_state_sol
+
+    Args:
+      sa: Steering wheel angles [rad], scalar or array broadcastable with u
+      u: Speeds [m/s]
+
+    Returns:
+      Array of the broadcast shape of sa and u with a last axis of 2 for the steady state
+      solutions (lateral speed, rotational speed)
+    """
+    sa, u = np.broadcast_arrays(np.asarray(sa, dtype=np.float64), np.atleast_1d(np.asarray(u, dtype=np.float64)))
+
+    # closed form of -A^{-1} B, the speed dependence is explicit
+    dyn = u > 0.1
+    ud = np.where(dyn, u, 1.)
+    det = (self.a00 * self.a11 - self.a01 * self.a10) / ud**2 + self.a10
+    v = -(self.a11 * self.b0 / ud - (self.a01 / ud - ud) * self.b1) / det
+    r = -(-self.a10 * self.b0 / ud + self.a00 * self.b1 / ud) / det
+
+    ret = np.empty(u.shape + (2,))
+    ret[..., 0] = np.where(dyn, v, self.aR / self.sR / self.l * u) * sa
+    ret[..., 1] = np.where(dyn, r, 1. / self.sR / self.l * u) * sa
+    return ret
+
 
 def kin_ss_sol(sa: float, u: float, VM: VehicleModel) -> np.ndarray:
   """Calculate the steady state solution at low speeds
@@ -163,14 +219,10 @@ def create_dyn_state_matrices(u: float, VM: VehicleModel) -> Tuple[np.ndarray, n
     sR: Steering ratio [-]
     chi: Steer ratio rear [-]
   """
-  A = np.zeros((2, 2))
-  B = np.zeros((2, 1))
-  A[0, 0] = - (VM.cF + VM.cR) / (VM.m * u)
-  A[0, 1] = - (VM.cF * VM.aF - VM.cR * VM.aR) / (VM.m * u) - u
-  A[1, 0] = - (VM.cF * VM.aF - VM.cR * VM.aR) / (VM.j * u)
-  A[1, 1] = - (VM.cF * VM.aF**2 + VM.cR * VM.aR**2) / (VM.j * u)
-  B[0, 0] = (VM.cF + VM.chi * VM.cR) / VM.m / VM.sR
-  B[1, 0] = (VM.cF * VM.aF - VM.chi * VM.cR * VM.aR) / VM.j / VM.sR
+  A = np.array([[VM.a00 / u, VM.a01 / u - u],
+                [VM.a10 / u, VM.a11 / u]])
+  B = np.array([[VM.b0],
+                [VM.b1]])
   return A, B
 
 
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import copy
+import random
+import unittest
+
+from common.realtime import DT_CTRL
+from selfdrive.controls.lib.alertmanager import AlertManager
+from selfdrive.controls.lib.events import Alert, Priority, AlertStatus, AlertSize, VisualAlert, AudibleAlert
+
+
+FIELDS = ('alert_type', 'alert_text_1', 'alert_text_2', 'alert_status', 'alert_size', 'visual_alert',
+          'audible_alert', 'alert_rate')
+
+
+class ListAlertManager():
+  """The list based AlertManager: every add is a copy, kept sorted by priority and start time."""
+  def __init__(self):
+    self.activealerts = []
+
+  def add(self, frame, alert):
+    added_alert = copy.copy(alert)
+    added_alert.start_time = frame * DT_CTRL
+    self.activealerts.append(added_alert)
+    self.activealerts.sort(key=lambda k: (k.alert_priority, k.start_time), reverse=True)
+
+  def process_alerts(self, frame):
+    cur_time = frame * DT_CTRL
+    self.activealerts = [a for a in self.activealerts if a.start_time +
+                         max(a.duration_sound, a.duration_hud_alert, a.duration_text) > cur_time]
+    current_alert = self.activealerts[0] if len(self.activealerts) else None
+
+    fields = dict.fromkeys(FIELDS)
+    fields.update(alert_type="", alert_text_1="", alert_text_2="", alert_status=AlertStatus.normal,
+                  alert_size=AlertSize.none, visual_alert=VisualAlert.none, audible_alert=AudibleAlert.none,
+                  alert_rate=0.)
+    if current_alert:
+      fields['alert_type'] = current_alert.alert_type
+      if current_alert.start_time + current_alert.duration_sound > cur_time:
+        fields['audible_alert'] = current_alert.audible_alert
+      if current_alert.start_time + current_alert.duration_hud_alert > cur_time:
+        fields['visual_alert'] = current_alert.visual_alert
+      if current_alert.start_time + current_alert.duration_text > cur_time:
+        for f in ('alert_text_1', 'alert_text_2', 'alert_status', 'alert_size', 'alert_rate'):
+          fields[f] = getattr(current_alert, f)
+    return current_alert, fields
+
+
+def make_alert(alert_type, priority, rnd):
+  durations = [rnd.choice([0., 0.02, 0.05, 0.1, 0.3]) for _ in range(3)]
+  alert = Alert(alert_type, "", AlertStatus.normal, AlertSize.small, priority, VisualAlert.steerRequired,
+                AudibleAlert.chimeWarning1, *durations)
+  alert.alert_type = alert_type
+  return alert
+
+
+def change_content(alert, rnd):
+  """A new alert object of the same type with other content and a stale start time"""
+  alert = copy.copy(alert)
+  alert.alert_text_2 = "text%d" % rnd.randint(0, 1000)
+  alert.alert_status = rnd.choice([AlertStatus.normal, AlertStatus.userPrompt, AlertStatus.critical])
+  alert.alert_size = rnd.choice([AlertSize.small, AlertSize.mid, AlertSize.full])
+  alert.visual_alert = rnd.choice([VisualAlert.none, VisualAlert.steerRequired, VisualAlert.fcw])
+  alert.audible_alert = rnd.choice([AudibleAlert.none, AudibleAlert.chimeWarning1, AudibleAlert.chimePrompt])
+  alert.alert_rate = rnd.choice([0., 0.5, 1.])
+  alert.start_time = rnd.randint(0, 100) * DT_CTRL
+  return alert
+
+
+class TestAlertManager(unittest.TestCase):
+  def test_matches_list_manager(self):
+    rnd = random.Random(0)
+    for _ in range(200):
+      # few priorities so most alerts tie with another one
+      alerts = [make_alert("alert%d" % i, rnd.choice([Priority.LOW, Priority.MID]), rnd) for i in range(6)]
+      # added every frame for a while, like an event that's active
+      sustained = rnd.choice(alerts)
+      sustained_frames = range(rnd.randint(0, 50), rnd.randint(50, 100))
+      AM, ref = AlertManager(), ListAlertManager()
+
+      for frame in range(100):
+        added = [sustained] if frame in sustained_frames else []
+        for _ in range(rnd.randint(0, 3)):
+          alert = rnd.choice(alerts)
+          if rnd.random() < 0.5:
+            alert = change_content(alert, rnd)
+          added.append(alert)
+        rnd.shuffle(added)
+
+        for alert in added:
+          AM.add(frame, alert)
+          ref.add(frame, alert)
+
+        AM.process_alerts(frame)
+        expected, fields = ref.process_alerts(frame)
+        self.assertEqual({f: getattr(AM, f) for f in FIELDS}, fields)
+        if expected is not None:
+          self.assertEqual(AM.current_alert.start_time, expected.start_time)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+import unittest
+import numpy as np
+
+from cereal import car
+from selfdrive.controls.lib.vehicle_model import VehicleModel
+
+
+def get_car_params():
+  CP = car.CarParams.new_message()
+  CP.mass = 1500.
+  CP.wheelbase = 2.7
+  CP.centerToFront = 1.2
+  CP.rotationalInertia = 2500.
+  CP.steerRatio = 15.
+  CP.tireStiffnessFront = 190000.
+  CP.tireStiffnessRear = 200000.
+  return CP
+
+
+class TestVehicleModel(unittest.TestCase):
+  def setUp(self):
+    self.VM = VehicleModel(get_car_params())
+
+  def check_batch(self, sa, u):
+    ret = self.VM.steady_state_sol_batch(sa, u)
+    sa, u = np.broadcast_arrays(sa, np.atleast_1d(u))
+    self.assertEqual(ret.shape, u.shape + (2,))
+    for idx in np.ndindex(u.shape):
+      np.testing.assert_allclose(ret[idx], self.VM.steady_state_sol(sa[idx], u[idx])[:, 0], rtol=1e-9, atol=1e-12)
+
+  def test_steady_state_sol_batch(self):
+    # dynamic and kinematic speeds
+    speeds = np.array([0., 0.05, 0.1, 0.2, 5., 20., 40.])
+    self.check_batch(.1, speeds)
+    self.check_batch(np.linspace(-.5, .5, len(speeds)), speeds)
+    self.check_batch(.1, 20.)
+    self.check_batch(np.array([.1, .2]), 5.)
+    self.check_batch(np.array([.1, .2]), 0.05)
+    self.check_batch(np.array([[.1], [-.2]]), speeds)
+    self.check_batch(.3, speeds.reshape(-1, 1) * np.ones((1, 3)))
+
+
+if __name__ == "__main__":
+  unittest.main()
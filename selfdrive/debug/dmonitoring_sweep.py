@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# type: ignore
+"""Replays logged driverState, carState and model messages through DriverStatus for
+many _DISTRACTED_* settings in parallel, and reports the alerts each would have raised."""
+
+import itertools
+import time
+
+import numpy as np
+
+from cereal import car
+from tools.lib.logreader import LogReader
+from selfdrive.debug.sweep_common import sweep, sweep_parser, parse_floats, for_each_route
+from selfdrive.locationd.calibration_helpers import Calibration
+from selfdrive.monitoring.driver_monitor import _DISTRACTED_TIME, _DISTRACTED_PRE_TIME_TILL_TERMINAL, \
+                                               _DISTRACTED_PROMPT_TIME_TILL_TERMINAL, _DISTRACTED_FILTER_TS
+from selfdrive.monitoring.replay import replay, driver_state_row, car_state_row
+
+EventName = car.CarEvent.EventName
+
+ALERTS = [
+  ('pre', EventName.preDriverDistracted),
+  ('prompt', EventName.promptDriverDistracted),
+  ('terminal', EventName.driverDistracted),
+  ('tooDistracted', EventName.tooDistracted),
+]
+
+
+def load_route(path):
+  """Extracts the messages dmonitoringd consumes into arrays."""
+  dm_t, dm, cal_rpy = [], [], []
+  cs_t, cs = [], []
+  model_t, engaged_prob = [], []
+  rpy = [0., 0., 0.]
+  for msg in LogReader(path):
+    which = msg.which()
+    t = msg.logMonoTime * 1e-9
+    if which == 'driverState':
+      dm_t.append(t)
+      dm.append(driver_state_row(msg.driverState))
+      cal_rpy.append(rpy)
+    elif which == 'carState':
+      cs_t.append(t)
+      cs.append(car_state_row(msg.carState))
+    elif which == 'model':
+      model_t.append(t)
+      engaged_prob.append(msg.model.meta.engagedProb)
+    elif which == 'liveCalibration':
+      if msg.liveCalibration.calStatus == Calibration.CALIBRATED and len(msg.liveCalibration.rpyCalib) == 3:
+        rpy = list(msg.liveCalibration.rpyCalib)
+
+  def sort(ts, *cols):
+    order = np.argsort(ts, kind='stable')
+    return [np.asarray(c)[order] for c in (ts,) + cols]
+
+  dm_t, dm, cal_rpy = sort(dm_t, dm, cal_rpy)
+  cs_t, cs = sort(cs_t, cs)
+  model_t, engaged_prob = sort(model_t, engaged_prob)
+  return dict(dm_t=dm_t, dm=dm, cal_rpy=cal_rpy, cs_t=cs_t, cs=cs, model_t=model_t, engaged_prob=engaged_prob)
+
+
+def run_hypothesis(route, hypothesis):
+  """Runs one (distracted_time, pre_time, prompt_time, filter_ts, is_rhd) hypothesis over the route."""
+  distracted_time, pre_time, prompt_time, filter_ts, is_rhd = hypothesis
+  out = replay(**route, is_rhd=is_rhd, distracted_time=distracted_time, distracted_pre_time=pre_time,
+               distracted_prompt_time=prompt_time, distracted_filter_ts=filter_ts)
+
+  dt = np.diff(route['dm_t'], append=route['dm_t'][-1])
+  result = {'minAwareness': float(np.min(out['awareness']))}
+  for name, event in ALERTS:
+    active = np.array([event in events for events in out['events']])
+    result[name] = int(np.count_nonzero(active[1:] & ~active[:-1]) + active[0])
+    result[name + 'Time'] = float(np.sum(dt[active]))
+  return result
+
+
+if __name__ == "__main__":
+  parser = sweep_parser('Sweep driver monitoring timers over logs of one or more routes')
+  parser.add_argument('--distracted-times', type=parse_floats, default=[_DISTRACTED_TIME])
+  parser.add_argument('--pre-times', type=parse_floats, default=[_DISTRACTED_PRE_TIME_TILL_TERMINAL])
+  parser.add_argument('--prompt-times', type=parse_floats, default=[_DISTRACTED_PROMPT_TIME_TILL_TERMINAL])
+  parser.add_argument('--filter-ts', type=parse_floats, default=[_DISTRACTED_FILTER_TS])
+  parser.add_argument('--rhd', action='store_true')
+  args = parser.parse_args()
+
+  hypotheses = list(itertools.product(args.distracted_times, args.pre_times, args.prompt_times, args.filter_ts, [args.rhd]))
+
+  def sweep_route(route):
+    data = load_route(route)
+    if len(data['dm_t']) == 0:
+      print(f"{route}: no driverState")
+      return
+
+    t = time.monotonic()
+    results = sweep(run_hypothesis, data, hypotheses, args.processes)
+    duration = data['dm_t'][-1] - data['dm_t'][0]
+    print(f"{route} ({duration:.0f}s, {len(hypotheses) * duration / (time.monotonic() - t):.0f}x realtime)")
+    print("  dist   pre    prompt filt   ->  pre(s)        prompt(s)     terminal(s)   tooDistracted  min awareness")
+    for (dist, pre, prompt, filt, _), r in zip(hypotheses, results):
+      print(f"  {dist:6.1f} {pre:6.1f} {prompt:6.1f} {filt:6.2f} ->  " +
+            "  ".join(f"{r[name]:3d} ({r[name + 'Time']:6.1f})" for name, _ in ALERTS[:3]) +
+            f"  {r['tooDistracted']:3d}            {r['minAwareness']:5.2f}")
+
+  for_each_route(args.route, sweep_route)
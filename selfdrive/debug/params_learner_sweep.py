@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# type: ignore
+"""Replays logged carState and liveLocationKalman through many ParamsLearner
+hypotheses in parallel, and reports converged values and convergence time."""
+
+import itertools
+import math
+from types import SimpleNamespace
+
+import numpy as np
+
+from tools.lib.logreader import LogReader
+from selfdrive.debug.sweep_common import sweep, sweep_parser, parse_floats, for_each_route
+from selfdrive.locationd.paramsd import ParamsLearner, CARSTATE_DECIMATION
+from selfdrive.locationd.models.car_kf import States
+
+# Hypotheses are considered converged once they stay within these bounds of their final value
+SR_TOL = 0.01  # relative
+STIFFNESS_TOL = 0.02  # relative
+ANGLE_OFFSET_TOL = 0.1  # deg
+
+
+def load_route(path):
+  """Extracts the CarParams and the messages ParamsLearner consumes
+  into plain, picklable objects."""
+  CP = None
+  msgs = []
+  for msg in LogReader(path):
+    which = msg.which()
+    t = msg.logMonoTime * 1e-9
+    if which == 'carParams' and CP is None:
+      cp = msg.carParams
+      CP = SimpleNamespace(carFingerprint=cp.carFingerprint, steerRatio=cp.steerRatio, mass=cp.mass,
+                           rotationalInertia=cp.rotationalInertia, centerToFront=cp.centerToFront,
+                           wheelbase=cp.wheelbase, tireStiffnessFront=cp.tireStiffnessFront,
+                           tireStiffnessRear=cp.tireStiffnessRear)
+    elif which == 'carState':
+      cs = msg.carState
+      msgs.append((t, which, SimpleNamespace(steeringAngle=cs.steeringAngle, steeringPressed=cs.steeringPressed,
+                                             vEgo=cs.vEgo)))
+    elif which == 'liveLocationKalman':
+      llk = msg.liveLocationKalman
+      msgs.append((t, which, SimpleNamespace(
+        angularVelocityCalibrated=SimpleNamespace(value=list(llk.angularVelocityCalibrated.value),
+                                                  std=list(llk.angularVelocityCalibrated.std)),
+        inputsOK=llk.inputsOK, posenetOK=llk.posenetOK, status=llk.status.raw)))
+
+  msgs.sort(key=lambda m: m[0])
+  return CP, msgs
+
+
+def convergence_time(ts, values, tol):
+  """Time from the first sample after which values stay within tol of the final value."""
+  err = np.abs(values - values[-1]) > tol
+  if not np.any(err):
+    return 0.0
+  last_out = np.nonzero(err)[0][-1]
+  if last_out + 1 >= len(ts):
+    return math.nan
+  return ts[last_out + 1] - ts[0]
+
+
+def run_hypothesis(route, hypothesis):
+  """Runs one (steer_ratio, stiffness_factor, angle_offset [deg], noise_scale) hypothesis
+  over the (CarParams, messages) of a route with its own ParamsLearner."""
+  CP, msgs = route
+  steer_ratio, stiffness_factor, angle_offset, noise_scale = hypothesis
+  learner = ParamsLearner(CP, steer_ratio, stiffness_factor, math.radians(angle_offset))
+
+  # Scale process and observation noise for this hypothesis
+  learner.kf.filter.Q = np.ascontiguousarray(learner.kf.Q * noise_scale)
+  learner.kf.obs_noise = {kind: noise * noise_scale for kind, noise in learner.kf.obs_noise.items()}
+
+  ts, estimates = [], []
+  for t, which, msg in msgs:
+    learner.handle_log(t, which, msg)
+    if which == 'carState' and learner.carstate_counter % CARSTATE_DECIMATION == 0:
+      x = learner.kf.x
+      ts.append(t)
+      estimates.append((float(x[States.STEER_RATIO]), float(x[States.STIFFNESS]), math.degrees(x[States.ANGLE_OFFSET])))
+
+  if len(ts) == 0:
+    return None
+
+  ts, estimates = np.array(ts), np.array(estimates)
+  sr, stiffness, angle_offset = estimates[-1]
+  return {
+    'steerRatio': sr,
+    'stiffnessFactor': stiffness,
+    'angleOffsetAverage': angle_offset,
+    'convergenceTime': max(convergence_time(ts, estimates[:, 0], SR_TOL * sr),
+                           convergence_time(ts, estimates[:, 1], STIFFNESS_TOL * stiffness),
+                           convergence_time(ts, estimates[:, 2], ANGLE_OFFSET_TOL)),
+  }
+
+
+if __name__ == "__main__":
+  parser = sweep_parser('Sweep ParamsLearner priors over logs of one or more routes')
+  parser.add_argument('--steer-ratios', type=parse_floats, default=None, help='Comma separated initial steer ratios, defaults to CarParams')
+  parser.add_argument('--stiffness', type=parse_floats, default=[0.8, 1.0, 1.2])
+  parser.add_argument('--angle-offsets', type=parse_floats, default=[0.0], help='Comma separated initial angle offsets [deg]')
+  parser.add_argument('--noise-scales', type=parse_floats, default=[1.0])
+  args = parser.parse_args()
+
+  def sweep_route(route):
+    CP, msgs = load_route(route)
+    if CP is None:
+      print(f"{route}: no carParams")
+      return
+
+    steer_ratios = args.steer_ratios
+    if steer_ratios is None:
+      steer_ratios = [0.8 * CP.steerRatio, CP.steerRatio, 1.2 * CP.steerRatio]
+    hypotheses = list(itertools.product(steer_ratios, args.stiffness, args.angle_offsets, args.noise_scales))
+
+    results = sweep(run_hypothesis, (CP, msgs), hypotheses, args.processes)
+    print(f"{route} ({CP.carFingerprint})")
+    print("  sR0    stiff0  ao0    noise  ->  sR     stiff   ao      t_conv")
+    for (sr0, stiff0, ao0, noise), r in zip(hypotheses, results):
+      if r is None:
+        print(f"  {sr0:6.2f} {stiff0:6.2f} {ao0:6.2f} {noise:6.2f} ->  no data")
+        continue
+      print(f"  {sr0:6.2f} {stiff0:6.2f} {ao0:6.2f} {noise:6.2f} ->  {r['steerRatio']:6.2f} {r['stiffnessFactor']:6.2f} "
+            f"{r['angleOffsetAverage']:6.2f} {r['convergenceTime']:7.1f}s")
+
+  for_each_route(args.route, sweep_route)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# type: ignore
+"""Replays logged health and thermal messages through the offroad power monitoring for many
+BATT_PERC_OFF and charge thresholds, and reports when each would have shut the device down."""
+
+import itertools
+
+import numpy as np
+
+from cereal import log
+from tools.lib.logreader import LogReader
+from selfdrive.debug.sweep_common import sweep, sweep_parser, parse_floats, for_each_route
+from selfdrive.thermald.power_monitoring import replay, BATT_PERC_OFF, BATT_PERC_TO_DISCHARGE, BATT_PERC_TO_CHARGE
+
+
+def load_route(path):
+  """Extracts the thermal messages and the health in effect at each of them into arrays."""
+  rows = []
+  health = (False, log.HealthData.HwType.unknown, 0)
+  for msg in LogReader(path):
+    which = msg.which()
+    if which == 'health':
+      h = msg.health
+      health = (h.ignitionLine or h.ignitionCan, h.hwType.raw, h.current)
+    elif which == 'thermal':
+      th = msg.thermal
+      rows.append((msg.logMonoTime * 1e-9, *health, th.batteryStatus, th.batteryVoltage, th.batteryCurrent, th.batteryPercent))
+
+  rows.sort(key=lambda r: r[0])
+  cols = list(zip(*rows)) if len(rows) else [[]] * 8
+  return {
+    't': np.array(cols[0], dtype=np.float64),
+    'ignition': np.array(cols[1], dtype=bool),
+    'hw_type': np.array(cols[2], dtype=np.int64),
+    'panda_current': np.array(cols[3], dtype=np.float64),
+    'battery_status': list(cols[4]),
+    'battery_voltage': np.array(cols[5], dtype=np.float64),
+    'battery_current': np.array(cols[6], dtype=np.float64),
+    'battery_percent': np.array(cols[7], dtype=np.float64),
+  }
+
+
+def run_hypothesis(route, hypothesis):
+  """Runs one (batt_perc_off, to_discharge, to_charge) hypothesis over the route."""
+  batt_perc_off, to_discharge, to_charge = hypothesis
+  out = replay(**route, batt_perc_off=batt_perc_off, to_discharge=to_discharge, to_charge=to_charge)
+
+  t, ignition = route['t'], route['ignition']
+  on = np.nonzero(ignition)[0]
+  off_ts = t[on[-1]] if len(on) else t[0]
+  prediction = out['timeToShutdown']
+  return {
+    'shutdownAfter': None if out['shutdownTs'] is None else out['shutdownTs'] - off_ts,
+    'chargingChanges': len(out['chargingChanges']),
+    'powerUsed': out['powerUsed'][-1],
+    'predictedAtOff': float(prediction[np.searchsorted(t, off_ts + 60.):][0]) if np.any(t >= off_ts + 60.) else np.nan,
+  }
+
+
+if __name__ == "__main__":
+  parser = sweep_parser('Sweep offroad shutdown and charging thresholds over logs of one or more routes')
+  parser.add_argument('--batt-perc-off', type=parse_floats, default=[BATT_PERC_OFF])
+  parser.add_argument('--to-discharge', type=parse_floats, default=[BATT_PERC_TO_DISCHARGE])
+  parser.add_argument('--to-charge', type=parse_floats, default=[BATT_PERC_TO_CHARGE])
+  args = parser.parse_args()
+
+  hypotheses = list(itertools.product(args.batt_perc_off, args.to_discharge, args.to_charge))
+
+  def sweep_route(route):
+    data = load_route(route)
+    if len(data['t']) == 0:
+      print(f"{route}: no thermal")
+      return
+
+    results = sweep(run_hypothesis, data, hypotheses, args.processes)
+    print(route)
+    print("  off    dischg charge ->  shutdown after  predicted  charging changes  power used")
+    for (off, dischg, charge), r in zip(hypotheses, results):
+      shutdown = "never" if r['shutdownAfter'] is None else f"{r['shutdownAfter']:7.0f}s"
+      print(f"  {off:6.1f} {dischg:6.1f} {charge:6.1f} ->  {shutdown:>14}  {r['predictedAtOff']:8.0f}s  "
+            f"{r['chargingChanges']:16d}  {r['powerUsed'] / 1e6:8.3f} Wh")
+
+  for_each_route(args.route, sweep_route)
@@ -0,0 +1,56 @@
+"""Scaffolding shared by the debug sweeps: the command line, the list of routes, and a process
+pool that runs every hypothesis over one route."""
+
+import argparse
+import os
+import traceback
+from functools import partial
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+_ROUTE = None
+
+
+def _init_worker(route):
+  global _ROUTE
+  _ROUTE = route
+
+
+def _run(run_hypothesis, hypothesis):
+  return run_hypothesis(_ROUTE, hypothesis)
+
+
+def sweep(run_hypothesis, route, hypotheses, processes=None):
+  """Returns run_hypothesis(route, hypothesis) for every hypothesis. The route is sent to each
+  worker once, run_hypothesis has to be a module level function."""
+  with Pool(processes, initializer=_init_worker, initargs=(route,)) as pool:
+    return pool.map(partial(_run, run_hypothesis), hypotheses)
+
+
+def parse_floats(s):
+  return [float(v) for v in s.split(',')]
+
+
+def sweep_parser(description):
+  parser = argparse.ArgumentParser(description=description)
+  parser.add_argument('route', help='Log path or file with list of log paths')
+  parser.add_argument('--processes', type=int, default=None)
+  return parser
+
+
+def get_routes(route):
+  if os.path.exists(route) and not route.endswith('.bz2'):
+    return [r.strip() for r in open(route) if len(r.strip())]
+  return [route]
+
+
+def for_each_route(route, sweep_route):
+  """Calls sweep_route for each log path, printing the exceptions of a route instead of stopping."""
+  for r in tqdm(get_routes(route)):
+    try:
+      sweep_route(r)
+    except Exception:
+      traceback.print_exc()
+    except KeyboardInterrupt:
+      break
@@ -1,14 +1,20 @@
+import time
 import importlib
 from setproctitle import setproctitle  # pylint: disable=no-name-in-module
 
 import cereal.messaging as messaging
 import selfdrive.crash as crash
+from common.import_profiler import start_from_env, dump_to_env
 from selfdrive.swaglog import cloudlog
 
 def launcher(proc):
   try:
-    # import the process
+    # import the process, only the modules the zygote didn't preload are imported here
+    profiler = start_from_env()
+    t = time.monotonic()
     mod = importlib.import_module(proc)
+    cloudlog.event("process_import", proc=proc, import_time=round(time.monotonic() - t, 4))
+    dump_to_env(profiler, proc)
 
     # rename the process
     setproctitle(proc)
@@ -53,6 +53,8 @@ class Calibrator():
     self.param_put = param_put
     self.vp = copy.copy(VP_INIT)
     self.vps = np.zeros((INPUTS_WANTED, 2))
+    self.vps_sum = np.zeros(2)  # sum of self.vps[:self.valid_blocks]
+    self._intrinsics = None
     self.idx = 0
     self.block_idx = 0
     self.valid_blocks = 0
@@ -75,6 +77,7 @@ class Calibrator():
         self.valid_blocks = calibration_params['valid_blocks']
         if not np.isfinite(self.valid_blocks) or self.valid_blocks < 0:
           self.valid_blocks = 0
+        self.vps_sum = np.sum(self.vps[:self.valid_blocks], axis=0)
         self.update_status()
       except Exception:
         cloudlog.exception("CalibrationParams file found but error encountered")
@@ -94,36 +97,78 @@ class Calibrator():
   def handle_v_ego(self, v_ego):
     self.v_ego = v_ego
 
+  @property
+  def intrinsics(self):
+    # only changes when the vp moves
+    if self._intrinsics is None or (self._intrinsics[:2, 2] != self.vp).any():
+      self._intrinsics = intrinsics_from_vp(self.vp)
+    return self._intrinsics
+
+  def add_vp(self, new_vp):
+    old_vp = self.vps[self.block_idx].copy()
+    self.vps[self.block_idx] = (self.idx*old_vp + (BLOCK_SIZE - self.idx) * new_vp) / float(BLOCK_SIZE)
+    if self.block_idx < self.valid_blocks:
+      self.vps_sum += self.vps[self.block_idx] - old_vp
+
+    self.idx = (self.idx + 1) % BLOCK_SIZE
+    if self.idx == 0:
+      self.block_idx += 1
+      self.valid_blocks = max(self.block_idx, self.valid_blocks)
+      self.block_idx = self.block_idx % INPUTS_WANTED
+      # resum once per block so the running sum doesn't drift
+      self.vps_sum = np.sum(self.vps[:self.valid_blocks], axis=0)
+    if self.valid_blocks > 0:
+      self.vp = self.vps_sum / min(self.valid_blocks, INPUTS_WANTED)
+    self.update_status()
+
+  def write_params(self):
+    calib = get_calib_from_vp(self.vp)
+    cal_params = {"calib_radians": list(calib),
+                  "valid_blocks": self.valid_blocks}
+    put_nonblocking("CalibrationParams", json.dumps(cal_params).encode('utf8'))
+
   def handle_cam_odom(self, trans, rot, trans_std, rot_std):
     straight_and_fast = ((self.v_ego > MIN_SPEED_FILTER) and (trans[0] > MIN_SPEED_FILTER) and (abs(rot[2]) < MAX_YAW_RATE_FILTER))
     certain_if_calib = ((np.arctan2(trans_std[1], trans[0]) < MAX_VEL_ANGLE_STD) or
                         (self.valid_blocks < INPUTS_NEEDED))
     if straight_and_fast and certain_if_calib:
       # intrinsics are not eon intrinsics, since this is calibrated frame
-      intrinsics = intrinsics_from_vp(self.vp)
-      new_vp = intrinsics.dot(view_frame_from_device_frame.dot(trans))
+      new_vp = self.intrinsics.dot(view_frame_from_device_frame.dot(trans))
       new_vp = new_vp[:2]/new_vp[2]
       new_vp = sanity_clip(new_vp)
-
-      self.vps[self.block_idx] = (self.idx*self.vps[self.block_idx] + (BLOCK_SIZE - self.idx) * new_vp) / float(BLOCK_SIZE)
-      self.idx = (self.idx + 1) % BLOCK_SIZE
-      if self.idx == 0:
-        self.block_idx += 1
-        self.valid_blocks = max(self.block_idx, self.valid_blocks)
-        self.block_idx = self.block_idx % INPUTS_WANTED
-      if self.valid_blocks > 0:
-        self.vp = np.mean(self.vps[:self.valid_blocks], axis=0)
-      self.update_status()
+      self.add_vp(new_vp)
 
       if self.param_put and ((self.idx == 0 and self.block_idx == 0) or self.just_calibrated):
-        calib = get_calib_from_vp(self.vp)
-        cal_params = {"calib_radians": list(calib),
-                      "valid_blocks": self.valid_blocks}
-        put_nonblocking("CalibrationParams", json.dumps(cal_params).encode('utf8'))
+        self.write_params()
       return new_vp
     else:
       return None
 
+  def handle_cam_odom_many(self, v_ego, trans, rot, trans_std, rot_std):
+    """Batched handle_cam_odom for replaying recorded cameraOdometry. v_ego is the
+    carState speed at each frame. Returns the new vp per frame, nan where the frame
+    was rejected. CalibrationParams is written once at the end."""
+    trans, rot, trans_std = np.atleast_2d(trans), np.atleast_2d(rot), np.atleast_2d(trans_std)
+    v_ego = np.broadcast_to(v_ego, (len(trans),))
+
+    straight_and_fast = (v_ego > MIN_SPEED_FILTER) & (trans[:, 0] > MIN_SPEED_FILTER) & (np.abs(rot[:, 2]) < MAX_YAW_RATE_FILTER)
+    certain = np.arctan2(trans_std[:, 1], trans[:, 0]) < MAX_VEL_ANGLE_STD
+
+    # intrinsics.dot(v)[:2] / v[2] == FOCAL * v[:2] / v[2] + vp
+    view_trans = trans.dot(view_frame_from_device_frame.T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      vp_offsets = FOCAL * view_trans[:, :2] / view_trans[:, 2:]
+
+    new_vps = np.full((len(trans), 2), np.nan)
+    for i in np.nonzero(straight_and_fast)[0]:
+      if certain[i] or self.valid_blocks < INPUTS_NEEDED:
+        new_vps[i] = sanity_clip(self.vp + vp_offsets[i])
+        self.add_vp(new_vps[i])
+
+    if self.param_put:
+      self.write_params()
+    return new_vps
+
   def send_data(self, pm):
     calib = get_calib_from_vp(self.vp)
     extrinsic_matrix = get_view_frame_from_road_frame(0, calib[1], calib[2], model_height)
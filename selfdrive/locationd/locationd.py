@@ -1,6 +1,5 @@
 #!/usr/bin/env python3
 import numpy as np
-import sympy as sp
 
 import cereal.messaging as messaging
 import common.transformations.coordinates as coord
@@ -17,9 +16,6 @@ from selfdrive.swaglog import cloudlog
 #from datetime import datetime
 #from laika.gps_time import GPSTime
 
-from sympy.utilities.lambdify import lambdify
-from rednose.helpers.sympy_helpers import euler_rotate
-
 
 VISION_DECIMATION = 2
 SENSOR_DECIMATION = 10
@@ -29,22 +25,6 @@ def to_float(arr):
   return [float(arr[0]), float(arr[1]), float(arr[2])]
 
 
-def get_H():
-  # this returns a function to eval the jacobian
-  # of the observation function of the local vel
-  roll = sp.Symbol('roll')
-  pitch = sp.Symbol('pitch')
-  yaw = sp.Symbol('yaw')
-  vx = sp.Symbol('vx')
-  vy = sp.Symbol('vy')
-  vz = sp.Symbol('vz')
-
-  h = euler_rotate(roll, pitch, yaw).T*(sp.Matrix([vx, vy, vz]))
-  H = h.jacobian(sp.Matrix([roll, pitch, yaw, vx, vy, vz]))
-  H_f = lambdify([roll, pitch, yaw, vx, vy, vz], H)
-  return H_f
-
-
 class Localizer():
   def __init__(self, disabled_logs=None, dog=None):
     if disabled_logs is None:
@@ -58,7 +38,7 @@ class Localizer():
     self.device_from_calib = np.eye(3)
     self.calib_from_device = np.eye(3)
     self.calibrated = 0
-    self.H = get_H()
+    self.H = self.kf.H_vel_device
 
     self.posenet_invalid_count = 0
     self.posenet_speed = 0
@@ -98,7 +78,7 @@ class Localizer():
     idxs = list(range(States.ECEF_ORIENTATION_ERR.start, States.ECEF_ORIENTATION_ERR.stop)) + \
            list(range(States.ECEF_VELOCITY_ERR.start, States.ECEF_VELOCITY_ERR.stop))
     condensed_cov = predicted_cov[idxs][:, idxs]
-    HH = H(*list(np.concatenate([device_from_ecef_eul, vel_ecef])))
+    HH = H(np.concatenate([device_from_ecef_eul, vel_ecef]))
     vel_device_cov = HH.dot(condensed_cov).dot(HH.T)
     vel_device_std = np.sqrt(np.diagonal(vel_device_cov))
 
@@ -4,12 +4,14 @@ import sys
 from typing import Any, Dict
 
 import numpy as np
-import sympy as sp
 
+from common.lazy_import import lazy_import
 from rednose import KalmanFilter
 from rednose.helpers.ekf_sym import EKF_sym, gen_code
 from selfdrive.locationd.models.constants import ObservationKind
 
+sp = lazy_import('sympy')
+
 i = 0
 
 
@@ -69,12 +71,12 @@ class CarKalman(KalmanFilter):
   }
 
   global_vars = [
-    sp.Symbol('mass'),
-    sp.Symbol('rotational_inertia'),
-    sp.Symbol('center_to_front'),
-    sp.Symbol('center_to_rear'),
-    sp.Symbol('stiffness_front'),
-    sp.Symbol('stiffness_rear'),
+    'mass',
+    'rotational_inertia',
+    'center_to_front',
+    'center_to_rear',
+    'stiffness_front',
+    'stiffness_rear',
   ]
 
   @staticmethod
@@ -83,7 +85,8 @@ class CarKalman(KalmanFilter):
     name = CarKalman.name
 
     # globals
-    m, j, aF, aR, cF_orig, cR_orig = CarKalman.global_vars
+    global_vars = [sp.Symbol(var) for var in CarKalman.global_vars]
+    m, j, aF, aR, cF_orig, cR_orig = global_vars
 
     # make functions and jacobians with sympy
     # state variables
@@ -137,7 +140,7 @@ class CarKalman(KalmanFilter):
       [sp.Matrix([x]), ObservationKind.STIFFNESS, None],
     ]
 
-    gen_code(generated_dir, name, f_sym, dt, state_sym, obs_eqs, dim_state, dim_state, global_vars=CarKalman.global_vars)
+    gen_code(generated_dir, name, f_sym, dt, state_sym, obs_eqs, dim_state, dim_state, global_vars=global_vars)
 
   def __init__(self, generated_dir, steer_ratio=15, stiffness_factor=1, angle_offset=0):  # pylint: disable=super-init-not-called
     dim_state = self.initial_x.shape[0]
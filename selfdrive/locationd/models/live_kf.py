@@ -3,11 +3,13 @@
 import sys
 
 import numpy as np
-import sympy as sp
 
+from common.lazy_import import lazy_import
 from selfdrive.locationd.models.constants import ObservationKind
+from rednose.helpers import load_code
 from rednose.helpers.ekf_sym import EKF_sym, gen_code
-from rednose.helpers.sympy_helpers import euler_rotate, quat_matrix_r, quat_rotate
+
+sp = lazy_import('sympy')
 
 EARTH_GM = 3.986005e14  # m^3/s^2 (gravitational constant * mass of earth)
 
@@ -67,6 +69,8 @@ class LiveKalman():
 
   @staticmethod
   def generate_code(generated_dir):
+    from rednose.helpers.sympy_helpers import euler_rotate, quat_matrix_r, quat_rotate
+
     name = LiveKalman.name
     dim_state = LiveKalman.initial_x.shape[0]
     dim_state_err = LiveKalman.initial_P_diag.shape[0]
@@ -189,7 +193,17 @@ class LiveKalman():
                [h_phone_rot_sym, ObservationKind.CAMERA_ODO_ROTATION, None],
                [h_imu_frame_sym, ObservationKind.IMU_FRAME, None]]
 
-    gen_code(generated_dir, name, f_sym, dt, state_sym, obs_eqs, dim_state, dim_state_err, eskf_params)
+    # jacobian of the device frame velocity w.r.t. the ecef
+    # orientation (euler) and ecef velocity, used by locationd
+    # to propagate the velocity covariance into the device frame
+    eul_vel_sym = sp.MatrixSymbol('eul_vel', 6, 1)
+    eul_vel = sp.Matrix(eul_vel_sym)
+    h_vel_device = euler_rotate(*eul_vel[:3, 0]).T * eul_vel[3:, :]
+    H_vel_device = h_vel_device.jacobian(eul_vel)
+    extra_routines = [('H_vel_device', H_vel_device, [eul_vel_sym])]
+
+    gen_code(generated_dir, name, f_sym, dt, state_sym, obs_eqs, dim_state, dim_state_err, eskf_params,
+             extra_routines=extra_routines)
 
   def __init__(self, generated_dir):
     self.dim_state = self.initial_x.shape[0]
@@ -208,6 +222,17 @@ class LiveKalman():
     # init filter
     self.filter = EKF_sym(generated_dir, self.name, self.Q, self.initial_x, np.diag(self.initial_P_diag), self.dim_state, self.dim_state_err)
 
+    # precompiled jacobian of the device frame velocity
+    ffi, lib = load_code(generated_dir, self.name)
+
+    def H_vel_device(eul_vel):
+      eul_vel = np.ascontiguousarray(eul_vel, dtype=np.float64)
+      out = np.zeros((3, 6), dtype=np.float64)
+      lib.H_vel_device(ffi.cast("double *", eul_vel.ctypes.data),
+                       ffi.cast("double *", out.ctypes.data))
+      return out
+    self.H_vel_device = H_vel_device
+
   @property
   def x(self):
     return self.filter.state()
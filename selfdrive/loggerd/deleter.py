@@ -1,35 +1,120 @@
 #!/usr/bin/env python3
 import os
+import time
 import shutil
 import threading
 from selfdrive.swaglog import cloudlog
-from selfdrive.loggerd.config import ROOT, get_available_bytes, get_available_percent
-from selfdrive.loggerd.uploader import listdir_by_creation
+from selfdrive.loggerd.config import ROOT
+from selfdrive.loggerd.uploader import UploadIndex, UPLOAD_ATTR_NAME
+from common.xattr import getxattr
 
 MIN_BYTES = 5 * 1024 * 1024 * 1024
 MIN_PERCENT = 10
 
 
-def deleter_thread(exit_event):
-  while not exit_event.is_set():
-    out_of_bytes = get_available_bytes(default=MIN_BYTES + 1) < MIN_BYTES
-    out_of_percent = get_available_percent(default=MIN_PERCENT + 1) < MIN_PERCENT
+def get_bytes_to_free(root=ROOT):
+  try:
+    statvfs = os.statvfs(root)
+  except OSError:
+    return 0
 
-    if out_of_percent or out_of_bytes:
-      # remove the earliest directory we can
-      dirs = listdir_by_creation(ROOT)
-      for delete_dir in dirs:
-        delete_path = os.path.join(ROOT, delete_dir)
+  available_bytes = statvfs.f_bavail * statvfs.f_frsize
+  min_percent_bytes = statvfs.f_blocks * statvfs.f_frsize * MIN_PERCENT / 100.
+  return max(0, MIN_BYTES - available_bytes, int(min_percent_bytes - available_bytes))
 
-        if any(name.endswith(".lock") for name in os.listdir(delete_path)):
-          continue
 
+def segment_size(path):
+  size = 0
+  try:
+    with os.scandir(path) as it:
+      for entry in it:
         try:
-          cloudlog.info("deleting %s" % delete_path)
-          shutil.rmtree(delete_path)
-          break
+          size += entry.stat(follow_symlinks=False).st_size
         except OSError:
-          cloudlog.exception("issue deleting %s" % delete_path)
+          pass
+  except OSError:
+    pass
+  return size
+
+
+class Deleter():
+  def __init__(self, root=ROOT, use_inotify=True):
+    self.root = root
+    self.index = UploadIndex(root, use_inotify=use_inotify)
+    self.sizes = {}  # final segments don't change size
+
+  def qlog_uploaded(self, seg):
+    # upload state only ever goes from not uploaded to uploaded, the uploader sets it
+    uploaded = seg.files.get("qlog.bz2")
+    if uploaded is False:
+      try:
+        uploaded = getxattr(os.path.join(self.root, seg.logname, "qlog.bz2"), UPLOAD_ATTR_NAME) is not None
+      except OSError:
+        uploaded = True
+      seg.files["qlog.bz2"] = uploaded
+    return bool(uploaded)
+
+  def eviction_key(self, seg):
+    """Segments whose qlog has been uploaded are deleted first, even a fresh one
+    before older segments whose qlog hasn't been. Then oldest first."""
+    return (not self.qlog_uploaded(seg), seg.sort_key)
+
+  def eviction_batch(self, bytes_to_free):
+    """Unlocked segments in eviction_key order with enough bytes in total."""
+    self.sizes = {logname: size for logname, size in self.sizes.items() if logname in self.index.segments}
+
+    candidates = []
+    for seg in self.index.segments.values():
+      if len(seg.locks):
+        continue
+      if seg.logname not in self.sizes:
+        self.sizes[seg.logname] = segment_size(os.path.join(self.root, seg.logname))
+      candidates.append((self.eviction_key(seg), seg.logname))
+    candidates.sort()
+
+    batch = []
+    batch_bytes = 0
+    for _, logname in candidates:
+      if batch_bytes >= bytes_to_free:
+        break
+      batch.append(logname)
+      batch_bytes += self.sizes[logname]
+    return batch
+
+  def delete(self, bytes_to_free):
+    self.index.update()
+    batch = self.eviction_batch(bytes_to_free)
+
+    t = time.monotonic()
+    freed = 0
+    deleted = 0
+    for logname in batch:
+      delete_path = os.path.join(self.root, logname)
+      size = self.sizes.pop(logname)
+      try:
+        cloudlog.info("deleting %s" % delete_path)
+        shutil.rmtree(delete_path)
+        self.index.drop_segment(logname)
+        freed += size
+        deleted += 1
+      except OSError:
+        cloudlog.exception("issue deleting %s" % delete_path)
+
+    dt = time.monotonic() - t
+    if deleted:
+      cloudlog.event("deleter_freed", segments=deleted, bytes_to_free=bytes_to_free, bytes_freed=freed,
+                     bytes_per_sec=freed / max(dt, 1e-3))
+    return freed
+
+
+def deleter_thread(exit_event):
+  deleter = Deleter()
+  while not exit_event.is_set():
+    bytes_to_free = get_bytes_to_free()
+
+    if bytes_to_free > 0:
+      # remove as many of the earliest segments as it takes in one go
+      deleter.delete(bytes_to_free)
       exit_event.wait(.1)
     else:
       exit_event.wait(30)
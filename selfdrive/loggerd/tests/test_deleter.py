@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+from common.xattr import setxattr
+from selfdrive.loggerd.deleter import Deleter
+from selfdrive.loggerd.uploader import UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+
+ROUTE = "2020-01-01--10-00-00"
+
+
+class TestDeleter(unittest.TestCase):
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.root)
+
+  def make_segment(self, segment, size=1000, qlog_uploaded=False, locked=False):
+    logname = "%s--%d" % (ROUTE, segment)
+    path = os.path.join(self.root, logname)
+    os.mkdir(path)
+    with open(os.path.join(path, "qlog.bz2"), "wb") as f:
+      f.write(b"\x00" * 100)
+    with open(os.path.join(path, "rlog.bz2"), "wb") as f:
+      f.write(b"\x00" * (size - 100))
+    if qlog_uploaded:
+      setxattr(os.path.join(path, "qlog.bz2"), UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+    if locked:
+      open(os.path.join(path, "rlog.bz2.lock"), "w").close()
+    return logname
+
+  def deleter(self):
+    deleter = Deleter(self.root, use_inotify=False)
+    deleter.index.update()
+    return deleter
+
+  def test_eviction_key(self):
+    old = self.make_segment(2)
+    older_uploaded = self.make_segment(3, qlog_uploaded=True)
+    fresh_uploaded = self.make_segment(10, qlog_uploaded=True)
+    oldest = self.make_segment(1)
+
+    deleter = self.deleter()
+    order = sorted(deleter.index.segments.values(), key=deleter.eviction_key)
+    # uploaded qlogs first, even a fresh segment's, then by age with segments sorting by number
+    self.assertEqual([seg.logname for seg in order], [older_uploaded, fresh_uploaded, oldest, old])
+
+  def test_batch(self):
+    sizes = {0: 3000, 1: 1000, 2: 2000, 3: 1000}
+    lognames = [self.make_segment(segment, size) for segment, size in sizes.items()]
+    locked = self.make_segment(4, locked=True)
+
+    deleter = self.deleter()
+    self.assertEqual(deleter.eviction_batch(0), [])
+    self.assertEqual(deleter.eviction_batch(1), lognames[:1])
+    self.assertEqual(deleter.eviction_batch(3000), lognames[:1])
+    self.assertEqual(deleter.eviction_batch(3001), lognames[:2])
+    self.assertEqual(deleter.eviction_batch(5500), lognames[:3])
+    # locked segments are never in a batch
+    self.assertEqual(deleter.eviction_batch(10**9), lognames)
+    self.assertNotIn(locked, deleter.eviction_batch(10**9))
+
+  def test_delete(self):
+    sizes = {0: 3000, 1: 1000, 2: 2000, 3: 1000}
+    lognames = [self.make_segment(segment, size) for segment, size in sizes.items()]
+
+    # one pass frees enough bytes over several segments
+    deleter = self.deleter()
+    self.assertEqual(deleter.delete(3500), 4000)
+    self.assertEqual(sorted(os.listdir(self.root)), lognames[2:])
+    self.assertEqual(sorted(deleter.index.segments), lognames[2:])
+
+    # segments that are gone already don't count
+    shutil.rmtree(os.path.join(self.root, lognames[2]))
+    self.assertEqual(deleter.delete(1), 1000)
+    self.assertEqual(os.listdir(self.root), [])
+    self.assertEqual(deleter.delete(1), 0)
+
+
+if __name__ == "__main__":
+  unittest.main()
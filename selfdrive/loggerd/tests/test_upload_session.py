@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import os
+import time
+import base64
+import shutil
+import tempfile
+import unittest
+from urllib.parse import urlsplit, parse_qs
+
+from selfdrive.loggerd.upload_session import UploadSession, TokenBucket, load_progress
+
+URL = "https://blob.example.com/container/2020-01-01--10-00-00--0/rlog.bz2?sig=abc"
+BLOCK_HEADERS = {'x-ms-blob-type': 'BlockBlob', 'x-ms-version': '2019-02-02'}
+
+
+class FakeResponse():
+  def __init__(self, status_code):
+    self.status_code = status_code
+
+
+class FakeSession():
+  """The put of a requests.Session against a block blob store. fail_at is the number of block
+  puts that succeed before every put fails."""
+  def __init__(self, fail_at=None, blocklist_status=201):
+    self.fail_at = fail_at
+    self.blocklist_status = blocklist_status
+    self.blocks = {}
+    self.committed = None
+    self.block_puts = []
+
+  def put(self, url, data=None, headers=None, timeout=None):
+    dat = data.read() if hasattr(data, 'read') else data
+    query = parse_qs(urlsplit(url).query)
+    if headers is not None and 'Content-Length' in headers:
+      assert int(headers['Content-Length']) == len(dat)
+
+    if query.get('comp') == ['block']:
+      if self.fail_at is not None and len(self.block_puts) >= self.fail_at:
+        return FakeResponse(500)
+      self.block_puts.append(int(base64.b64decode(query['blockid'][0])))
+      self.blocks[query['blockid'][0]] = dat
+      return FakeResponse(201)
+
+    if query.get('comp') == ['blocklist']:
+      if self.blocklist_status in (200, 201):
+        block_ids = [b.split('</Latest>')[0] for b in dat.decode().split('<Latest>')[1:]]
+        self.committed = b''.join(self.blocks[b] for b in block_ids)
+      return FakeResponse(self.blocklist_status)
+
+    self.committed = dat
+    return FakeResponse(201)
+
+
+class TestUploadSession(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.fn = os.path.join(self.tmp, "rlog.bz2")
+    self.write(os.urandom(35))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def write(self, dat):
+    self.dat = dat
+    with open(self.fn, "wb") as f:
+      f.write(dat)
+
+  def upload(self, fake, headers=BLOCK_HEADERS):
+    session = UploadSession(chunk_size=10)
+    session.session = fake
+    return session.put(self.fn, URL, headers).status_code
+
+  def test_single_put(self):
+    fake = FakeSession()
+    self.assertEqual(self.upload(fake, {'x-ms-blob-type': 'AppendBlob'}), 201)
+    self.assertEqual(fake.committed, self.dat)
+    self.assertEqual(fake.block_puts, [])
+
+  def test_blocks(self):
+    fake = FakeSession()
+    self.assertEqual(self.upload(fake), 201)
+    self.assertEqual(fake.block_puts, [0, 1, 2, 3])
+    self.assertEqual(fake.committed, self.dat)
+    self.assertIsNone(load_progress(self.fn))
+
+  def test_resume(self):
+    fake = FakeSession(fail_at=2)
+    self.assertEqual(self.upload(fake), 500)
+    self.assertIsNone(fake.committed)
+    self.assertEqual(load_progress(self.fn)['blocks'], 2)
+
+    # only the blocks that didn't make it are sent again
+    fake.fail_at = None
+    self.assertEqual(self.upload(fake), 201)
+    self.assertEqual(fake.block_puts, [0, 1, 2, 3])
+    self.assertEqual(fake.committed, self.dat)
+    self.assertIsNone(load_progress(self.fn))
+
+  def test_stale_checkpoint(self):
+    for change in ["size", "mtime", "dest"]:
+      with self.subTest(change=change):
+        fake = FakeSession(fail_at=2)
+        self.assertEqual(self.upload(fake), 500)
+        self.assertEqual(load_progress(self.fn)['blocks'], 2)
+
+        url = URL
+        if change == "size":
+          self.write(os.urandom(42))
+        elif change == "mtime":
+          # same size, rewritten after the checkpoint
+          self.write(os.urandom(35))
+          st = os.stat(self.fn)
+          os.utime(self.fn, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        else:
+          url = URL.replace("--0/", "--1/")
+
+        fake.fail_at = None
+        session = UploadSession(chunk_size=10)
+        session.session = fake
+        self.assertEqual(session.put(self.fn, url, BLOCK_HEADERS).status_code, 201)
+        # started over from the first block
+        self.assertEqual(fake.block_puts[2:], list(range((len(self.dat) + 9) // 10)))
+        self.assertEqual(fake.committed, self.dat)
+
+  def test_rejected_block_list(self):
+    fake = FakeSession(blocklist_status=400)
+    self.assertEqual(self.upload(fake), 400)
+    # the blocks may have expired, the next attempt starts over
+    self.assertIsNone(load_progress(self.fn))
+    fake.blocklist_status = 201
+    self.assertEqual(self.upload(fake), 201)
+    self.assertEqual(fake.block_puts, [0, 1, 2, 3] * 2)
+    self.assertEqual(fake.committed, self.dat)
+
+
+class TestTokenBucket(unittest.TestCase):
+  def test_rate(self):
+    rate, burst = 100000, 10000
+    bucket = TokenBucket(rate, burst)
+    t = time.monotonic()
+    for _ in range(60):
+      bucket.consume(1000)
+    # the burst goes out right away, the rest at the rate
+    expected = (60 * 1000 - burst) / rate
+    self.assertGreater(time.monotonic() - t, expected * 0.9)
+    self.assertLess(time.monotonic() - t, expected * 1.5)
+
+  def test_unlimited(self):
+    bucket = TokenBucket(1000, 1000)
+    bucket.set_rate(None)
+    t = time.monotonic()
+    bucket.consume(10**9)
+    self.assertLess(time.monotonic() - t, 0.1)
+
+  def test_throttled_upload(self):
+    rate = 50000
+    tmp = tempfile.mkdtemp()
+    try:
+      fn = os.path.join(tmp, "qlog.bz2")
+      dat = os.urandom(40000)
+      with open(fn, "wb") as f:
+        f.write(dat)
+
+      fake = FakeSession()
+      session = UploadSession(bandwidth_limit=rate, chunk_size=8192)
+      session.bucket.tokens = 0
+      session.session = fake
+      t = time.monotonic()
+      self.assertEqual(session.put(fn, URL, BLOCK_HEADERS).status_code, 201)
+      self.assertGreater(time.monotonic() - t, 0.9 * len(dat) / rate)
+      self.assertEqual(fake.committed, dat)
+    finally:
+      shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+  unittest.main()
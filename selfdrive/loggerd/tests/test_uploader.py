@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from common.inotify import Inotify, IN_CREATE, IN_DELETE, IN_ISDIR
+from common.xattr import setxattr
+import cereal.messaging as messaging
+import selfdrive.loggerd.uploader as uploader
+from selfdrive.loggerd.uploader import UploadIndex, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE, NETWORK_STATE_GRACE, \
+                                      NETWORK_STATE_MAX_AGE, NetworkType, is_on_wifi
+
+UPLOAD_CLASS = {"qlog.bz2": 0, "rlog.bz2": 1}
+ROUTE = "2020-01-01--10-00-00"
+
+
+def get_upload_class(name):
+  return UPLOAD_CLASS.get(name, 2)
+
+
+def get_upload_sort(name):
+  return 0
+
+
+class TestInotify(unittest.TestCase):
+  def test_events(self):
+    root = tempfile.mkdtemp()
+    inotify = Inotify()
+    try:
+      wd = inotify.add_watch(root, IN_CREATE | IN_DELETE)
+      self.assertEqual(inotify.read(), [])
+
+      open(os.path.join(root, "file"), "w").close()
+      os.mkdir(os.path.join(root, "dir"))
+      os.unlink(os.path.join(root, "file"))
+      events = [(ev.wd, ev.mask, ev.name) for ev in inotify.read()]
+      self.assertEqual(events, [(wd, IN_CREATE, "file"), (wd, IN_CREATE | IN_ISDIR, "dir"), (wd, IN_DELETE, "file")])
+    finally:
+      inotify.close()
+      shutil.rmtree(root)
+
+
+class TestNetworkState(unittest.TestCase):
+  def network_state(self, network_type, ts):
+    msg = messaging.new_message('networkState')
+    msg.networkState.networkType = network_type
+    msg.networkState.typeTs = int(ts * 1e9)
+    return msg.networkState
+
+  def test_is_on_wifi(self):
+    start, now = 100., 1000.
+    self.assertTrue(is_on_wifi(self.network_state(NetworkType.wifi, now - 1), start, now))
+    self.assertTrue(is_on_wifi(self.network_state(NetworkType.ethernet, now - 1), start, now))
+    self.assertFalse(is_on_wifi(self.network_state(NetworkType.cell4G, now - 1), start, now))
+    self.assertFalse(is_on_wifi(self.network_state(NetworkType.none, now - 1), start, now))
+
+  def test_stale(self):
+    # networkd stopped publishing, or died, while on wifi
+    start, now = 100., 1000.
+    self.assertTrue(is_on_wifi(self.network_state(NetworkType.wifi, now - NETWORK_STATE_MAX_AGE + 1), start, now))
+    self.assertFalse(is_on_wifi(self.network_state(NetworkType.wifi, now - NETWORK_STATE_MAX_AGE - 1), start, now))
+
+  def test_missing(self):
+    # only wifi while networkd may still be starting
+    start = 100.
+    self.assertTrue(is_on_wifi(None, start, start))
+    self.assertTrue(is_on_wifi(None, start, start + NETWORK_STATE_GRACE - 1))
+    self.assertFalse(is_on_wifi(None, start, start + NETWORK_STATE_GRACE + 1))
+
+
+class TestUploadIndex(unittest.TestCase):
+  use_inotify = True
+
+  def setUp(self):
+    self.root = tempfile.mkdtemp()
+    self.index = UploadIndex(self.root, get_upload_class, get_upload_sort, use_inotify=self.use_inotify)
+    self.assertEqual(self.index.inotify is not None, self.use_inotify)
+    # seeded with an empty root, what follows is picked up as it's created
+    self.index.update()
+
+  def tearDown(self):
+    if self.index.inotify is not None:
+      self.index.inotify.close()
+    shutil.rmtree(self.root)
+
+  def make_segment(self, segment, names=("qlog.bz2", "rlog.bz2"), uploaded=()):
+    path = os.path.join(self.root, "%s--%d" % (ROUTE, segment))
+    os.mkdir(path)
+    for name in names:
+      with open(os.path.join(path, name), "wb") as f:
+        f.write(b"\x00")
+      if name in uploaded:
+        setxattr(os.path.join(path, name), UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
+    return path
+
+  def next_file(self, max_class=2):
+    self.index.update()
+    d = self.index.next_file(max_class)
+    return d[0] if d is not None else None
+
+  def upload_all(self, max_class=2):
+    keys = []
+    while True:
+      key = self.next_file(max_class)
+      if key is None:
+        return keys
+      keys.append(key)
+      self.index.set_uploaded(key)
+
+  def test_order(self):
+    # segments sort by number, not by name
+    for segment in [10, 2, 0, 1]:
+      self.make_segment(segment, ["rlog.bz2", "qlog.bz2", "fcamera.hevc"])
+
+    keys = self.upload_all()
+    expected = ["%s--%d/%s" % (ROUTE, segment, name) for name in ["qlog.bz2", "rlog.bz2", "fcamera.hevc"] for segment in [0, 1, 2, 10]]
+    self.assertEqual(keys, expected)
+
+  def test_max_class(self):
+    self.make_segment(0)
+    self.assertEqual(self.upload_all(0), ["%s--0/qlog.bz2" % ROUTE])
+    self.assertEqual(self.upload_all(), ["%s--0/rlog.bz2" % ROUTE])
+
+  def test_locks(self):
+    path = self.make_segment(0, ["qlog.bz2", "qlog.bz2.lock"])
+    self.assertIsNone(self.next_file())
+
+    # loggerd adds the rlog to the segment it's still writing
+    open(os.path.join(path, "rlog.bz2.lock"), "w").close()
+    open(os.path.join(path, "rlog.bz2"), "w").close()
+    os.unlink(os.path.join(path, "qlog.bz2.lock"))
+    self.assertIsNone(self.next_file())
+
+    os.unlink(os.path.join(path, "rlog.bz2.lock"))
+    self.assertEqual(self.upload_all(), ["%s--0/qlog.bz2" % ROUTE, "%s--0/rlog.bz2" % ROUTE])
+
+    # a locked segment doesn't hold back the others
+    self.make_segment(1, ["qlog.bz2", "qlog.bz2.lock"])
+    self.make_segment(2, ["qlog.bz2"])
+    self.assertEqual(self.upload_all(), ["%s--2/qlog.bz2" % ROUTE])
+
+  def test_set_uploaded(self):
+    self.make_segment(0, uploaded=["qlog.bz2"])
+    self.make_segment(1)
+
+    key = "%s--1/qlog.bz2" % ROUTE
+    self.assertEqual(self.next_file(), key)
+    self.assertEqual(self.next_file(), key)
+    self.index.set_uploaded(key)
+    self.assertEqual(self.upload_all(), ["%s--0/rlog.bz2" % ROUTE, "%s--1/rlog.bz2" % ROUTE])
+
+    # skipped while in flight
+    self.make_segment(2)
+    key = "%s--2/qlog.bz2" % ROUTE
+    self.index.update()
+    self.assertEqual(self.index.next_file(2, skip={key})[0], "%s--2/rlog.bz2" % ROUTE)
+
+  def test_rmtree(self):
+    for segment in range(3):
+      self.make_segment(segment)
+    self.assertEqual(self.next_file(), "%s--0/qlog.bz2" % ROUTE)
+
+    # the deleter removes segments, also ones that are pending
+    shutil.rmtree(os.path.join(self.root, "%s--0" % ROUTE))
+    shutil.rmtree(os.path.join(self.root, "%s--2" % ROUTE))
+    self.assertEqual(self.upload_all(), ["%s--1/qlog.bz2" % ROUTE, "%s--1/rlog.bz2" % ROUTE])
+    self.assertEqual(list(self.index.segments), ["%s--1" % ROUTE])
+    self.assertEqual(self.index.newest, "%s--1" % ROUTE)
+
+    # and the same segment can come back
+    self.make_segment(2, ["qlog.bz2"])
+    self.assertEqual(self.upload_all(), ["%s--2/qlog.bz2" % ROUTE])
+
+
+class TestUploadIndexRescan(TestUploadIndex):
+  use_inotify = False
+
+
+class TestUploadIndexNoInotify(TestUploadIndex):
+  """inotify is unavailable, the index falls back to rescanning."""
+  use_inotify = False
+
+  def setUp(self):
+    with mock.patch.object(uploader, "Inotify", side_effect=OSError(24, "Too many open files")):
+      self.root = tempfile.mkdtemp()
+      self.index = UploadIndex(self.root, get_upload_class, get_upload_sort, use_inotify=True)
+    self.assertIsNone(self.index.inotify)
+    self.index.update()
+
+
+if __name__ == "__main__":
+  unittest.main()
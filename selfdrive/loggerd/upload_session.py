@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import base64
+import threading
+from urllib.parse import urlsplit, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.xattr import getxattr, setxattr, removexattr
+from selfdrive.swaglog import cloudlog
+
+PROGRESS_ATTR_NAME = 'user.upload_progress'
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_TIMEOUT = 10
+
+
+class TokenBucket():
+  """Limits the combined rate of all readers, in bytes per second. A rate of None is unlimited."""
+
+  def __init__(self, rate=None, burst=256 * 1024):
+    self.lock = threading.Lock()
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.last = time.monotonic()
+
+  def set_rate(self, rate):
+    with self.lock:
+      self.rate = rate
+
+  def consume(self, n):
+    with self.lock:
+      now = time.monotonic()
+      if self.rate is None:
+        self.tokens = self.burst
+        self.last = now
+        return
+      self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate) - n
+      self.last = now
+      # go into debt, the next reader waits for it to be paid off
+      wait = -self.tokens / self.rate if self.tokens < 0 else 0.
+    if wait > 0:
+      time.sleep(wait)
+
+
+class ThrottledFile():
+  """Read-only view of length bytes of f starting at offset. len() gives
+  requests the Content-Length, reads are paced by the bucket."""
+
+  def __init__(self, f, offset, length, bucket):
+    self.f = f
+    self.offset = offset
+    self.length = length
+    self.pos = 0
+    self.bucket = bucket
+
+  def __len__(self):
+    return self.length - self.pos
+
+  def read(self, size=-1):
+    remaining = self.length - self.pos
+    if size is None or size < 0 or size > remaining:
+      size = remaining
+    if size == 0:
+      return b''
+    dat = os.pread(self.f.fileno(), size, self.offset + self.pos)
+    self.pos += len(dat)
+    self.bucket.consume(len(dat))
+    return dat
+
+
+def block_id(idx):
+  # all block ids of a blob must have the same length
+  return base64.b64encode(b"%08d" % idx).decode()
+
+
+def block_url(url, params):
+  return url + ('&' if urlsplit(url).query else '?') + urlencode(params)
+
+
+class UploadSession():
+  """Pooled HTTP connections shared by all uploads of a process, with a bandwidth limit.
+
+  Block blobs larger than one chunk are sent as separate blocks and committed at the end,
+  the number of blocks sent is checkpointed in an xattr so an interrupted upload resumes
+  from the last complete block. Other destinations get a single (throttled) PUT."""
+
+  def __init__(self, concurrency=1, bandwidth_limit=None, chunk_size=UPLOAD_CHUNK_SIZE, timeout=UPLOAD_TIMEOUT):
+    self.chunk_size = chunk_size
+    self.timeout = timeout
+    self.bucket = TokenBucket(bandwidth_limit)
+
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency)
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+
+  def set_bandwidth_limit(self, limit):
+    self.bucket.set_rate(limit)
+
+  def put(self, fn, url, headers):
+    with open(fn, "rb") as f:
+      st = os.fstat(f.fileno())
+      if headers.get('x-ms-blob-type') == 'BlockBlob' and st.st_size > self.chunk_size:
+        return self.put_blocks(f, fn, st, url, headers)
+
+      return self.session.put(url, data=ThrottledFile(f, 0, st.st_size, self.bucket),
+                              headers={**headers, 'Content-Length': str(st.st_size)}, timeout=self.timeout)
+
+  def put_blocks(self, f, fn, st, url, headers):
+    checkpoint = {'dest': urlsplit(url).path, 'size': st.st_size, 'mtime': st.st_mtime, 'blocks': 0}
+    progress = load_progress(fn)
+    if progress is not None and all(progress.get(k) == checkpoint[k] for k in ('dest', 'size', 'mtime')):
+      checkpoint['blocks'] = progress['blocks']
+      cloudlog.event("upload_resume", fn=fn, blocks=checkpoint['blocks'])
+
+    block_headers = {k: v for k, v in headers.items() if k.lower() != 'x-ms-blob-type'}
+    n_blocks = (st.st_size + self.chunk_size - 1) // self.chunk_size
+    for idx in range(checkpoint['blocks'], n_blocks):
+      offset = idx * self.chunk_size
+      length = min(self.chunk_size, st.st_size - offset)
+      resp = self.session.put(block_url(url, {'comp': 'block', 'blockid': block_id(idx)}),
+                              data=ThrottledFile(f, offset, length, self.bucket),
+                              headers={**block_headers, 'Content-Length': str(length)}, timeout=self.timeout)
+      if resp.status_code not in (200, 201):
+        return resp
+
+      checkpoint['blocks'] = idx + 1
+      save_progress(fn, checkpoint)
+
+    block_list = ''.join(f"<Latest>{block_id(idx)}</Latest>" for idx in range(n_blocks))
+    body = f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>'.encode()
+    resp = self.session.put(block_url(url, {'comp': 'blocklist'}), data=body, timeout=self.timeout)
+
+    # uncommitted blocks expire server side, start over if the block list is rejected
+    if resp.status_code in (200, 201, 400):
+      clear_progress(fn)
+    return resp
+
+
+def load_progress(fn):
+  try:
+    progress = getxattr(fn, PROGRESS_ATTR_NAME, size=256)
+    return json.loads(progress) if progress is not None else None
+  except (OSError, ValueError):
+    return None
+
+
+def save_progress(fn, checkpoint):
+  try:
+    setxattr(fn, PROGRESS_ATTR_NAME, json.dumps(checkpoint).encode())
+  except OSError:
+    cloudlog.exception("upload: saving progress failed")
+
+
+def clear_progress(fn):
+  try:
+    removexattr(fn, PROGRESS_ATTR_NAME)
+  except OSError:
+    pass
@@ -1,29 +1,37 @@
 #!/usr/bin/env python3
 import os
-import re
 import time
 import json
+import queue
 import random
 import ctypes
+import heapq
 import inspect
-import requests
 import traceback
 import threading
-import subprocess
 
+import cereal.messaging as messaging
+from cereal import log
 from selfdrive.swaglog import cloudlog
 from selfdrive.loggerd.config import ROOT
+from selfdrive.loggerd.upload_session import UploadSession
 
-from common import android
 from common.params import Params
 from common.api import Api
+from common.realtime import sec_since_boot
 from common.xattr import getxattr, setxattr
+from common.inotify import Inotify, IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVED_FROM, IN_MOVED_TO, \
+                           IN_MOVE_SELF, IN_ONLYDIR, IN_ISDIR, IN_IGNORED, IN_Q_OVERFLOW
 
 UPLOAD_ATTR_NAME = 'user.upload'
 UPLOAD_ATTR_VALUE = b'1'
 
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "2"))
+
 fake_upload = os.getenv("FAKEUPLOAD") is not None
 
+NetworkType = log.ThermalData.NetworkType
+
 def raise_on_thread(t, exctype):
   '''Raises an exception in the threads with id tid'''
   for ctid, tobj in threading._active.items():
@@ -68,169 +76,366 @@ def clear_locks(root):
     except OSError:
       cloudlog.exception("clear_locks failed")
 
-def is_on_wifi():
-  # ConnectivityManager.getActiveNetworkInfo()
-  try:
-    # TODO: figure out why the android service call sometimes dies with SIGUSR2 (signal from MSGQ)
-    result = android.parse_service_call_string(android.service_call(["connectivity", "2"]))
-    if result is None:
-      return True
-    return 'WIFI' in result
-  except Exception:
-    cloudlog.exception("is_on_wifi failed")
+# networkd refreshes the network type at least every 10s
+NETWORK_STATE_MAX_AGE = 60.  # s
+# how long a network networkd hasn't published yet is treated as wifi after the uploader starts
+NETWORK_STATE_GRACE = 60.  # s
+
+# network_state is the latest networkState from networkd, None until it publishes one
+def is_on_wifi(network_state, start_time, now):
+  if network_state is None:
+    # an unknown network is treated as wifi, like when the connectivity service call had no result,
+    # but not for good when networkd doesn't come up
+    return now - start_time < NETWORK_STATE_GRACE
+  if now - network_state.typeTs * 1e-9 > NETWORK_STATE_MAX_AGE:
+    # networkd stopped refreshing it
     return False
+  return network_state.networkType in (NetworkType.wifi, NetworkType.ethernet)
 
-def is_on_hotspot():
+def get_bandwidth_limit(params):
+  # set by thermald, bytes per second
   try:
-    result = subprocess.check_output(["ifconfig", "wlan0"], stderr=subprocess.STDOUT, encoding='utf8')
-    result = re.findall(r"inet addr:((\d+\.){3}\d+)", result)[0][0]
+    limit = int(params.get("UploadBandwidthLimit") or 0)
+  except ValueError:
+    limit = 0
+  return limit if limit > 0 else None
+
+def is_on_hotspot(network_state):
+  return network_state is not None and network_state.isHotspot
+
+ROOT_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+SEGMENT_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+class UploadSegment():
+  def __init__(self, logname):
+    self.logname = logname
+    self.sort_key = tuple(get_directory_sort(logname))
+    self.files = {}  # name -> uploaded
+    self.locks = set()
+    self.wd = None
+
+class UploadIndex():
+  """Files under root waiting to be uploaded, in a heap ordered by file class
+  and then by segment age.
+
+  The index is seeded with one scan of root. After that it follows root and the
+  segments loggerd is still writing with inotify, a segment is final once its
+  last lock file is gone. Without inotify root is rescanned on every update.
+  Upload state is kept in memory, the xattr is only read the first time a file is seen.
+  Without get_upload_class nothing is queued and the index only tracks segments."""
+
+  def __init__(self, root, get_upload_class=None, get_upload_sort=None, use_inotify=True):
+    self.root = root
+    self.get_upload_class = get_upload_class
+    self.get_upload_sort = get_upload_sort
+
+    self.segments = {}
+    self.newest = None
+    self.heap = []
+    self.seeded = False
+
+    self.inotify = None
+    self.root_wd = None
+    self.wds = {}
+    self.polled = set()  # locked segments we couldn't watch
+    if use_inotify:
+      try:
+        self.inotify = Inotify()
+      except OSError:
+        cloudlog.exception("uploader inotify unavailable, falling back to rescanning")
 
-    is_android = result.startswith('192.168.43.')
-    is_ios = result.startswith('172.20.10.')
-    is_entune = result.startswith('10.0.2.')
+  def update(self):
+    if self.inotify is None or not self.seeded:
+      self.rescan()
+      return
 
-    return (is_android or is_ios or is_entune)
-  except Exception:
-    return False
+    for ev in self.inotify.read():
+      if ev.mask & IN_Q_OVERFLOW:
+        cloudlog.event("uploader_inotify_overflow")
+        self.rescan()
+        return
 
-class Uploader():
-  def __init__(self, dongle_id, root):
-    self.dongle_id = dongle_id
-    self.api = Api(dongle_id)
-    self.root = root
+      if ev.mask & IN_IGNORED:
+        logname = self.wds.pop(ev.wd, None)
+        if logname is None and ev.wd == self.root_wd:
+          # root itself went away, start over once it's back
+          self.root_wd = None
+          self.seeded = False
+        elif logname in self.segments and self.segments[logname].wd == ev.wd:
+          self.segments[logname].wd = None
+        continue
 
-    self.upload_thread = None
+      if ev.wd == self.root_wd:
+        if not ev.mask & IN_ISDIR:
+          continue
+        if ev.mask & (IN_CREATE | IN_MOVED_TO):
+          self.scan_segment(ev.name)
+        elif ev.mask & (IN_DELETE | IN_MOVED_FROM):
+          self.drop_segment(ev.name)
+        continue
 
-    self.last_resp = None
-    self.last_exc = None
+      logname = self.wds.get(ev.wd)
+      seg = self.segments.get(logname)
+      if seg is None or ev.mask & IN_ISDIR or len(ev.name) == 0:
+        continue
+      if ev.mask & (IN_CREATE | IN_MOVED_TO):
+        self.add_file(seg, ev.name)
+      elif ev.mask & (IN_DELETE | IN_MOVED_FROM):
+        self.remove_file(seg, ev.name)
 
-    self.immediate_priority = {"qlog.bz2": 0, "qcamera.ts": 1}
-    self.high_priority = {"rlog.bz2": 0, "fcamera.hevc": 1, "dcamera.hevc": 2}
+    for logname in list(self.polled):
+      self.scan_segment(logname)
 
-  def get_upload_sort(self, name):
-    if name in self.immediate_priority:
-      return self.immediate_priority[name]
-    if name in self.high_priority:
-      return self.high_priority[name] + 100
-    return 1000
+  def rescan(self):
+    if self.inotify is not None and self.root_wd is None:
+      try:
+        self.root_wd = self.inotify.add_watch(self.root, ROOT_WATCH_MASK)
+      except OSError:
+        pass
+
+    try:
+      lognames = set(os.listdir(self.root))
+    except OSError:
+      return
+
+    for logname in list(self.segments):
+      if logname not in lognames:
+        self.drop_segment(logname)
+    for logname in sorted(lognames, key=get_directory_sort):
+      self.scan_segment(logname)
+
+    self.seeded = self.inotify is None or self.root_wd is not None
+
+  def scan_segment(self, logname):
+    seg = self.segments.get(logname)
+    if seg is None:
+      seg = UploadSegment(logname)
+      if self.inotify is not None and not self.watch(seg):
+        return
+
+    # the watch is in place before listing, so nothing created in between is missed
+    path = os.path.join(self.root, logname)
+    try:
+      names = set(os.listdir(path))
+    except OSError:
+      self.unwatch(seg)
+      return
+
+    if logname not in self.segments:
+      self.segments[logname] = seg
+      if self.newest is None or seg.sort_key > self.segments[self.newest].sort_key:
+        previous, self.newest = self.newest, logname
+        if previous is not None:
+          self.maybe_unwatch(self.segments[previous])
+
+    for name in list(seg.files):
+      if name not in names:
+        self.remove_file(seg, name)
+    seg.locks &= names
+    for name in names:
+      self.add_file(seg, name)
+    self.maybe_unwatch(seg)
+
+  def drop_segment(self, logname):
+    self.polled.discard(logname)
+    seg = self.segments.pop(logname, None)
+    if seg is None:
+      return
+    self.unwatch(seg)
+    if logname == self.newest:
+      self.newest = max(self.segments, key=lambda l: self.segments[l].sort_key) if len(self.segments) else None
+
+  def watch(self, seg):
+    try:
+      seg.wd = self.inotify.add_watch(os.path.join(self.root, seg.logname), SEGMENT_WATCH_MASK)
+      self.wds[seg.wd] = seg.logname
+    except (FileNotFoundError, NotADirectoryError):
+      return False
+    except OSError:
+      # out of watches, poll this segment until it's final
+      cloudlog.exception("uploader add_watch failed")
+      self.polled.add(seg.logname)
+    return True
 
-  def gen_upload_files(self):
-    if not os.path.isdir(self.root):
+  def unwatch(self, seg):
+    if seg.wd is None:
       return
-    for logname in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logname)
+    wd, seg.wd = seg.wd, None
+    if self.wds.get(wd) == seg.logname:
       try:
-        names = os.listdir(path)
+        self.inotify.rm_watch(wd)
       except OSError:
+        pass
+
+  def maybe_unwatch(self, seg):
+    # loggerd doesn't come back to a segment it has moved on from
+    if len(seg.locks) == 0 and seg.logname != self.newest:
+      self.unwatch(seg)
+      self.polled.discard(seg.logname)
+
+  def add_file(self, seg, name):
+    if name.endswith(".lock"):
+      seg.locks.add(name)
+      return
+    if name.endswith(".tmp") or name in seg.files:
+      return
+
+    fn = os.path.join(self.root, seg.logname, name)
+    try:
+      is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) is not None
+    except OSError:
+      cloudlog.event("uploader_getxattr_failed", key=os.path.join(seg.logname, name), fn=fn)
+      is_uploaded = True  # deleter could have deleted
+
+    seg.files[name] = is_uploaded
+    if not is_uploaded and self.get_upload_class is not None:
+      heapq.heappush(self.heap, (self.get_upload_class(name), seg.sort_key, self.get_upload_sort(name), name, seg.logname))
+
+  def remove_file(self, seg, name):
+    if name.endswith(".lock"):
+      seg.locks.discard(name)
+      self.maybe_unwatch(seg)
+    else:
+      seg.files.pop(name, None)
+
+  def set_uploaded(self, key, uploaded=True):
+    logname, name = os.path.split(key)
+    seg = self.segments.get(logname)
+    if seg is not None and name in seg.files:
+      seg.files[name] = uploaded
+
+  def discard(self, key):
+    logname, name = os.path.split(key)
+    seg = self.segments.get(logname)
+    if seg is not None:
+      seg.files.pop(name, None)
+
+  def next_file(self, max_class, skip=()):
+    """Oldest pending file of the highest priority class up to max_class, skipping
+    locked segments and the keys in skip."""
+    ret = None
+    locked = []
+    while len(self.heap):
+      upload_class, _, _, name, logname = self.heap[0]
+      seg = self.segments.get(logname)
+      if seg is None or seg.files.get(name, True):
+        heapq.heappop(self.heap)  # uploaded or gone
         continue
-      if any(name.endswith(".lock") for name in names):
+      if upload_class > max_class:
+        break
+      key = os.path.join(logname, name)
+      if len(seg.locks) or key in skip:
+        locked.append(heapq.heappop(self.heap))
         continue
+      ret = (key, os.path.join(self.root, logname, name))
+      break
 
-      for name in sorted(names, key=self.get_upload_sort):
-        key = os.path.join(logname, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME)
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", exc=self.last_exc, key=key, fn=fn)
-          is_uploaded = True  # deleter could have deleted
-        if is_uploaded:
-          continue
+    for entry in locked:
+      heapq.heappush(self.heap, entry)
+    return ret
+
+class Uploader():
+  def __init__(self, dongle_id, root, use_inotify=True, concurrency=1):
+    self.dongle_id = dongle_id
+    self.api = Api(dongle_id)
+    self.root = root
+    self.session = UploadSession(concurrency)
+
+    self.immediate_priority = {"qlog.bz2": 0, "qcamera.ts": 1}
+    self.high_priority = {"rlog.bz2": 0, "fcamera.hevc": 1, "dcamera.hevc": 2}
 
-        yield (name, key, fn)
+    self.index = UploadIndex(root, self.get_upload_class, self.get_upload_sort, use_inotify=use_inotify)
+    self.index_lock = threading.Lock()
 
-  def next_file_to_upload(self, with_raw):
-    upload_files = list(self.gen_upload_files())
-    # try to upload qlog files first
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return (key, fn)
+  def get_upload_class(self, name):
+    if name in self.immediate_priority:
+      return 0
+    if name in self.high_priority:
+      return 1
+    return 2
 
-    if with_raw:
-      # then upload the full log files, rear and front camera files
-      for name, key, fn in upload_files:
-        if name in self.high_priority:
-          return (key, fn)
+  def get_upload_sort(self, name):
+    if name in self.immediate_priority:
+      return self.immediate_priority[name]
+    if name in self.high_priority:
+      return self.high_priority[name] + 100
+    return 1000
 
-      # then upload other files
-      for name, key, fn in upload_files:
-        if not name.endswith('.lock') and not name.endswith(".tmp"):
-          return (key, fn)
+  def next_file_to_upload(self, with_raw, skip=()):
+    with self.index_lock:
+      self.index.update()
+      # qlog files first, then the full log files, rear and front camera files, then everything else
+      return self.index.next_file(2 if with_raw else 0, skip)
 
-    return None
+  def set_bandwidth_limit(self, limit):
+    self.session.set_bandwidth_limit(limit)
 
   def do_upload(self, key, fn):
-    try:
-      url_resp = self.api.get("v1.3/"+self.dongle_id+"/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
-      if url_resp.status_code == 412:
-        self.last_resp = url_resp
-        return
+    url_resp = self.api.get("v1.3/"+self.dongle_id+"/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
+    if url_resp.status_code == 412:
+      return url_resp
 
-      url_resp_json = json.loads(url_resp.text)
-      url = url_resp_json['url']
-      headers = url_resp_json['headers']
-      cloudlog.info("upload_url v1.3 %s %s", url, str(headers))
+    url_resp_json = json.loads(url_resp.text)
+    url = url_resp_json['url']
+    headers = url_resp_json['headers']
+    cloudlog.info("upload_url v1.3 %s %s", url, str(headers))
 
-      if fake_upload:
-        cloudlog.info("*** WARNING, THIS IS A FAKE UPLOAD TO %s ***" % url)
+    if fake_upload:
+      cloudlog.info("*** WARNING, THIS IS A FAKE UPLOAD TO %s ***" % url)
 
-        class FakeResponse():
-          def __init__(self):
-            self.status_code = 200
+      class FakeResponse():
+        def __init__(self):
+          self.status_code = 200
 
-        self.last_resp = FakeResponse()
-      else:
-        with open(fn, "rb") as f:
-          self.last_resp = requests.put(url, data=f, headers=headers, timeout=10)
-    except Exception as e:
-      self.last_exc = (e, traceback.format_exc())
-      raise
+      return FakeResponse()
+    return self.session.put(fn, url, headers)
 
   def normal_upload(self, key, fn):
-    self.last_resp = None
-    self.last_exc = None
-
     try:
-      self.do_upload(key, fn)
-    except Exception:
-      pass
-
-    return self.last_resp
+      return self.do_upload(key, fn), None
+    except Exception as e:
+      return None, (e, traceback.format_exc())
 
   def upload(self, key, fn):
     try:
       sz = os.path.getsize(fn)
     except OSError:
       cloudlog.exception("upload: getsize failed")
+      with self.index_lock:
+        self.index.discard(key)
       return False
 
     cloudlog.event("upload", key=key, fn=fn, sz=sz)
 
     cloudlog.info("checking %r with size %r", key, sz)
 
+    exc = None
     if sz == 0:
       try:
         # tag files of 0 size as uploaded
         setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
       except OSError:
-        cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
+        cloudlog.event("uploader_setxattr_failed", exc=exc, key=key, fn=fn, sz=sz)
       success = True
     else:
       cloudlog.info("uploading %r", fn)
-      stat = self.normal_upload(key, fn)
+      stat, exc = self.normal_upload(key, fn)
       if stat is not None and stat.status_code in (200, 201, 412):
         cloudlog.event("upload_success" if stat.status_code != 412 else "upload_ignored", key=key, fn=fn, sz=sz)
         try:
           # tag file as uploaded
           setxattr(fn, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE)
         except OSError:
-          cloudlog.event("uploader_setxattr_failed", exc=self.last_exc, key=key, fn=fn, sz=sz)
+          cloudlog.event("uploader_setxattr_failed", exc=exc, key=key, fn=fn, sz=sz)
         success = True
       else:
-        cloudlog.event("upload_failed", stat=stat, exc=self.last_exc, key=key, fn=fn, sz=sz)
+        cloudlog.event("upload_failed", stat=stat, exc=exc, key=key, fn=fn, sz=sz)
         success = False
 
+    if success:
+      with self.index_lock:
+        self.index.set_uploaded(key)
+
     return success
 
 def uploader_fn(exit_event):
@@ -243,29 +448,62 @@ def uploader_fn(exit_event):
     cloudlog.info("uploader missing dongle_id")
     raise Exception("uploader can't start without dongle id")
 
-  uploader = Uploader(dongle_id, ROOT)
+  uploader = Uploader(dongle_id, ROOT, concurrency=UPLOAD_CONCURRENCY)
+
+  uploading = set()
+  done: queue.Queue = queue.Queue()
+
+  network_state_sock = messaging.sub_sock('networkState', conflate=True)
+  network_state = None
+  start_time = sec_since_boot()
+
+  def upload_worker(key, fn):
+    try:
+      success = uploader.upload(key, fn)
+    except Exception:
+      cloudlog.exception("uploader.upload_worker.exception")
+      success = False
+    done.put((key, success))
 
   backoff = 0.1
   while True:
     allow_raw_upload = (params.get("IsUploadRawEnabled") != b"0")
-    on_hotspot = is_on_hotspot()
-    on_wifi = is_on_wifi()
+    msg = messaging.recv_sock(network_state_sock)
+    if msg is not None:
+      network_state = msg.networkState
+    on_hotspot = is_on_hotspot(network_state)
+    on_wifi = is_on_wifi(network_state, start_time, sec_since_boot())
     should_upload = on_wifi and not on_hotspot
+    uploader.set_bandwidth_limit(get_bandwidth_limit(params))
 
     if exit_event.is_set():
       return
 
-    d = uploader.next_file_to_upload(with_raw=allow_raw_upload and should_upload)
-    if d is None:  # Nothing to upload
+    d = None
+    if len(uploading) < UPLOAD_CONCURRENCY:
+      d = uploader.next_file_to_upload(with_raw=allow_raw_upload and should_upload, skip=uploading)
+
+    if d is not None:
+      key, fn = d
+
+      cloudlog.event("uploader_netcheck", is_on_hotspot=on_hotspot, is_on_wifi=on_wifi)
+      cloudlog.info("to upload %r", d)
+      uploading.add(key)
+      threading.Thread(target=upload_worker, args=(key, fn), daemon=True).start()
+      continue
+
+    if len(uploading) == 0:  # Nothing to upload
       offroad = params.get("IsOffroad") == b'1'
       time.sleep(60 if offroad else 5)
       continue
 
-    key, fn = d
+    # all slots busy or nothing else to start, wait for an upload to finish
+    try:
+      key, success = done.get(timeout=5)
+    except queue.Empty:
+      continue
 
-    cloudlog.event("uploader_netcheck", is_on_hotspot=on_hotspot, is_on_wifi=on_wifi)
-    cloudlog.info("to upload %r", d)
-    success = uploader.upload(key, fn)
+    uploading.discard(key)
     if success:
       backoff = 0.1
     else:
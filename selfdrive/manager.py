@@ -9,7 +9,8 @@ import shutil
 import subprocess
 import datetime
 import textwrap
-from typing import Dict, List
+import select
+from typing import Dict, List, Set, Union
 from selfdrive.swaglog import cloudlog, add_logentries_handler
 
 
@@ -77,7 +78,6 @@ else:
   from common.spinner import FakeSpinner as Spinner
   from common.text_window import FakeTextWindow as TextWindow
 
-import importlib
 import traceback
 from multiprocessing import Process
 
@@ -158,7 +158,7 @@ import selfdrive.crash as crash
 from selfdrive.registration import register
 from selfdrive.version import version, dirty
 from selfdrive.loggerd.config import ROOT
-from selfdrive.launcher import launcher
+from selfdrive.zygote import Zygote, ZygoteProcess, start_python_process
 from common import android
 from common.apk import update_apks, pm_apply_packages, start_offroad
 
@@ -167,6 +167,7 @@ ThermalStatus = cereal.log.ThermalData.ThermalStatus
 # comment out anything you don't want to run
 managed_processes = {
   "thermald": "selfdrive.thermald.thermald",
+  "networkd": "selfdrive.networkd",
   "uploader": "selfdrive.loggerd.uploader",
   "deleter": "selfdrive.loggerd.deleter",
   "controlsd": "selfdrive.controls.controlsd",
@@ -199,7 +200,20 @@ daemon_processes = {
   "manage_athenad": ("selfdrive.athena.manage_athenad", "AthenadPid"),
 }
 
-running: Dict[str, Process] = {}
+# imported by the zygote on top of the python managed processes
+zygote_preload_modules = [
+  'numpy',
+  'capnp',
+  'cereal.messaging',
+  'common.params',
+  'common.realtime',
+  'selfdrive.launcher',
+]
+
+# python processes are forked from the zygote once it's started
+zygote = None
+
+running: Dict[str, Union[Process, ZygoteProcess]] = {}
 def get_running():
   return running
 
@@ -217,6 +231,7 @@ green_temp_processes = ['uploader']
 
 persistent_processes = [
   'thermald',
+  'networkd',
   'logmessaged',
   'ui',
   'uploader',
@@ -258,6 +273,12 @@ if ANDROID:
     'dmonitoringmodeld',
   ]
 
+# started after, and stopped before, the processes they depend on
+process_dependencies = {
+  'plannerd': ['controlsd'],
+  'radard': ['controlsd'],
+}
+
 def register_managed_process(name, desc, car_started=False):
   global managed_processes, car_started_processes, persistent_processes
   print("registering %s" % name)
@@ -283,13 +304,13 @@ def start_managed_process(name):
   proc = managed_processes[name]
   if isinstance(proc, str):
     cloudlog.info("starting python %s" % proc)
-    running[name] = Process(name=name, target=launcher, args=(proc,))
+    running[name] = start_python_process(zygote, name, proc)
   else:
     pdir, pargs = proc
     cwd = os.path.join(BASEDIR, pdir)
     cloudlog.info("starting process %s" % name)
     running[name] = Process(name=name, target=nativelauncher, args=(pargs, cwd))
-  running[name].start()
+    running[name].start()
 
 def start_daemon_process(name):
   params = Params()
@@ -316,13 +337,24 @@ def start_daemon_process(name):
 
   params.put(pid_param, str(proc.pid))
 
+def start_zygote():
+  global zygote
+  if zygote is not None:
+    return
+  modules = zygote_preload_modules + [p for p in managed_processes.values() if isinstance(p, str)]
+  cloudlog.info("starting zygote, preloading %s" % modules)
+  zygote = Zygote(modules)
+
+def stop_zygote():
+  global zygote
+  if zygote is not None:
+    zygote.close()
+    zygote = None
+
 def prepare_managed_process(p):
   proc = managed_processes[p]
-  if isinstance(proc, str):
-    # import this python
-    cloudlog.info("preimporting %s" % proc)
-    importlib.import_module(proc)
-  elif os.path.isfile(os.path.join(BASEDIR, proc[0], "Makefile")):
+  # python processes are imported by the zygote
+  if not isinstance(proc, str) and os.path.isfile(os.path.join(BASEDIR, proc[0], "Makefile")):
     # build this process
     cloudlog.info("building %s" % (proc,))
     try:
@@ -334,34 +366,78 @@ def prepare_managed_process(p):
       subprocess.check_call(["make", "-j4"], cwd=os.path.join(BASEDIR, proc[0]))
 
 
-def join_process(process, timeout):
-  # Process().join(timeout) will hang due to a python 3 bug: https://bugs.python.org/issue28382
-  # We have to poll the exitcode instead
-  t = time.time()
-  while time.time() - t < timeout and process.exitcode is None:
-    time.sleep(0.001)
-
-
-def kill_managed_process(name):
-  if name not in running or name not in managed_processes:
-    return
-  cloudlog.info("killing %s" % name)
-
-  if running[name].exitcode is None:
-    if name in interrupt_processes:
-      os.kill(running[name].pid, signal.SIGINT)
-    elif name in kill_processes:
-      os.kill(running[name].pid, signal.SIGKILL)
-    else:
-      running[name].terminate()
-
-    join_process(running[name], 5)
+def process_sentinel(process):
+  # readable once the process exits, or for the zygote's processes once it has news about any of them
+  if isinstance(process, ZygoteProcess):
+    return process.zygote.sock
+  return process.sentinel
+
+
+def wait_processes(processes, timeout):
+  """Waits for all processes to exit without polling, returns the ones still alive after timeout."""
+  end = time.monotonic() + timeout
+  while True:
+    # the zygote's processes all get an exit code once it dies, so its closed socket isn't selected again
+    alive = [p for p in processes if p.exitcode is None]
+    remaining = end - time.monotonic()
+    if len(alive) == 0 or remaining <= 0:
+      return alive
+    select.select(list({process_sentinel(p) for p in alive}), [], [], remaining)
+
+
+def dependency_waves(names):
+  """Splits names into groups, each process comes in a later group than the processes it depends on."""
+  names = list(names)
+  waves: List[List[str]] = []
+  placed: Set[str] = set()
+  while len(placed) < len(names):
+    wave = [n for n in names if n not in placed and
+            all(d in placed or d not in names for d in process_dependencies.get(n, []))]
+    if len(wave) == 0:
+      wave = [n for n in names if n not in placed]
+    waves.append(wave)
+    placed.update(wave)
+  return waves
+
+
+def start_managed_processes(names):
+  """Starts names in dependency order."""
+  for wave in dependency_waves(n for n in names if n not in running and n in managed_processes):
+    for name in wave:
+      t = time.monotonic()
+      start_managed_process(name)
+      cloudlog.event("process_start", name=name, latency=round(time.monotonic() - t, 4))
+
+
+def stop_signal(name):
+  process = running[name]
+  if name in interrupt_processes:
+    os.kill(process.pid, signal.SIGINT)
+  elif name in kill_processes:
+    os.kill(process.pid, signal.SIGKILL)
+  else:
+    process.terminate()
+
+
+def kill_managed_processes(names):
+  """Stops names in parallel, the processes that depend on others first."""
+  names = [n for n in names if n in running and n in managed_processes]
+  for wave in reversed(dependency_waves(names)):
+    t = time.monotonic()
+    for name in wave:
+      cloudlog.info("killing %s" % name)
+      if running[name].exitcode is None:
+        stop_signal(name)
+
+    alive = wait_processes([running[n] for n in wave], 5)
+    for name in wave:
+      process = running[name]
+      if process not in alive:
+        continue
 
-    if running[name].exitcode is None:
       if name in unkillable_processes:
         cloudlog.critical("unkillable process %s failed to exit! rebooting in 15 if it doesn't die" % name)
-        join_process(running[name], 15)
-        if running[name].exitcode is None:
+        if process in wait_processes([process], 15):
           cloudlog.critical("unkillable process %s failed to die!" % name)
           if ANDROID:
             cloudlog.critical("FORCE REBOOTING PHONE!")
@@ -370,11 +446,18 @@ def kill_managed_process(name):
           raise RuntimeError
       else:
         cloudlog.info("killing %s with SIGKILL" % name)
-        os.kill(running[name].pid, signal.SIGKILL)
-        running[name].join()
+        os.kill(process.pid, signal.SIGKILL)
+        process.join()
 
-  cloudlog.info("%s is dead with %d" % (name, running[name].exitcode))
-  del running[name]
+    for name in wave:
+      cloudlog.info("%s is dead with %s" % (name, running[name].exitcode))
+      cloudlog.event("process_stop", name=name, exitcode=running[name].exitcode,
+                     latency=round(time.monotonic() - t, 4))
+      del running[name]
+
+
+def kill_managed_process(name):
+  kill_managed_processes([name])
 
 
 def cleanup_all_processes(signal, frame):
@@ -383,8 +466,8 @@ def cleanup_all_processes(signal, frame):
   if ANDROID:
     pm_apply_packages('disable')
 
-  for name in list(running.keys()):
-    kill_managed_process(name)
+  kill_managed_processes(list(running.keys()))
+  stop_zygote()
   cloudlog.info("everything is dead")
 
 # ****************** run loop ******************
@@ -472,32 +555,25 @@ def manager_thread():
 
   logger_dead = False
 
+  # processes the loop starts and stops, in start order
+  gated_processes = car_started_processes + [p for p in green_temp_processes if p in persistent_processes]
+
   while 1:
     msg = messaging.recv_sock(thermal_sock, wait=True)
 
+    desired = set()
+
     # heavyweight batch processes are gated on favorable thermal conditions
-    if msg.thermal.thermalStatus >= ThermalStatus.yellow:
-      for p in green_temp_processes:
-        if p in persistent_processes:
-          kill_managed_process(p)
-    else:
-      for p in green_temp_processes:
-        if p in persistent_processes:
-          start_managed_process(p)
+    if msg.thermal.thermalStatus < ThermalStatus.yellow:
+      desired.update(p for p in green_temp_processes if p in persistent_processes)
 
     if msg.thermal.freeSpace < 0.05:
       logger_dead = True
 
     if msg.thermal.started and "driverview" not in running:
-      for p in car_started_processes:
-        if p == "loggerd" and logger_dead:
-          kill_managed_process(p)
-        else:
-          start_managed_process(p)
+      desired.update(p for p in car_started_processes if not (p == "loggerd" and logger_dead))
     else:
       logger_dead = False
-      for p in reversed(car_started_processes):
-        kill_managed_process(p)
       # this is ugly
       if "driverview" not in running and params.get("IsDriverViewEnabled") == b"1":
         pass
@@ -505,6 +581,18 @@ def manager_thread():
       elif "driverview" in running and params.get("IsDriverViewEnabled") == b"0":
         kill_managed_process("driverview")
 
+    # only act on the processes whose state differs from the desired one
+    to_stop = [p for p in reversed(gated_processes) if p in running and p not in desired]
+    to_start = [p for p in gated_processes if p not in running and p in desired and p in managed_processes]
+    if len(to_stop):
+      t = time.monotonic()
+      kill_managed_processes(to_stop)
+      cloudlog.event("manager_stopped", processes=to_stop, latency=round(time.monotonic() - t, 4))
+    if len(to_start):
+      t = time.monotonic()
+      start_managed_processes(to_start)
+      cloudlog.event("manager_started", processes=to_start, latency=round(time.monotonic() - t, 4))
+
     # check the status of all processes, did any of them die?
     running_list = ["%s%s\u001b[0m" % ("\u001b[32m" if running[p].is_alive() else "\u001b[31m", p) for p in running]
     cloudlog.debug(' '.join(running_list))
@@ -525,6 +613,8 @@ def manager_prepare(spinner=None):
       spinner.update("%d" % ((100.0 - total) + total * (i + 1) / len(managed_processes),))
     prepare_managed_process(p)
 
+  start_zygote()
+
 def uninstall():
   cloudlog.warning("uninstalling")
   with open('/cache/recovery/command', 'w') as f:
@@ -53,11 +53,28 @@ MAX_TERMINAL_DURATION = 300  # 30s
 RESIZED_FOCAL = 320.0
 H, W, FULL_W = 320, 160, 426
 
+# driverState is reduced to a row of floats before it reaches DriverStatus, so logged
+# messages can be replayed from an array with the same code path
+POSE_FIELDS = ('pitch', 'yaw', 'roll', 'x', 'y', 'pitch_std', 'yaw_std', 'face_prob', 'left_blink', 'right_blink')
+
 class DistractedType():
   NOT_DISTRACTED = 0
   BAD_POSE = 1
   BAD_BLINK = 2
 
+def pose_row(driver_state):
+  """Returns the POSE_FIELDS of a driverState, or None if the model has no face pose."""
+  face_orientation = driver_state.faceOrientation
+  face_position = driver_state.facePosition
+  face_orientation_std = driver_state.faceOrientationStd
+  if len(face_orientation) == 0 or len(face_position) == 0 or len(face_orientation_std) == 0 or len(driver_state.facePositionStd) == 0:
+    return None
+
+  return (face_orientation[0], face_orientation[1], face_orientation[2], face_position[0], face_position[1],
+          face_orientation_std[0], face_orientation_std[1], driver_state.faceProb,
+          driver_state.leftBlinkProb * (driver_state.leftEyeProb > _EYE_THRESHOLD),
+          driver_state.rightBlinkProb * (driver_state.rightEyeProb > _EYE_THRESHOLD))
+
 def face_orientation_from_net(angles_desc, pos_desc, rpy_calib, is_rhd):
   # the output of these angles are in device frame
   # so from driver's perspective, pitch is up and yaw is right
@@ -99,7 +116,13 @@ class DriverBlink():
     self.cfactor = 1.
 
 class DriverStatus():
-  def __init__(self):
+  def __init__(self, distracted_time=_DISTRACTED_TIME, distracted_pre_time=_DISTRACTED_PRE_TIME_TILL_TERMINAL,
+               distracted_prompt_time=_DISTRACTED_PROMPT_TIME_TILL_TERMINAL, distracted_filter_ts=_DISTRACTED_FILTER_TS):
+    # the defaults are what runs in the car, the arguments are for replaying logs offline
+    self.distracted_step = DT_DMON / distracted_time
+    self.distracted_threshold_pre = distracted_pre_time / distracted_time
+    self.distracted_threshold_prompt = distracted_prompt_time / distracted_time
+
     self.pose = DriverPose()
     self.pose_calibrated = self.pose.pitch_offseter.filtered_stat.n > _POSE_OFFSET_MIN_COUNT and \
                             self.pose.yaw_offseter.filtered_stat.n > _POSE_OFFSET_MIN_COUNT
@@ -108,14 +131,14 @@ class DriverStatus():
     self.awareness_active = 1.
     self.awareness_passive = 1.
     self.driver_distracted = False
-    self.driver_distraction_filter = FirstOrderFilter(0., _DISTRACTED_FILTER_TS, DT_DMON)
+    self.driver_distraction_filter = FirstOrderFilter(0., distracted_filter_ts, DT_DMON)
     self.face_detected = False
     self.terminal_alert_cnt = 0
     self.terminal_time = 0
     self.step_change = 0.
     self.active_monitoring_mode = True
     self.hi_stds = 0
-    self.threshold_prompt = _DISTRACTED_PROMPT_TIME_TILL_TERMINAL / _DISTRACTED_TIME
+    self.threshold_prompt = self.distracted_threshold_prompt
 
     self.is_rhd_region = False
     self.is_rhd_region_checked = False
@@ -125,7 +148,7 @@ class DriverStatus():
   def _set_timers(self, active_monitoring):
     if self.active_monitoring_mode and self.awareness <= self.threshold_prompt:
       if active_monitoring:
-        self.step_change = DT_DMON / _DISTRACTED_TIME
+        self.step_change = self.distracted_step
       else:
         self.step_change = 0.
       return  # no exploit after orange alert
@@ -138,9 +161,9 @@ class DriverStatus():
         self.awareness_passive = self.awareness
         self.awareness = self.awareness_active
 
-      self.threshold_pre = _DISTRACTED_PRE_TIME_TILL_TERMINAL / _DISTRACTED_TIME
-      self.threshold_prompt = _DISTRACTED_PROMPT_TIME_TILL_TERMINAL / _DISTRACTED_TIME
-      self.step_change = DT_DMON / _DISTRACTED_TIME
+      self.threshold_pre = self.distracted_threshold_pre
+      self.threshold_prompt = self.distracted_threshold_prompt
+      self.step_change = self.distracted_step
       self.active_monitoring_mode = True
     else:
       if self.active_monitoring_mode:
@@ -174,46 +197,53 @@ class DriverStatus():
       return DistractedType.NOT_DISTRACTED
 
   def set_policy(self, model_data):
-    ep = min(model_data.meta.engagedProb, 0.8) / 0.8
+    self.set_engaged_prob(model_data.meta.engagedProb)
+
+  def set_engaged_prob(self, engaged_prob):
+    ep = min(engaged_prob, 0.8) / 0.8
     self.pose.cfactor = interp(ep, [0, 0.5, 1], [_METRIC_THRESHOLD_STRICT, _METRIC_THRESHOLD, _METRIC_THRESHOLD_SLACK])/_METRIC_THRESHOLD
     self.blink.cfactor = interp(ep, [0, 0.5, 1], [_BLINK_THRESHOLD_STRICT, _BLINK_THRESHOLD, _BLINK_THRESHOLD_SLACK])/_BLINK_THRESHOLD
 
   def get_pose(self, driver_state, cal_rpy, car_speed, op_engaged):
     # 10 Hz
-    if len(driver_state.faceOrientation) == 0 or len(driver_state.facePosition) == 0 or len(driver_state.faceOrientationStd) == 0 or len(driver_state.facePositionStd) == 0:
-      return
-
-    self.pose.roll, self.pose.pitch, self.pose.yaw = face_orientation_from_net(driver_state.faceOrientation, driver_state.facePosition, cal_rpy, self.is_rhd_region)
-    self.pose.pitch_std = driver_state.faceOrientationStd[0]
-    self.pose.yaw_std = driver_state.faceOrientationStd[1]
-    # self.pose.roll_std = driver_state.faceOrientationStd[2]
-    model_std_max = max(self.pose.pitch_std, self.pose.yaw_std)
-    self.pose.low_std = model_std_max < _POSESTD_THRESHOLD
-    self.blink.left_blink = driver_state.leftBlinkProb * (driver_state.leftEyeProb > _EYE_THRESHOLD)
-    self.blink.right_blink = driver_state.rightBlinkProb * (driver_state.rightEyeProb > _EYE_THRESHOLD)
-    self.face_detected = driver_state.faceProb > _FACE_THRESHOLD and \
-                          abs(driver_state.facePosition[0]) <= 0.4 and abs(driver_state.facePosition[1]) <= 0.45
-
-    self.driver_distracted = self._is_driver_distracted(self.pose, self.blink) > 0
+    row = pose_row(driver_state)
+    if row is not None:
+      self.update_pose(row, cal_rpy, car_speed, op_engaged)
+
+  def update_pose(self, row, cal_rpy, car_speed, op_engaged):
+    pitch_net, yaw_net, roll_net, face_x, face_y, pitch_std, yaw_std, face_prob, left_blink, right_blink = row
+    pose = self.pose
+
+    pose.roll, pose.pitch, pose.yaw = face_orientation_from_net((pitch_net, yaw_net, roll_net), (face_x, face_y), cal_rpy, self.is_rhd_region)
+    pose.pitch_std = pitch_std
+    pose.yaw_std = yaw_std
+    # pose.roll_std is not used
+    model_std_max = max(pitch_std, yaw_std)
+    pose.low_std = model_std_max < _POSESTD_THRESHOLD
+    self.blink.left_blink = left_blink
+    self.blink.right_blink = right_blink
+    self.face_detected = face_prob > _FACE_THRESHOLD and abs(face_x) <= 0.4 and abs(face_y) <= 0.45
+
+    self.driver_distracted = self._is_driver_distracted(pose, self.blink) > 0
     # first order filters
     self.driver_distraction_filter.update(self.driver_distracted)
 
     # update offseter
     # only update when driver is actively driving the car above a certain speed
-    if self.face_detected and car_speed > _POSE_CALIB_MIN_SPEED and self.pose.low_std and (not op_engaged or not self.driver_distracted):
-      self.pose.pitch_offseter.push_and_update(self.pose.pitch)
-      self.pose.yaw_offseter.push_and_update(self.pose.yaw)
+    if self.face_detected and car_speed > _POSE_CALIB_MIN_SPEED and pose.low_std and (not op_engaged or not self.driver_distracted):
+      pose.pitch_offseter.push_and_update(pose.pitch)
+      pose.yaw_offseter.push_and_update(pose.yaw)
 
-    self.pose_calibrated = self.pose.pitch_offseter.filtered_stat.n > _POSE_OFFSET_MIN_COUNT and \
-                            self.pose.yaw_offseter.filtered_stat.n > _POSE_OFFSET_MIN_COUNT
+    self.pose_calibrated = pose.pitch_offseter.filtered_stat.n > _POSE_OFFSET_MIN_COUNT and \
+                            pose.yaw_offseter.filtered_stat.n > _POSE_OFFSET_MIN_COUNT
 
     is_model_uncertain = self.hi_stds * DT_DMON > _HI_STD_FALLBACK_TIME
     self._set_timers(self.face_detected and not is_model_uncertain)
-    if self.face_detected and not self.pose.low_std:
+    if self.face_detected and not pose.low_std:
       if not is_model_uncertain:
         self.step_change *= max(0, (model_std_max-0.5)*(model_std_max-2))
       self.hi_stds += 1
-    elif self.face_detected and self.pose.low_std:
+    elif self.face_detected and pose.low_std:
       self.hi_stds = 0
 
   def update(self, events, driver_engaged, ctrl_active, standstill):
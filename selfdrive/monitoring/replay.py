@@ -0,0 +1,125 @@
+"""Runs logged driverState and carState through DriverStatus the same way dmonitoringd
+does, but from arrays and without messaging, to get the dMonitoringState timeline of a
+drive for a given set of _DISTRACTED_* settings."""
+import math
+import numpy as np
+
+from cereal import car
+from selfdrive.monitoring.driver_monitor import DriverStatus, MAX_TERMINAL_ALERTS, MAX_TERMINAL_DURATION, \
+                                                POSE_FIELDS, pose_row
+
+EventName = car.CarEvent.EventName
+
+CAR_STATE_FIELDS = ('vEgo', 'vCruise', 'cruiseEnabled', 'buttonEvents', 'steeringPressed', 'standstill')
+LOOP_TIME = 0.01  # dmonitoringd's sleep between SubMaster updates
+
+
+class EventList(list):
+  """Collects the names DriverStatus.update adds, without the bookkeeping of Events."""
+  def add(self, event_name, static=False):
+    self.append(event_name)
+
+
+def driver_state_row(driver_state):
+  """POSE_FIELDS of a driverState, NaN if the model has no face pose."""
+  row = pose_row(driver_state)
+  return row if row is not None else (math.nan,) * len(POSE_FIELDS)
+
+
+def car_state_row(car_state):
+  return (car_state.vEgo, car_state.cruiseState.speed, car_state.cruiseState.enabled,
+          len(car_state.buttonEvents), car_state.steeringPressed, car_state.standstill)
+
+
+def replay(dm_t, dm, cs_t, cs, model_t=None, engaged_prob=None, cal_rpy=(0., 0., 0.), is_rhd=False, **settings):
+  """dm has a row of POSE_FIELDS per driverState and cs a row of CAR_STATE_FIELDS per
+  carState, with their log times in dm_t and cs_t. model_t and engaged_prob optionally
+  give the model's engagedProb. cal_rpy is one calibration or one per driverState.
+  settings are passed to DriverStatus.
+
+  dmonitoringd only keeps standstill and cruise enabled from a carState in the loop that
+  received it and uses True for both otherwise. Replay can't know the loops, it takes a
+  carState logged less than LOOP_TIME before a driverState to be in the same loop.
+
+  Returns per driverState the awareness, distracted, face detected and step change
+  arrays, and the list of events dmonitoringd would have published."""
+  ds = DriverStatus(**settings)
+  ds.is_rhd_region = is_rhd
+  ds.is_rhd_region_checked = True
+
+  n = len(dm)
+  dm_t = np.asarray(dm_t, dtype=np.float64).tolist()
+  dm = np.asarray(dm, dtype=np.float64).reshape(n, len(POSE_FIELDS)).tolist()
+  cal_rpy = np.broadcast_to(np.asarray(cal_rpy, dtype=np.float64), (n, 3)).tolist()
+  cs_t = np.asarray(cs_t, dtype=np.float64).tolist()
+  cs = np.asarray(cs, dtype=np.float64).reshape(len(cs_t), len(CAR_STATE_FIELDS)).tolist()
+  if model_t is None:
+    model_t, engaged_prob = [], []
+  else:
+    model_t = np.asarray(model_t, dtype=np.float64).tolist()
+    engaged_prob = np.asarray(engaged_prob, dtype=np.float64).tolist()
+
+  awareness = np.empty(n)
+  distracted = np.empty(n, dtype=bool)
+  face_detected = np.empty(n, dtype=bool)
+  step_change = np.empty(n)
+  events = []
+
+  # same initial state as dmonitoringd
+  v_ego = 0.
+  v_cruise_last = 0.
+  driver_engaged = False
+  cs_standstill = cs_cruise_enabled = True
+  last_cs_t = None
+  cs_idx = 0
+  model_idx = 0
+
+  for i in range(n):
+    t = dm_t[i]
+
+    # dmonitoringd sees the carState and model updates of a loop before its driverState
+    while cs_idx < len(cs_t) and cs_t[cs_idx] <= t:
+      v_ego, v_cruise, cruise_enabled, button_events, steering_pressed, standstill = cs[cs_idx]
+      driver_engaged = button_events > 0 or v_cruise != v_cruise_last or steering_pressed > 0
+      cs_standstill = standstill > 0 or v_ego < 5
+      cs_cruise_enabled = cruise_enabled > 0 and v_ego > 30
+      if driver_engaged:
+        ds.update(EventList(), True, cs_cruise_enabled, cs_standstill)
+        ds.terminal_alert_cnt = 0
+        ds.terminal_time = 0
+      v_cruise_last = v_cruise
+      last_cs_t = cs_t[cs_idx]
+      cs_idx += 1
+
+    # reset every loop by dmonitoringd, only set in loops with a carState
+    if last_cs_t is not None and t - last_cs_t < LOOP_TIME:
+      standstill, cruise_enabled = cs_standstill, cs_cruise_enabled
+    else:
+      standstill, cruise_enabled = True, True
+
+    while model_idx < len(model_t) and model_t[model_idx] <= t:
+      ds.set_engaged_prob(engaged_prob[model_idx])
+      model_idx += 1
+
+    row = dm[i]
+    if not math.isnan(row[0]):
+      ds.update_pose(row, cal_rpy[i], v_ego, cruise_enabled)
+
+    msg_events = EventList()
+    if ds.terminal_alert_cnt >= MAX_TERMINAL_ALERTS or ds.terminal_time >= MAX_TERMINAL_DURATION:
+      msg_events.add(EventName.tooDistracted)
+    ds.update(msg_events, driver_engaged, cruise_enabled, standstill)
+
+    awareness[i] = ds.awareness
+    distracted[i] = ds.driver_distracted
+    face_detected[i] = ds.face_detected
+    step_change[i] = ds.step_change
+    events.append(msg_events)
+
+  return {
+    'awareness': awareness,
+    'isDistracted': distracted,
+    'faceDetected': face_detected,
+    'stepChange': step_change,
+    'events': events,
+  }
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""Publishes the network type, strength and whether it's a hotspot as networkState.
+
+Checking the network on android forks service and dumpsys, which used to block
+thermald's loop and the uploader. Here it runs on its own thread every 10s, or as
+soon as wlan0's address changes. On other Linux machines everything is read from
+/proc/net and /sys/class/net, cheap enough to do every second."""
+import os
+import socket
+import struct
+import fcntl
+import threading
+
+import cereal.messaging as messaging
+from cereal import log
+from common.android import ANDROID, get_network_type, get_network_strength
+from common.realtime import Ratekeeper, sec_since_boot
+from selfdrive.swaglog import cloudlog
+
+NetworkType = log.ThermalData.NetworkType
+NetworkStrength = log.ThermalData.NetworkStrength
+
+ANDROID_REFRESH_TIME = 10.  # s
+WIFI_IFACE = 'wlan0'
+
+SIOCGIFADDR = 0x8915
+RTF_UP = 0x1
+CELL_IFACE_PREFIXES = ('rmnet', 'wwan', 'ccmni')
+
+
+def default_route_iface(proc_net='/proc/net'):
+  """Interface of the lowest metric IPv4 default route that is up."""
+  best = None
+  try:
+    with open(os.path.join(proc_net, 'route')) as f:
+      next(f)
+      for line in f:
+        fields = line.split()
+        if len(fields) < 8:
+          continue
+        iface, dest, flags, metric, mask = fields[0], fields[1], int(fields[3], 16), int(fields[6]), fields[7]
+        if dest == '00000000' and mask == '00000000' and flags & RTF_UP and (best is None or metric < best[0]):
+          best = (metric, iface)
+  except (OSError, StopIteration, ValueError):
+    return None
+  return best[1] if best is not None else None
+
+
+def iface_network_type(iface, sys_net='/sys/class/net'):
+  if iface is None:
+    return NetworkType.none
+
+  path = os.path.join(sys_net, iface)
+  try:
+    with open(os.path.join(path, 'operstate')) as f:
+      if f.read().strip() == 'down':
+        return NetworkType.none
+  except OSError:
+    return NetworkType.none
+
+  if os.path.isdir(os.path.join(path, 'wireless')) or os.path.isdir(os.path.join(path, 'phy80211')):
+    return NetworkType.wifi
+  if iface.startswith(CELL_IFACE_PREFIXES):
+    # the generation isn't in sysfs
+    return NetworkType.cell4G
+  return NetworkType.ethernet
+
+
+def wifi_strength(iface, proc_net='/proc/net'):
+  """Signal level of iface from /proc/net/wireless, with the thresholds android uses."""
+  try:
+    with open(os.path.join(proc_net, 'wireless')) as f:
+      for line in f:
+        name, _, stats = line.partition(':')
+        if name.strip() != iface:
+          continue
+        level = float(stats.split()[2].rstrip('.'))
+        if level > 0:
+          level -= 256  # some drivers report unsigned dBm
+        if level >= -50:
+          return NetworkStrength.great
+        elif level >= -60:
+          return NetworkStrength.good
+        elif level >= -70:
+          return NetworkStrength.moderate
+        else:
+          return NetworkStrength.poor
+  except (OSError, IndexError, ValueError):
+    pass
+  return NetworkStrength.unknown
+
+
+def iface_ipv4(iface):
+  try:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+      ret = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack('256s', iface.encode()[:15]))
+    return socket.inet_ntoa(ret[20:24])
+  except OSError:
+    return None
+
+
+def is_hotspot_ip(ip):
+  if ip is None:
+    return False
+
+  is_android = ip.startswith('192.168.43.')
+  is_ios = ip.startswith('172.20.10.')
+  is_entune = ip.startswith('10.0.2.')
+  return is_android or is_ios or is_entune
+
+
+class NetworkMonitor():
+  def __init__(self, android=ANDROID, proc_net='/proc/net', sys_net='/sys/class/net'):
+    self.android = android
+    self.proc_net = proc_net
+    self.sys_net = sys_net
+
+    self.lock = threading.Lock()
+    self.network_type = NetworkType.none
+    self.network_strength = NetworkStrength.unknown
+    self.iface = None
+    self.ip = None
+    self.type_ts = 0
+    self.strength_ts = 0
+
+    self.refresh_event = threading.Event()
+    self.exit_event = threading.Event()
+    self.android_thread = None
+    if self.android:
+      self.android_thread = threading.Thread(target=self.android_refresh_thread, daemon=True)
+      self.android_thread.start()
+
+  def refresh(self):
+    """The cheap part of the refresh, the android service calls are done on their own thread."""
+    if self.android:
+      iface = WIFI_IFACE
+    else:
+      iface = default_route_iface(self.proc_net)
+    ip = iface_ipv4(iface) if iface is not None else None
+
+    with self.lock:
+      if self.android:
+        if ip != self.ip:
+          self.refresh_event.set()
+      else:
+        ts = int(sec_since_boot() * 1e9)
+        self.network_type = iface_network_type(iface, self.sys_net)
+        self.network_strength = wifi_strength(iface, self.proc_net) if self.network_type == NetworkType.wifi else NetworkStrength.unknown
+        self.type_ts = self.strength_ts = ts
+      self.iface = iface
+      self.ip = ip
+
+  def android_refresh_thread(self):
+    while not self.exit_event.is_set():
+      try:
+        network_type = get_network_type()
+        type_ts = int(sec_since_boot() * 1e9)
+        network_strength = get_network_strength(network_type)
+        strength_ts = int(sec_since_boot() * 1e9)
+        with self.lock:
+          self.network_type, self.type_ts = network_type, type_ts
+          self.network_strength, self.strength_ts = network_strength, strength_ts
+      except Exception:
+        cloudlog.exception("Error getting network status")
+
+      self.refresh_event.wait(ANDROID_REFRESH_TIME)
+      self.refresh_event.clear()
+
+  def fill(self, msg):
+    with self.lock:
+      msg.networkType = self.network_type
+      msg.networkStrength = self.network_strength
+      msg.isHotspot = is_hotspot_ip(self.ip)
+      msg.iface = self.iface or ""
+      msg.typeTs = self.type_ts
+      msg.strengthTs = self.strength_ts
+
+  def close(self):
+    self.exit_event.set()
+    self.refresh_event.set()
+
+
+def main():
+  pm = messaging.PubMaster(['networkState'])
+  monitor = NetworkMonitor()
+
+  rk = Ratekeeper(1., print_delay_threshold=None)
+  while True:
+    monitor.refresh()
+
+    msg = messaging.new_message('networkState')
+    monitor.fill(msg.networkState)
+    pm.send('networkState', msg)
+    rk.keep_time()
+
+
+if __name__ == "__main__":
+  main()
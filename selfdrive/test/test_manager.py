@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import os
+import sys
+import time
+import shutil
+import signal
+import tempfile
+import unittest
+from multiprocessing import Process
+from unittest import mock
+
+import selfdrive.manager as manager
+from selfdrive.zygote import Zygote, ZygoteProcess
+
+EXIT_PROC = "zygote_test_exit"
+SLEEP_PROC = "zygote_test_sleep"
+TEST_PROCS = {
+  EXIT_PROC: "import sys\ndef main():\n  sys.exit(3)\n",
+  SLEEP_PROC: "import time\ndef main():\n  time.sleep(60)\n",
+}
+
+
+def setUpModule():
+  global proc_dir
+  # trivial python processes for the zygote to fork
+  proc_dir = tempfile.mkdtemp()
+  for proc, code in TEST_PROCS.items():
+    with open(os.path.join(proc_dir, proc + ".py"), "w") as f:
+      f.write(code)
+  sys.path.insert(0, proc_dir)
+
+
+def tearDownModule():
+  sys.path.remove(proc_dir)
+  shutil.rmtree(proc_dir)
+
+
+class TestZygote(unittest.TestCase):
+  def setUp(self):
+    self.zygote = Zygote(list(TEST_PROCS))
+
+  def tearDown(self):
+    self.zygote.close()
+
+  def start(self, proc):
+    process = ZygoteProcess(self.zygote, proc, proc)
+    process.start()
+    return process
+
+  def test_exit_codes(self):
+    process = self.start(EXIT_PROC)
+    process.join(10)
+    self.assertEqual(process.exitcode, 3)
+    self.assertFalse(process.is_alive())
+
+    process = self.start(SLEEP_PROC)
+    self.assertTrue(process.is_alive())
+    process.terminate()
+    process.join(10)
+    self.assertEqual(process.exitcode, -signal.SIGTERM)
+
+  def test_join_timeout(self):
+    process = self.start(SLEEP_PROC)
+    t = time.monotonic()
+    process.join(0.1)
+    self.assertLess(time.monotonic() - t, 1)
+    self.assertIsNone(process.exitcode)
+    process.terminate()
+    process.join(10)
+
+  def test_zygote_death(self):
+    process = self.start(SLEEP_PROC)
+    os.kill(self.zygote.pid, signal.SIGKILL)
+
+    # its processes get an exit code instead of being waited on forever
+    t = time.monotonic()
+    process.join()
+    self.assertLess(time.monotonic() - t, 5)
+    self.assertTrue(self.zygote.dead)
+    self.assertEqual(process.exitcode, -signal.SIGKILL)
+    with self.assertRaises(OSError):
+      self.start(EXIT_PROC)
+
+
+class TestManager(unittest.TestCase):
+  def test_dependency_waves(self):
+    with mock.patch.object(manager, "process_dependencies", {'b': ['a'], 'c': ['b'], 'd': ['x']}):
+      self.assertEqual(manager.dependency_waves(['c', 'b', 'a', 'd']), [['a', 'd'], ['b'], ['c']])
+      # dependencies that aren't started don't hold back the others
+      self.assertEqual(manager.dependency_waves(['c', 'd']), [['c', 'd']])
+
+    # a cycle ends up in one wave instead of never being started
+    with mock.patch.object(manager, "process_dependencies", {'a': ['b'], 'b': ['a'], 'c': ['a']}):
+      self.assertEqual(manager.dependency_waves(['a', 'b', 'c']), [['a', 'b', 'c']])
+
+  def test_start_without_zygote(self):
+    zygote = Zygote(list(TEST_PROCS))
+    # dead, but the manager doesn't know yet
+    os.kill(zygote.pid, signal.SIGKILL)
+    try:
+      with mock.patch.object(manager, "zygote", zygote), \
+           mock.patch.dict(manager.managed_processes, {EXIT_PROC: EXIT_PROC}), \
+           mock.patch.dict(manager.running, {}, clear=True):
+        manager.start_managed_process(EXIT_PROC)
+        process = manager.running[EXIT_PROC]
+        self.assertIsInstance(process, Process)
+        process.join(10)
+        self.assertEqual(process.exitcode, 3)
+        self.assertTrue(zygote.dead)
+    finally:
+      zygote.close()
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tempfile
+import unittest
+
+import cereal.messaging as messaging
+from selfdrive.networkd import NetworkMonitor, NetworkType, NetworkStrength, default_route_iface, iface_network_type, \
+                               wifi_strength
+
+ROUTE_HEADER = "Iface\tDestination\tGateway \tFlags\tRefCnt\tUse\tMetric\tMask\t\tMTU\tWindow\tIRTT\n"
+WIRELESS_HEADER = ("Inter-| sta-|   Quality        |   Discarded packets               | Missed | WE\n"
+                   " face | tus | link level noise |  nwid  crypt   frag  retry   misc | beacon | 22\n")
+
+
+class TestNetworkd(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.proc_net = os.path.join(self.tmp, "proc_net")
+    self.sys_net = os.path.join(self.tmp, "sys_net")
+    os.mkdir(self.proc_net)
+    os.mkdir(self.sys_net)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def write_routes(self, routes):
+    """routes are (iface, destination, flags, metric, mask)"""
+    with open(os.path.join(self.proc_net, "route"), "w") as f:
+      f.write(ROUTE_HEADER)
+      for iface, dest, flags, metric, mask in routes:
+        f.write("%s\t%s\t0101A8C0\t%04X\t0\t0\t%d\t%s\t0\t0\t0\n" % (iface, dest, flags, metric, mask))
+
+  def write_wireless(self, levels):
+    with open(os.path.join(self.proc_net, "wireless"), "w") as f:
+      f.write(WIRELESS_HEADER)
+      for iface, level in levels.items():
+        f.write("%6s: 0000   70.  %s.  -256        0      0      0      0      0        0\n" % (iface, level))
+
+  def make_iface(self, iface, operstate="up", wireless_dir=None):
+    path = os.path.join(self.sys_net, iface)
+    os.mkdir(path)
+    with open(os.path.join(path, "operstate"), "w") as f:
+      f.write(operstate + "\n")
+    if wireless_dir is not None:
+      os.mkdir(os.path.join(path, wireless_dir))
+
+  def test_default_route(self):
+    self.assertIsNone(default_route_iface(self.proc_net))
+
+    self.write_routes([("eth0", "0002A8C0", 0x1, 0, "00FFFFFF"),
+                       ("wlan0", "00000000", 0x3, 600, "00000000"),
+                       ("eth0", "00000000", 0x3, 100, "00000000")])
+    self.assertEqual(default_route_iface(self.proc_net), "eth0")
+
+    self.write_routes([("wlan0", "00000000", 0x3, 50, "00000000"),
+                       ("eth0", "00000000", 0x3, 100, "00000000")])
+    self.assertEqual(default_route_iface(self.proc_net), "wlan0")
+
+    # a route that isn't up and a route that isn't the default don't count
+    self.write_routes([("wlan0", "00000000", 0x2, 50, "00000000"),
+                       ("eth0", "0002A8C0", 0x3, 0, "00FFFFFF")])
+    self.assertIsNone(default_route_iface(self.proc_net))
+
+  def test_network_type(self):
+    self.make_iface("eth0")
+    self.make_iface("eth1", operstate="down")
+    self.make_iface("wlan0", wireless_dir="wireless")
+    self.make_iface("wlp2s0", wireless_dir="phy80211")
+    self.make_iface("rmnet_data0", operstate="unknown")
+
+    self.assertEqual(iface_network_type("eth0", self.sys_net), NetworkType.ethernet)
+    self.assertEqual(iface_network_type("eth1", self.sys_net), NetworkType.none)
+    self.assertEqual(iface_network_type("wlan0", self.sys_net), NetworkType.wifi)
+    self.assertEqual(iface_network_type("wlp2s0", self.sys_net), NetworkType.wifi)
+    self.assertEqual(iface_network_type("rmnet_data0", self.sys_net), NetworkType.cell4G)
+    self.assertEqual(iface_network_type("missing0", self.sys_net), NetworkType.none)
+    self.assertEqual(iface_network_type(None, self.sys_net), NetworkType.none)
+
+  def test_wifi_strength(self):
+    self.assertEqual(wifi_strength("wlan0", self.proc_net), NetworkStrength.unknown)
+
+    # some drivers report unsigned dBm, 211 is -45
+    levels = {"wlan0": -45, "wlan1": -55, "wlan2": -65, "wlan3": -80, "wlan4": 211}
+    self.write_wireless(levels)
+    self.assertEqual(wifi_strength("wlan0", self.proc_net), NetworkStrength.great)
+    self.assertEqual(wifi_strength("wlan1", self.proc_net), NetworkStrength.good)
+    self.assertEqual(wifi_strength("wlan2", self.proc_net), NetworkStrength.moderate)
+    self.assertEqual(wifi_strength("wlan3", self.proc_net), NetworkStrength.poor)
+    self.assertEqual(wifi_strength("wlan4", self.proc_net), NetworkStrength.great)
+    self.assertEqual(wifi_strength("wlan5", self.proc_net), NetworkStrength.unknown)
+
+  def test_monitor(self):
+    self.make_iface("eth0")
+    self.make_iface("wlan0", wireless_dir="wireless")
+    self.write_wireless({"wlan0": -55})
+    self.write_routes([("wlan0", "00000000", 0x3, 600, "00000000")])
+
+    monitor = NetworkMonitor(android=False, proc_net=self.proc_net, sys_net=self.sys_net)
+    monitor.refresh()
+    msg = messaging.new_message('networkState')
+    monitor.fill(msg.networkState)
+    self.assertEqual(msg.networkState.networkType, NetworkType.wifi)
+    self.assertEqual(msg.networkState.networkStrength, NetworkStrength.good)
+    self.assertEqual(msg.networkState.iface, "wlan0")
+    self.assertGreater(msg.networkState.typeTs, 0)
+
+    # plugged in, ethernet has the lower metric
+    self.write_routes([("wlan0", "00000000", 0x3, 600, "00000000"),
+                       ("eth0", "00000000", 0x3, 100, "00000000")])
+    monitor.refresh()
+    monitor.fill(msg.networkState)
+    self.assertEqual(msg.networkState.networkType, NetworkType.ethernet)
+    self.assertEqual(msg.networkState.networkStrength, NetworkStrength.unknown)
+    self.assertEqual(msg.networkState.iface, "eth0")
+
+    self.write_routes([])
+    monitor.refresh()
+    monitor.fill(msg.networkState)
+    self.assertEqual(msg.networkState.networkType, NetworkType.none)
+    self.assertEqual(msg.networkState.iface, "")
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -4,7 +4,7 @@ os.environ['FAKEUPLOAD'] = "1"
 
 from common.params import Params
 from common.realtime import sec_since_boot
-from selfdrive.manager import manager_init, manager_prepare, start_daemon_process
+from selfdrive.manager import manager_init, manager_prepare, start_daemon_process, stop_zygote
 from selfdrive.test.helpers import phone_only, with_processes
 import json
 import requests
@@ -19,6 +19,10 @@ def test_manager_prepare():
   manager_init()
   manager_prepare()
 
+# manager_prepare forks the zygote the other tests' processes start from
+def teardown_module():
+  stop_zygote()
+
 @phone_only
 @with_processes(['loggerd', 'logmessaged', 'tombstoned', 'proclogd', 'logcatd'])
 def test_logging():
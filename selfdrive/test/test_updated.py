@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import os
+import random
+import shutil
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+import selfdrive.updated as updated
+
+
+def snapshot(root, inodes=False):
+  """Type, mode, mtime and contents or link target of everything below root."""
+  tree = {}
+  for dirpath, dirnames, filenames in os.walk(root):
+    for name in dirnames + filenames:
+      path = os.path.join(dirpath, name)
+      st = os.lstat(path)
+      entry = [stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode), st.st_mtime_ns]
+      if stat.S_ISLNK(st.st_mode):
+        entry[1] = None
+        entry.append(os.readlink(path))
+      elif stat.S_ISREG(st.st_mode):
+        with open(path, 'rb') as f:
+          entry.append(f.read())
+        if inodes:
+          entry.append(st.st_ino)
+      tree[os.path.relpath(path, root)] = entry
+  return tree
+
+
+class MutatingTree():
+  """A random tree of directories, files and symlinks, changed a bit every round."""
+  def __init__(self, root, seed):
+    self.root = root
+    self.rnd = random.Random(seed)
+    self.mtime = 1500000000 * 10**9
+    self.names = 0
+
+  def _name(self, dirname):
+    self.names += 1
+    return os.path.join(dirname, "n%d" % self.names)
+
+  def _touch(self, path):
+    self.mtime += 10**9
+    os.utime(path, ns=(self.mtime, self.mtime), follow_symlinks=False)
+
+  def _write(self, path):
+    with open(path, 'ab' if self.rnd.random() < 0.5 else 'wb') as f:
+      f.write(os.urandom(self.rnd.randint(0, 64)))
+    os.chmod(path, self.rnd.choice([0o644, 0o755, 0o600]))
+    self._touch(path)
+
+  def _new(self, path, depth=0):
+    kind = self.rnd.random()
+    if kind < 0.3 and depth < 3:
+      os.mkdir(path)
+      for _ in range(self.rnd.randint(0, 4)):
+        self._new(self._name(path), depth + 1)
+      os.chmod(path, self.rnd.choice([0o755, 0o700]))
+      self._touch(path)
+    elif kind < 0.4:
+      os.symlink(self.rnd.choice(["n1", "../n2", "missing"]), path)
+      self._touch(path)
+    else:
+      self._write(path)
+
+  def create(self):
+    for _ in range(8):
+      self._new(self._name(self.root))
+
+  def mutate(self):
+    for _ in range(self.rnd.randint(1, 10)):
+      paths = []
+      for dirpath, dirnames, filenames in os.walk(self.root):
+        paths += [os.path.join(dirpath, name) for name in dirnames + filenames]
+      if not len(paths):
+        self.create()
+        continue
+
+      path = self.rnd.choice(paths)
+      if not os.path.lexists(path):
+        continue
+      is_dir = os.path.isdir(path) and not os.path.islink(path)
+      is_file = os.path.isfile(path) and not os.path.islink(path)
+
+      action = self.rnd.random()
+      if action < 0.2 and is_file:
+        self._write(path)
+      elif action < 0.3 and is_file:
+        # a new inode, like git checking out the file
+        os.unlink(path)
+        self._write(path)
+      elif action < 0.45:
+        if is_dir:
+          shutil.rmtree(path)
+        else:
+          os.unlink(path)
+      elif action < 0.6:
+        # file <-> dir and symlink -> dir or file
+        if is_dir:
+          shutil.rmtree(path)
+          self._write(path)
+        else:
+          os.unlink(path)
+          self._new(path, 2)
+      elif action < 0.75 and is_dir:
+        os.chmod(path, self.rnd.choice([0o755, 0o700, 0o750]))
+      else:
+        self._new(self._name(path if is_dir else os.path.dirname(path)))
+
+      parent = os.path.dirname(path)
+      if parent != self.root and self.rnd.random() < 0.5:
+        self._touch(parent)
+
+
+class TestFinalizeOverlay(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.merged = os.path.join(self.tmp, "merged")
+    self.finalized = os.path.join(self.tmp, "finalized")
+    self.lower = os.path.join(self.tmp, "lower")
+    self.fresh = os.path.join(self.tmp, "fresh")
+    os.mkdir(self.merged)
+    os.mkdir(self.lower)
+
+    # Without an overlay mount the merged view is its own upper layer, so its
+    # files can be hardlinked
+    self.patches = [mock.patch.object(updated, name, value) for name, value in
+                    [("OVERLAY_MERGED", self.merged), ("OVERLAY_UPPER", self.merged),
+                     ("FINALIZED", self.finalized), ("BASEDIR", self.lower)]]
+    for p in self.patches:
+      p.start()
+    self.umask = os.umask(0o022)
+
+  def tearDown(self):
+    os.umask(self.umask)
+    for p in self.patches:
+      p.stop()
+    shutil.rmtree(self.tmp)
+
+  def _check(self, hardlink, seed):
+    tree = MutatingTree(self.merged, seed)
+    tree.create()
+    for _ in range(15):
+      updated.finalize_overlay(hardlink)
+
+      if os.path.isdir(self.fresh):
+        shutil.rmtree(self.fresh)
+      shutil.copytree(self.merged, self.fresh, symlinks=True)
+      self.assertEqual(snapshot(self.finalized), snapshot(self.fresh))
+      if hardlink:
+        self.assertEqual(snapshot(self.finalized, inodes=True), snapshot(self.merged, inodes=True))
+        self.assertEqual(stat.S_IMODE(os.lstat(self.finalized).st_mode), 0o700)
+
+      tree.mutate()
+
+  def test_copy(self):
+    for seed in range(10):
+      with self.subTest(seed=seed):
+        self._check(False, seed)
+        shutil.rmtree(self.finalized)
+        shutil.rmtree(self.merged)
+        os.mkdir(self.merged)
+
+  def test_hardlink(self):
+    for seed in range(10):
+      with self.subTest(seed=seed):
+        self._check(True, seed)
+        shutil.rmtree(self.finalized)
+        shutil.rmtree(self.merged)
+        os.mkdir(self.merged)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -2,41 +2,70 @@ import datetime
 import random
 import threading
 import time
-from statistics import mean
+import numpy as np
 
 from cereal import log
 from common.realtime import sec_since_boot
 from selfdrive.swaglog import cloudlog
+from selfdrive.thermald.sensors import SysfsReader
 
 PANDA_OUTPUT_VOLTAGE = 5.28
+PULSE_MEASUREMENT_SAMPLES = 6
+
+POWER_HISTORY_SIZE = 3600  # integrated measurements, 30 min at 2Hz
+PERCENT_HISTORY_SIZE = 3600  # battery percentages while discharging
+PERCENT_HISTORY_MIN_TIME = 60.  # s of discharging before predicting the time to shutdown
+
+# offroad battery percentages to shut down at and to turn charging off and on at
+BATT_PERC_OFF = 90
+LEON_BATT_PERC_OFF = 95  # prevent LEECO from undervoltage
+BATT_PERC_TO_DISCHARGE = 80
+BATT_PERC_TO_CHARGE = 70
+
+BATTERY_CAPACITY = "/sys/class/power_supply/battery/capacity"
+BATTERY_STATUS = "/sys/class/power_supply/battery/status"
+BATTERY_CURRENT = "/sys/class/power_supply/battery/current_now"
+BATTERY_VOLTAGE = "/sys/class/power_supply/battery/voltage_now"
+USB_PRESENT = "/sys/class/power_supply/usb/present"
 
 
 # Parameters
 def get_battery_capacity():
-  return _read_param("/sys/class/power_supply/battery/capacity", int)
+  return _read_param(BATTERY_CAPACITY, int)
 
 
 def get_battery_status():
   # This does not correspond with actual charging or not.
   # If a USB cable is plugged in, it responds with 'Charging', even when charging is disabled
-  return _read_param("/sys/class/power_supply/battery/status", lambda x: x.strip(), '')
+  return _read_param(BATTERY_STATUS, _strip, '')
 
 
 def get_battery_current():
-  return _read_param("/sys/class/power_supply/battery/current_now", int)
+  return _read_param(BATTERY_CURRENT, int)
 
 
 def get_battery_voltage():
-  return _read_param("/sys/class/power_supply/battery/voltage_now", int)
+  return _read_param(BATTERY_VOLTAGE, int)
 
 
 def get_usb_present():
-  return _read_param("/sys/class/power_supply/usb/present", lambda x: bool(int(x)), False)
+  return _read_param(USB_PRESENT, _parse_bool, False)
+
+
+def battery_sensors():
+  # the same readers as the getters above, keyed by their thermal field
+  return {
+    'batteryPercent': _get_reader(BATTERY_CAPACITY, int),
+    'batteryStatus': _get_reader(BATTERY_STATUS, _strip, ''),
+    'batteryCurrent': _get_reader(BATTERY_CURRENT, int),
+    'batteryVoltage': _get_reader(BATTERY_VOLTAGE, int),
+    'usbOnline': _get_reader(USB_PRESENT, _parse_bool, False),
+  }
 
 
 def get_battery_charging():
   # This does correspond with actually charging
-  return _read_param("/sys/class/power_supply/battery/charge_type", lambda x: x.strip() != "N/A", False)
+  return _read_param("/sys/class/power_supply/battery/charge_type", _parse_charge_type, False)
 
 
 def set_battery_charging(on):
@@ -45,12 +74,34 @@ def set_battery_charging(on):
 
 
 # Helpers
+def _strip(x):
+  return x.strip()
+
+
+def _parse_bool(x):
+  return bool(int(x))
+
+
+def _parse_charge_type(x):
+  return x.strip() != "N/A"
+
+
+# the files stay open, the getters are called from thermald and the pulsed measurement thread
+_readers = {}
+_readers_lock = threading.Lock()
+
+
+def _get_reader(path, parser, default=0):
+  # a file read with another parser or default gets its own reader, so parsers are module level functions
+  key = (path, parser, default)
+  with _readers_lock:
+    if key not in _readers:
+      _readers[key] = SysfsReader(path, parser, default)
+    return _readers[key]
+
+
 def _read_param(path, parser, default=0):
-  try:
-    with open(path) as f:
-      return parser(f.read())
-  except Exception:
-    return default
+  return _get_reader(path, parser, default).read()
 
 
 def panda_current_to_actual_current(panda_current):
@@ -58,13 +109,83 @@ def panda_current_to_actual_current(panda_current):
   return (3.3 - (panda_current * 3.3 / 4096)) / 8.25
 
 
+class RingBuffer():
+  """Fixed size history of rows of floats, read back oldest first."""
+  def __init__(self, size, columns):
+    self.data = np.zeros((size, columns))
+    self.size = size
+    self.idx = 0
+    self.count = 0
+
+  def __len__(self):
+    return self.count
+
+  def append(self, row):
+    self.data[self.idx] = row
+    self.idx = (self.idx + 1) % self.size
+    self.count = min(self.count + 1, self.size)
+
+  def clear(self):
+    self.idx = 0
+    self.count = 0
+
+  def get(self):
+    if self.count < self.size:
+      return self.data[:self.count]
+    return np.roll(self.data, -self.idx, axis=0)
+
+
+def integrate_power(t, power):
+  """Energy in uWh of power [W] sampled at times t [s], each sample counts for the time since the one before."""
+  if len(t) < 2:
+    return 0.
+  return float(np.dot(power[1:], np.diff(t))) * 1e6 / 3600
+
+
+def discharge_rate(t, percent):
+  """Least squares slope of the battery percentage in %/s."""
+  t = t - t[-1]
+  denom = len(t) * np.dot(t, t) - np.sum(t)**2
+  if denom <= 0:
+    return 0.
+  return float((len(t) * np.dot(t, percent) - np.sum(t) * np.sum(percent)) / denom)
+
+
+def power_shutdown(battery_status, battery_percent, ts, off_ts, started_seen, batt_perc_off):
+  shutdown = False
+
+  if battery_status == "Discharging":
+    delta_ts = ts - off_ts
+    if started_seen:
+      if battery_percent <= batt_perc_off and delta_ts > 10:
+        shutdown = True
+    elif delta_ts > 240 and battery_percent < 30:
+      shutdown = True
+
+  return shutdown
+
+
+def charging_decision(battery_percent, battery_charging, to_discharge, to_charge):
+  """Returns whether charging should be turned on or off, None to leave it as it is."""
+  if battery_percent >= to_discharge and battery_charging:
+    return False
+  elif battery_percent <= to_charge and not battery_charging:
+    return True
+  return None
+
+
 class PowerMonitoring:
-  def __init__(self):
+  def __init__(self, pulsed_measurement=True):
     self.last_measurement_time = None           # Used for integration delta
     self.power_used_uWh = 0                     # Integrated power usage in uWh since going into offroad
     self.next_pulsed_measurement_time = None
+    self.pulsed_measurement = pulsed_measurement  # turns off charging, not when replaying logs
     self.integration_lock = threading.Lock()
 
+    # (t, power [W]) of every integrated measurement and (t, battery %) while discharging offroad
+    self.power_history = RingBuffer(POWER_HISTORY_SIZE, 2)
+    self.percent_history = RingBuffer(PERCENT_HISTORY_SIZE, 2)
+
     self.ts_last_charging_ctrl = None
 
   # Calculation tick
@@ -76,79 +197,100 @@ class PowerMonitoring:
       if datetime.datetime.fromtimestamp(now).year < 2019:
         return
 
-      # Only integrate when there is no ignition
-      # If health is None, we're probably not in a car, so we don't care
-      if health is None or (health.health.ignitionLine or health.health.ignitionCan) or \
-         health.health.hwType == log.HealthData.HwType.unknown:
-        with self.integration_lock:
-          self.last_measurement_time = None
-          self.next_pulsed_measurement_time = None
-          self.power_used_uWh = 0
+      if health is None:
+        ignition, hw_type, panda_current = False, log.HealthData.HwType.unknown, 0
+      else:
+        ignition = health.health.ignitionLine or health.health.ignitionCan
+        hw_type, panda_current = health.health.hwType, health.health.current
+
+      # nothing is integrated with ignition or outside a car, don't read the battery for it
+      if ignition or hw_type == log.HealthData.HwType.unknown:
+        self.update(now, ignition, hw_type, panda_current, '', 0, 0, 0)
         return
+      self.update(now, ignition, hw_type, panda_current, get_battery_status(), get_battery_voltage(),
+                  get_battery_current(), get_battery_capacity())
+    except Exception:
+      cloudlog.exception("Power monitoring calculation failed")
 
-      # First measurement, set integration time
+  def update(self, now, ignition, hw_type, panda_current, battery_status, battery_voltage, battery_current, battery_percent):
+    # Only integrate when there is no ignition
+    # If hw_type is unknown, we're probably not in a car, so we don't care
+    if ignition or hw_type == log.HealthData.HwType.unknown:
       with self.integration_lock:
-        if self.last_measurement_time is None:
-          self.last_measurement_time = now
-          return
-
-      is_uno = health.health.hwType == log.HealthData.HwType.uno
-      # Get current power draw somehow
-      current_power = 0
-      if get_battery_status() == 'Discharging':
-        # If the battery is discharging, we can use this measurement
-        # On C2: this is low by about 10-15%, probably mostly due to UNO draw not being factored in
-        current_power = ((get_battery_voltage() / 1000000) * (get_battery_current() / 1000000))
-      elif (health.health.hwType in [log.HealthData.HwType.whitePanda, log.HealthData.HwType.greyPanda]) and (health.health.current > 1):
-        # If white/grey panda, use the integrated current measurements if the measurement is not 0
-        # If the measurement is 0, the current is 400mA or greater, and out of the measurement range of the panda
-        # This seems to be accurate to about 5%
-        current_power = (PANDA_OUTPUT_VOLTAGE * panda_current_to_actual_current(health.health.current))
-      elif (self.next_pulsed_measurement_time is not None) and (self.next_pulsed_measurement_time <= now):
-        # TODO: Figure out why this is off by a factor of 3/4???
-        FUDGE_FACTOR = 1.33
-
-        # Turn off charging for about 10 sec in a thread that does not get killed on SIGINT, and perform measurement here to avoid blocking thermal
-        def perform_pulse_measurement(now):
-          try:
-            set_battery_charging(False)
-            time.sleep(5)
-
-            # Measure for a few sec to get a good average
-            voltages = []
-            currents = []
-            for _ in range(6):
-              voltages.append(get_battery_voltage())
-              currents.append(get_battery_current())
-              time.sleep(1)
-            current_power = ((mean(voltages) / 1000000) * (mean(currents) / 1000000))
-
-            self._perform_integration(now, current_power * FUDGE_FACTOR)
-
-            # Enable charging again
-            set_battery_charging(True)
-          except Exception:
-            cloudlog.exception("Pulsed power measurement failed")
-
-        # Start pulsed measurement and return
-        threading.Thread(target=perform_pulse_measurement, args=(now,)).start()
+        self.last_measurement_time = None
         self.next_pulsed_measurement_time = None
-        return
+        self.power_used_uWh = 0
+        self.power_history.clear()
+        self.percent_history.clear()
+      return
 
-      elif self.next_pulsed_measurement_time is None and not is_uno:
-        # On a charging EON with black panda, or drawing more than 400mA out of a white/grey one
-        # Only way to get the power draw is to turn off charging for a few sec and check what the discharging rate is
-        # We shouldn't do this very often, so make sure it has been some long-ish random time interval
-        self.next_pulsed_measurement_time = now + random.randint(120, 180)
-        return
-      else:
-        # Do nothing
+    # First measurement, set integration time
+    with self.integration_lock:
+      if self.last_measurement_time is None:
+        self.last_measurement_time = now
+        self.power_history.append((now, 0.))
         return
 
-      # Do the integration
-      self._perform_integration(now, current_power)
+    if battery_status == 'Discharging':
+      self.percent_history.append((now, battery_percent))
+    else:
+      self.percent_history.clear()
+
+    is_uno = hw_type == log.HealthData.HwType.uno
+    # Get current power draw somehow
+    current_power = 0
+    if battery_status == 'Discharging':
+      # If the battery is discharging, we can use this measurement
+      # On C2: this is low by about 10-15%, probably mostly due to UNO draw not being factored in
+      current_power = ((battery_voltage / 1000000) * (battery_current / 1000000))
+    elif (hw_type in [log.HealthData.HwType.whitePanda, log.HealthData.HwType.greyPanda]) and (panda_current > 1):
+      # If white/grey panda, use the integrated current measurements if the measurement is not 0
+      # If the measurement is 0, the current is 400mA or greater, and out of the measurement range of the panda
+      # This seems to be accurate to about 5%
+      current_power = (PANDA_OUTPUT_VOLTAGE * panda_current_to_actual_current(panda_current))
+    elif (self.next_pulsed_measurement_time is not None) and (self.next_pulsed_measurement_time <= now):
+      # Start pulsed measurement and return
+      if self.pulsed_measurement:
+        threading.Thread(target=self.perform_pulse_measurement, args=(now,)).start()
+      self.next_pulsed_measurement_time = None
+      return
+
+    elif self.next_pulsed_measurement_time is None and not is_uno:
+      # On a charging EON with black panda, or drawing more than 400mA out of a white/grey one
+      # Only way to get the power draw is to turn off charging for a few sec and check what the discharging rate is
+      # We shouldn't do this very often, so make sure it has been some long-ish random time interval
+      self.next_pulsed_measurement_time = now + random.randint(120, 180)
+      return
+    else:
+      # Do nothing
+      return
+
+    # Do the integration
+    self._perform_integration(now, current_power)
+
+  # Turn off charging for about 10 sec in a thread that does not get killed on SIGINT, and perform measurement here to avoid blocking thermal
+  def perform_pulse_measurement(self, now):
+    # TODO: Figure out why this is off by a factor of 3/4???
+    FUDGE_FACTOR = 1.33
+
+    try:
+      set_battery_charging(False)
+      time.sleep(5)
+
+      # Measure for a few sec to get a good average
+      samples = np.zeros((PULSE_MEASUREMENT_SAMPLES, 2))
+      for i in range(PULSE_MEASUREMENT_SAMPLES):
+        samples[i] = get_battery_voltage(), get_battery_current()
+        time.sleep(1)
+      voltage, current = samples.mean(axis=0)
+      current_power = ((voltage / 1000000) * (current / 1000000))
+
+      self._perform_integration(now, current_power * FUDGE_FACTOR)
+
+      # Enable charging again
+      set_battery_charging(True)
     except Exception:
-      cloudlog.exception("Power monitoring calculation failed")
+      cloudlog.exception("Pulsed power measurement failed")
 
   def _perform_integration(self, t, current_power):
     with self.integration_lock:
@@ -160,6 +302,7 @@ class PowerMonitoring:
             raise ValueError(f"Negative power used! Integration time: {integration_time_h} h Current Power: {power_used} uWh")
           self.power_used_uWh += power_used
           self.last_measurement_time = t
+          self.power_history.append((t, current_power))
       except Exception:
         cloudlog.exception("Integration failed")
 
@@ -167,14 +310,85 @@ class PowerMonitoring:
   def get_power_used(self):
     return int(self.power_used_uWh)
 
-
+  def get_average_power(self, window=None):
+    """Average power draw in W over the last window seconds of integrated measurements."""
+    with self.integration_lock:
+      history = self.power_history.get()
+    if window is not None and len(history):
+      history = history[history[:, 0] >= history[-1, 0] - window]
+    if len(history) < 2:
+      return None
+    return integrate_power(history[:, 0], history[:, 1]) * 3600 / 1e6 / (history[-1, 0] - history[0, 0])
+
+  def get_time_to_shutdown(self, batt_perc_off):
+    """Seconds until the battery percentage reaches batt_perc_off at the recent discharge rate, None if
+    it isn't discharging or there isn't enough history yet."""
+    history = self.percent_history.get()
+    if len(history) < 2 or history[-1, 0] - history[0, 0] < PERCENT_HISTORY_MIN_TIME:
+      return None
+    rate = discharge_rate(history[:, 0], history[:, 1])
+    if rate >= 0:
+      return None
+    return max(0., (history[-1, 1] - batt_perc_off) / -rate)
 
   def charging_ctrl(self, msg, ts, to_discharge, to_charge ):
     if self.ts_last_charging_ctrl is None or (ts - self.ts_last_charging_ctrl) >= 300.:
       battery_changing = get_battery_charging()
       if self.ts_last_charging_ctrl:
-        if msg.thermal.batteryPercent >= to_discharge and battery_changing:
-          set_battery_charging(False)
-        elif msg.thermal.batteryPercent <= to_charge and not battery_changing:
-          set_battery_charging(True)
-      self.ts_last_charging_ctrl = ts
\ No newline at end of file
+        charging = charging_decision(msg.thermal.batteryPercent, battery_changing, to_discharge, to_charge)
+        if charging is not None:
+          set_battery_charging(charging)
+      self.ts_last_charging_ctrl = ts
+
+
+def replay(t, ignition, hw_type, panda_current, battery_status, battery_voltage, battery_current, battery_percent,
+           batt_perc_off=BATT_PERC_OFF, to_discharge=BATT_PERC_TO_DISCHARGE, to_charge=BATT_PERC_TO_CHARGE):
+  """Runs logged health and thermal samples, one row per thermal message, through PowerMonitoring and
+  thermald's shutdown and charging control. Started is taken to be ignition, usb power to be on and
+  charging to follow the charging control. No pulsed measurements are made.
+
+  Returns the power used and predicted time to shutdown at every sample, the time thermald would
+  have shut down at and the times it would have turned charging on or off."""
+  pm = PowerMonitoring(pulsed_measurement=False)
+  n = len(t)
+  power_used = np.zeros(n)
+  time_to_shutdown = np.full(n, np.nan)
+  shutdown_ts = None
+  charging_changes = []
+
+  off_ts = None
+  started_seen = False
+  charging = True
+  last_charging_ctrl = None
+  for i in range(n):
+    ts = t[i]
+    if ignition[i]:
+      started_seen = True
+      off_ts = None
+    else:
+      if off_ts is None:
+        off_ts = ts
+      if shutdown_ts is None and power_shutdown(battery_status[i], battery_percent[i], ts, off_ts, started_seen, batt_perc_off):
+        shutdown_ts = ts
+
+    pm.update(ts, ignition[i], hw_type[i], panda_current[i], battery_status[i], battery_voltage[i],
+              battery_current[i], battery_percent[i])
+    power_used[i] = pm.get_power_used()
+    prediction = pm.get_time_to_shutdown(batt_perc_off)
+    if prediction is not None:
+      time_to_shutdown[i] = prediction
+
+    if last_charging_ctrl is None or (ts - last_charging_ctrl) >= 300.:
+      if last_charging_ctrl is not None:
+        decision = charging_decision(battery_percent[i], charging, to_discharge, to_charge)
+        if decision is not None:
+          charging = decision
+          charging_changes.append((ts, charging))
+      last_charging_ctrl = ts
+
+  return {
+    'powerUsed': power_used,
+    'timeToShutdown': time_to_shutdown,
+    'shutdownTs': shutdown_ts,
+    'chargingChanges': charging_changes,
+  }
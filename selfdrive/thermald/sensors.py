@@ -0,0 +1,132 @@
+import os
+import time
+import threading
+
+
+class SysfsReader():
+  """Keeps a sysfs attribute open and rereads it with pread at offset 0, which makes
+  the kernel regenerate the value, so polling it is one syscall instead of three."""
+  RETRY_TIME = 10.  # s, between attempts to open a file that isn't there
+
+  def __init__(self, path, parser=int, default=0):
+    self.path = path
+    self.parser = parser
+    self.default = default
+    self.lock = threading.Lock()
+    self.fd = None
+    self.next_open = 0.
+    self.latency = 0.  # s, of the last read
+
+  def read(self):
+    t = time.monotonic()
+    try:
+      with self.lock:
+        if self.fd is None:
+          if t < self.next_open:
+            return self.default
+          try:
+            self.fd = os.open(self.path, os.O_RDONLY | os.O_CLOEXEC)
+          except OSError:
+            self.next_open = t + self.RETRY_TIME
+            return self.default
+
+        try:
+          dat = os.pread(self.fd, 4096, 0)
+        except OSError:
+          # the device can go away, open it again on the next read
+          self._close()
+          return self.default
+
+      try:
+        return self.parser(dat.decode())
+      except Exception:
+        return self.default
+    finally:
+      self.latency = time.monotonic() - t
+
+  def _close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  def close(self):
+    with self.lock:
+      self._close()
+
+
+class SensorSample():
+  """The values of a set of sensors, allocated once and updated in place."""
+
+  def __init__(self, defaults):
+    self.values = dict(defaults)
+    self.latency = dict.fromkeys(defaults, 0.)
+    self.t = 0.
+    self.batch_time = 0.
+
+  def __getattr__(self, name):
+    try:
+      return self.__dict__['values'][name]
+    except KeyError:
+      raise AttributeError(name) from None
+
+  def items(self):
+    return self.values.items()
+
+  def copy_from(self, other):
+    self.values.update(other.values)
+    self.latency.update(other.latency)
+    self.t = other.t
+    self.batch_time = other.batch_time
+
+
+class SensorSampler():
+  """Reads a dict of SysfsReaders in one batch. With a rate [Hz] the batch is read on a
+  thread and read_into hands out the latest one, otherwise read_into reads it."""
+
+  def __init__(self, readers, rate=None):
+    self.readers = readers
+    self.lock = threading.Lock()
+    self.latest = self.new_sample()
+
+    self.exit_event = threading.Event()
+    self.thread = None
+    if rate:
+      self.thread = threading.Thread(target=self.sampler_thread, args=(1. / rate,), daemon=True)
+      self.thread.start()
+
+  def new_sample(self):
+    return SensorSample({name: reader.default for name, reader in self.readers.items()})
+
+  def sample(self, out):
+    t = time.monotonic()
+    values, latency = out.values, out.latency
+    for name, reader in self.readers.items():
+      values[name] = reader.read()
+      latency[name] = reader.latency
+    out.t = t
+    out.batch_time = time.monotonic() - t
+
+  def read_into(self, out):
+    if self.thread is None:
+      self.sample(out)
+    else:
+      with self.lock:
+        out.copy_from(self.latest)
+
+  def sampler_thread(self, period):
+    back = self.new_sample()
+    next_t = time.monotonic()
+    while not self.exit_event.is_set():
+      self.sample(back)
+      with self.lock:
+        self.latest, back = back, self.latest
+
+      next_t = max(next_t + period, time.monotonic())
+      self.exit_event.wait(next_t - time.monotonic())
+
+  def close(self):
+    self.exit_event.set()
+    if self.thread is not None:
+      self.thread.join()
+    for reader in self.readers.values():
+      reader.close()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import unittest
+import numpy as np
+
+from cereal import log
+from selfdrive.thermald.power_monitoring import PowerMonitoring, RingBuffer, PERCENT_HISTORY_MIN_TIME, \
+                                                integrate_power, discharge_rate, replay
+
+WHITE_PANDA = log.HealthData.HwType.whitePanda
+
+
+class TestPowerMonitoring(unittest.TestCase):
+  def test_ring_buffer(self):
+    ring = RingBuffer(4, 2)
+    self.assertEqual(len(ring), 0)
+    self.assertEqual(ring.get().shape, (0, 2))
+
+    for i in range(3):
+      ring.append((i, -i))
+    self.assertEqual(len(ring), 3)
+    np.testing.assert_equal(ring.get(), [[0, 0], [1, -1], [2, -2]])
+
+    # oldest first after wrapping around, also at the end of the data
+    for i in range(3, 9):
+      ring.append((i, -i))
+      self.assertEqual(len(ring), 4)
+      np.testing.assert_equal(ring.get()[:, 0], range(i - 3, i + 1))
+
+    ring.clear()
+    self.assertEqual(len(ring), 0)
+    ring.append((9, -9))
+    np.testing.assert_equal(ring.get(), [[9, -9]])
+
+  def test_integrate_power(self):
+    rng = np.random.default_rng(0)
+    pm = PowerMonitoring(pulsed_measurement=False)
+    t = 1000.
+    for _ in range(500):
+      t += rng.uniform(0.1, 2.)
+      pm.update(t, False, WHITE_PANDA, 0, 'Discharging', rng.uniform(3.5e6, 4.2e6), rng.uniform(0, 2e6), 80)
+
+    history = pm.power_history.get()
+    self.assertEqual(len(history), 500)
+    self.assertGreater(pm.power_used_uWh, 0)
+    self.assertAlmostEqual(integrate_power(history[:, 0], history[:, 1]), pm.power_used_uWh, delta=1e-6 * pm.power_used_uWh)
+    self.assertEqual(integrate_power(history[:1, 0], history[:1, 1]), 0.)
+
+  def test_discharge_rate(self):
+    rng = np.random.default_rng(0)
+    t = np.arange(1000, 2000, 0.5)
+    self.assertAlmostEqual(discharge_rate(t, 90 - 0.01 * (t - 1000)), -0.01)
+    self.assertAlmostEqual(discharge_rate(t, 90 - 0.01 * (t - 1000) + rng.normal(0, 0.5, len(t))), -0.01, delta=1e-3)
+    self.assertAlmostEqual(discharge_rate(t, np.full(len(t), 80.)), 0.)
+    self.assertEqual(discharge_rate(t[:1], np.array([80.])), 0.)
+
+  def test_time_to_shutdown(self):
+    pm = PowerMonitoring(pulsed_measurement=False)
+    t0 = 1000.
+    for t in np.arange(t0, t0 + 200, 0.5):
+      pm.update(t, False, WHITE_PANDA, 0, 'Discharging', 4e6, 1e6, 95 - 0.01 * (t - t0))
+      if t - t0 <= PERCENT_HISTORY_MIN_TIME:
+        self.assertIsNone(pm.get_time_to_shutdown(90))
+    # 93.005% at 0.01%/s
+    self.assertAlmostEqual(pm.get_time_to_shutdown(90), 300.5, delta=1e-6)
+    self.assertEqual(pm.get_time_to_shutdown(95), 0.)
+
+    # not discharging anymore
+    pm.update(t0 + 200, False, WHITE_PANDA, 0, 'Charging', 4e6, 1e6, 93)
+    self.assertIsNone(pm.get_time_to_shutdown(90))
+
+  def test_replay(self):
+    t = np.arange(0., 1300., 1.)
+    n = len(t)
+    ignition = t < 100
+    # full until 500 s, then down 1% every 50 s
+    battery_percent = np.where(t < 500, 100, 100 - (t - 500) // 50).astype(int)
+    args = (t, ignition, [WHITE_PANDA] * n, np.zeros(n), ['Discharging'] * n, np.full(n, 4e6), np.full(n, 1e6),
+            battery_percent)
+
+    ret = replay(*args)
+    # below 90% 10 s after going offroad
+    self.assertEqual(ret['shutdownTs'], 1000.)
+    # the charging control runs every 300 s and turns it off above 80%
+    self.assertEqual(ret['chargingChanges'], [(300., False)])
+    # not within 10 s of going offroad
+    self.assertEqual(replay(*args, batt_perc_off=100)['shutdownTs'], 111.)
+
+    ret = replay(*args, batt_perc_off=85, to_discharge=95, to_charge=92)
+    self.assertEqual(ret['shutdownTs'], 1250.)
+    self.assertEqual(ret['chargingChanges'], [(300., False), (900., True)])
+
+    # nothing is integrated or predicted with ignition
+    self.assertTrue(np.all(ret['powerUsed'][ignition] == 0))
+    self.assertTrue(np.all(np.isnan(ret['timeToShutdown'][ignition])))
+    # 4 W for the 1199 s after the first sample offroad
+    self.assertAlmostEqual(ret['powerUsed'][-1], 4 * 1199 / 3600 * 1e6, delta=1)
+    # predicted from the discharge since the first sample offroad, once the percentage drops
+    np.testing.assert_equal(np.flatnonzero(~np.isnan(ret['timeToShutdown'])), np.arange(550, n))
+    rate = discharge_rate(t[101:901], battery_percent[101:901])
+    self.assertAlmostEqual(ret['timeToShutdown'][900], (battery_percent[900] - 85) / -rate)
+
+
+if __name__ == "__main__":
+  unittest.main()
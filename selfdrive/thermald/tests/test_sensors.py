@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+import selfdrive.thermald.power_monitoring as power_monitoring
+from selfdrive.thermald.sensors import SysfsReader, SensorSampler
+
+
+class BatchReader():
+  """Returns the batch number, which the first reader of a batch advances, slowly."""
+  def __init__(self, batch, first):
+    self.batch = batch
+    self.first = first
+    self.default = 0
+    self.latency = 0.
+
+  def read(self):
+    if self.first:
+      self.batch[0] += 1
+    time.sleep(0.001)
+    return self.batch[0]
+
+  def close(self):
+    pass
+
+
+class TestSensors(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, "capacity")
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def write(self, dat):
+    # in place, like the kernel regenerating the attribute
+    with open(self.path, "w") as f:
+      f.write(dat)
+
+  def test_reread(self):
+    self.write("50\n")
+    reader = SysfsReader(self.path, int)
+    self.assertEqual(reader.read(), 50)
+    fd = reader.fd
+
+    self.write("100\n")
+    self.assertEqual(reader.read(), 100)
+    self.assertEqual(reader.fd, fd)
+    reader.close()
+    self.assertIsNone(reader.fd)
+
+  def test_parse_failure(self):
+    self.write("N/A\n")
+    reader = SysfsReader(self.path, int, -1)
+    self.assertEqual(reader.read(), -1)
+    self.write("42\n")
+    self.assertEqual(reader.read(), 42)
+    reader.close()
+
+  def test_open_retry(self):
+    reader = SysfsReader(self.path, int, -1)
+    reader.RETRY_TIME = 0.2
+    self.assertEqual(reader.read(), -1)
+
+    # not tried again right away
+    self.write("42\n")
+    self.assertEqual(reader.read(), -1)
+    self.assertIsNone(reader.fd)
+    time.sleep(0.3)
+    self.assertEqual(reader.read(), 42)
+    reader.close()
+
+  def test_read_error(self):
+    # pread on a directory fails, the reader closes it and opens the path again on the next read
+    os.mkdir(self.path)
+    reader = SysfsReader(self.path, int, -1)
+    self.assertEqual(reader.read(), -1)
+    self.assertIsNone(reader.fd)
+
+    os.rmdir(self.path)
+    self.write("42\n")
+    self.assertEqual(reader.read(), 42)
+    reader.close()
+
+  def test_get_reader(self):
+    self.write("1\n")
+    reader = power_monitoring._get_reader(self.path, int)
+    self.assertIs(power_monitoring._get_reader(self.path, int), reader)
+    # another parser or default doesn't get the cached reader
+    self.assertEqual(power_monitoring._read_param(self.path, power_monitoring._parse_bool, False), True)
+    self.assertEqual(power_monitoring._read_param(self.path, int, -1), 1)
+    self.assertIsNot(power_monitoring._get_reader(self.path, int, -1), reader)
+    for key in [k for k in power_monitoring._readers if k[0] == self.path]:
+      power_monitoring._readers.pop(key).close()
+
+  def test_sampler(self):
+    self.write("42\n")
+    sampler = SensorSampler({'capacity': SysfsReader(self.path, int)})
+    out = sampler.new_sample()
+    self.assertEqual(out.capacity, 0)
+    sampler.read_into(out)
+    self.assertEqual(out.capacity, 42)
+    self.assertGreater(out.t, 0)
+    sampler.close()
+
+  def test_threaded_sampler(self):
+    batch = [0]
+    readers = {name: BatchReader(batch, i == 0) for i, name in enumerate(['a', 'b', 'c'])}
+    sampler = SensorSampler(readers, rate=1000)
+    out = sampler.new_sample()
+    try:
+      prev_t, prev_batch = 0., 0
+      t = time.monotonic()
+      while time.monotonic() - t < 0.5:
+        sampler.read_into(out)
+        # all values from one batch, never one that's still being read
+        self.assertEqual(out.a, out.b)
+        self.assertEqual(out.a, out.c)
+        self.assertGreaterEqual(out.a, prev_batch)
+        self.assertGreaterEqual(out.t, prev_t)
+        prev_t, prev_batch = out.t, out.a
+      self.assertGreater(prev_batch, 10)
+    finally:
+      sampler.close()
+    self.assertFalse(sampler.thread.is_alive())
+
+
+if __name__ == "__main__":
+  unittest.main()
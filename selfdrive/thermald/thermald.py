@@ -6,7 +6,7 @@ import datetime
 import psutil
 from smbus2 import SMBus
 from cereal import log
-from common.android import ANDROID, get_network_type, get_network_strength
+from common.android import ANDROID
 from common.basedir import BASEDIR
 from common.params import Params, put_nonblocking
 from common.realtime import sec_since_boot, DT_TRML
@@ -17,8 +17,9 @@ from selfdrive.swaglog import cloudlog
 import cereal.messaging as messaging
 from selfdrive.loggerd.config import get_available_percent
 from selfdrive.pandad import get_expected_signature
-from selfdrive.thermald.power_monitoring import PowerMonitoring, get_battery_capacity, get_battery_status, \
-                                                get_battery_current, get_battery_voltage, get_usb_present
+from selfdrive.thermald.power_monitoring import PowerMonitoring, battery_sensors, power_shutdown, BATT_PERC_OFF, \
+                                               LEON_BATT_PERC_OFF, BATT_PERC_TO_DISCHARGE, BATT_PERC_TO_CHARGE
+from selfdrive.thermald.sensors import SysfsReader, SensorSampler
 
 FW_SIGNATURE = get_expected_signature()
 
@@ -30,6 +31,19 @@ CPU_TEMP_TAU = 5.   # 5s time constant
 DAYS_NO_CONNECTIVITY_MAX = 7  # do not allow to engage after a week without internet
 DAYS_NO_CONNECTIVITY_PROMPT = 4  # send an offroad prompt after 4 days with no internet
 DISCONNECT_TIMEOUT = 5.  # wait 5 seconds before going offroad after disconnect so you get an alert
+UPLOAD_BANDWIDTH_THROTTLED = 256 * 1024  # bytes/s, uploader limit while cpu is close to stopping it
+SENSOR_SAMPLE_RATE = float(os.getenv("SENSOR_SAMPLE_RATE", "0"))  # Hz, 0 reads the sensors in the thermald loop
+
+THERMAL_ZONES = {
+  'cpu0': 5,
+  'cpu1': 7,
+  'cpu2': 10,
+  'cpu3': 12,
+  'mem': 2,
+  'gpu': 16,
+  'bat': 29,
+  'pa0': 25,
+}
 
 LEON = False
 last_eon_fan_val = None
@@ -39,31 +53,24 @@ with open(BASEDIR + "/selfdrive/controls/lib/alerts_offroad.json") as json_file:
   OFFROAD_ALERTS = json.load(json_file)
 
 
-def read_tz(x, clip=True):
-  if not ANDROID:
-    # we don't monitor thermal on PC
-    return 0
-  try:
-    with open("/sys/devices/virtual/thermal/thermal_zone%d/temp" % x) as f:
-      ret = int(f.read())
-      if clip:
-        ret = max(0, ret)
-  except FileNotFoundError:
-    return 0
+def parse_tz(x):
+  return max(0, int(x))
+
 
-  return ret
+def thermal_sensors():
+  sensors = battery_sensors()
+  if ANDROID:
+    # we don't monitor thermal on PC
+    for name, zone in THERMAL_ZONES.items():
+      sensors[name] = SysfsReader("/sys/devices/virtual/thermal/thermal_zone%d/temp" % zone, parse_tz)
+  return sensors
 
 
-def read_thermal():
+def read_thermal(sampler, sample):
+  sampler.read_into(sample)
   dat = messaging.new_message('thermal')
-  dat.thermal.cpu0 = read_tz(5)
-  dat.thermal.cpu1 = read_tz(7)
-  dat.thermal.cpu2 = read_tz(10)
-  dat.thermal.cpu3 = read_tz(12)
-  dat.thermal.mem = read_tz(2)
-  dat.thermal.gpu = read_tz(16)
-  dat.thermal.bat = read_tz(29)
-  dat.thermal.pa0 = read_tz(25)
+  for name, value in sample.items():
+    setattr(dat.thermal, name, value)
   return dat
 
 
@@ -148,25 +155,8 @@ def handle_fan_uno(max_cpu_temp, bat_temp, fan_speed, ignition):
 
   return new_speed
 
-def power_shutdown( msg, ts, off_ts, started_seen, batt_perc_off ):
-  shutdown = False
-
-  if msg.thermal.batteryStatus == "Discharging":
-    delta_ts = ts - off_ts
-    if started_seen:
-      if msg.thermal.batteryPercent <= batt_perc_off and delta_ts > 10:
-        shutdown = True
-    elif delta_ts > 240 and msg.thermal.batteryPercent < 30:
-      shutdown = True
-
-    #print( 'shutdown={} power={} started_seen={} Percent={} batt_perc_off={}'.format( shutdown, delta_ts, started_seen, msg.thermal.batteryPercent, batt_perc_off ) )
-
-
-  return shutdown
-
 def thermald_thread():
-  # prevent LEECO from undervoltage
-  BATT_PERC_OFF = 95 if LEON else 90
+  batt_perc_off = LEON_BATT_PERC_OFF if LEON else BATT_PERC_OFF
 
   health_timeout = int(1000 * 2.5 * DT_TRML)  # 2.5x the expected health frequency
 
@@ -174,6 +164,7 @@ def thermald_thread():
   thermal_sock = messaging.pub_sock('thermal')
   health_sock = messaging.sub_sock('health', timeout=health_timeout)
   location_sock = messaging.sub_sock('gpsLocation')
+  network_state_sock = messaging.sub_sock('networkState', conflate=True)
 
   ignition = False
   fan_speed = 0
@@ -197,6 +188,7 @@ def thermald_thread():
   current_connectivity_alert = None
   time_valid_prev = True
   should_start_prev = False
+  upload_bandwidth_limit_prev = None
   handle_fan = None
   is_uno = False
   has_relay = False
@@ -205,6 +197,9 @@ def thermald_thread():
   pm = PowerMonitoring()
   no_panda_cnt = 0
 
+  sensor_sampler = SensorSampler(thermal_sensors(), SENSOR_SAMPLE_RATE)
+  sensor_sample = sensor_sampler.new_sample()
+
   IsOpenpilotViewEnabled = 0
 
   while 1:
@@ -212,7 +207,7 @@ def thermald_thread():
     health = messaging.recv_sock(health_sock, wait=True)
     location = messaging.recv_sock(location_sock)
     location = location.gpsLocation if location else None
-    msg = read_thermal()
+    msg = read_thermal(sensor_sampler, sensor_sample)
 
     if health is not None:
       usb_power = health.health.usbPowerMode != log.HealthData.UsbPowerMode.client
@@ -252,24 +247,17 @@ def thermald_thread():
       ignition = IsOpenpilotViewEnabled      
 
 
-    # get_network_type is an expensive call. update every 10s
-    if (count % int(10. / DT_TRML)) == 0:
-      try:
-        network_type = get_network_type()
-        network_strength = get_network_strength(network_type)
-      except Exception:
-        cloudlog.exception("Error getting network status")
+    # refreshed by networkd
+    network_state = messaging.recv_sock(network_state_sock)
+    if network_state is not None:
+      network_type = network_state.networkState.networkType
+      network_strength = network_state.networkState.networkStrength
 
     msg.thermal.freeSpace = get_available_percent(default=100.0) / 100.0
     msg.thermal.memUsedPercent = int(round(psutil.virtual_memory().percent))
     msg.thermal.cpuPerc = int(round(psutil.cpu_percent()))
     msg.thermal.networkType = network_type
     msg.thermal.networkStrength = network_strength
-    msg.thermal.batteryPercent = get_battery_capacity()
-    msg.thermal.batteryStatus = get_battery_status()
-    msg.thermal.batteryCurrent = get_battery_current()
-    msg.thermal.batteryVoltage = get_battery_voltage()
-    msg.thermal.usbOnline = get_usb_present()
 
     # Fake battery levels on uno for frame
     if is_uno:
@@ -314,6 +302,12 @@ def thermald_thread():
       # all good
       thermal_status = ThermalStatus.green
 
+    # tighten the uploader's bandwidth before it's stopped at yellow
+    upload_bandwidth_limit = UPLOAD_BANDWIDTH_THROTTLED if max_cpu_temp > 75.0 else 0
+    if upload_bandwidth_limit != upload_bandwidth_limit_prev:
+      put_nonblocking("UploadBandwidthLimit", str(upload_bandwidth_limit))
+      upload_bandwidth_limit_prev = upload_bandwidth_limit
+
     # **** starting logic ****
 
     # Check for last update time and display alerts if needed
@@ -422,10 +416,10 @@ def thermald_thread():
 
       # shutdown if the battery gets lower than 3%, it's discharging, we aren't running for
       # more than a minute but we were running
-      if power_shutdown( msg, ts, off_ts, started_seen, BATT_PERC_OFF ):
+      if power_shutdown(msg.thermal.batteryStatus, msg.thermal.batteryPercent, ts, off_ts, started_seen, batt_perc_off):
         os.system('LD_LIBRARY_PATH="" svc power shutdown')
 
-      #if msg.thermal.batteryPercent < BATT_PERC_OFF and msg.thermal.batteryStatus == "Discharging" and \
+      #if msg.thermal.batteryPercent < batt_perc_off and msg.thermal.batteryStatus == "Discharging" and \
       #   started_seen and (sec_since_boot() - off_ts) > 60:
       #  os.system('LD_LIBRARY_PATH="" svc power shutdown')
 
@@ -451,7 +445,7 @@ def thermald_thread():
     should_start_prev = should_start
 
     if usb_power:
-      pm.charging_ctrl( msg, ts, 80, 70 )
+      pm.charging_ctrl( msg, ts, BATT_PERC_TO_DISCHARGE, BATT_PERC_TO_CHARGE )
 
     # report to server once per minute
     if (count % int(60. / DT_TRML)) == 0:
@@ -459,7 +453,11 @@ def thermald_thread():
                      count=count,
                      health=(health.to_dict() if health else None),
                      location=(location.to_dict() if location else None),
-                     thermal=msg.to_dict())
+                     thermal=msg.to_dict(),
+                     sensor_latency=sensor_sample.latency,
+                     sensor_batch_time=sensor_sample.batch_time,
+                     offroad_power=pm.get_average_power(),
+                     time_to_shutdown=pm.get_time_to_shutdown(batt_perc_off))
 
     count += 1
 
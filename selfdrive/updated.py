@@ -26,13 +26,15 @@ import os
 import datetime
 import subprocess
 import psutil
-from stat import S_ISREG, S_ISDIR, S_ISLNK, S_IMODE, ST_MODE, ST_INO, ST_UID, ST_GID, ST_ATIME, ST_MTIME
+from stat import S_ISREG, S_ISDIR, S_ISLNK, S_IMODE, S_IFMT, ST_MODE, ST_INO
 import shutil
 import signal
 from pathlib import Path
 import fcntl
+import functools
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from cffi import FFI
 
 from common.basedir import BASEDIR
@@ -47,6 +49,7 @@ OVERLAY_MERGED = os.path.join(STAGING_ROOT, "merged")
 FINALIZED = os.path.join(STAGING_ROOT, "finalized")
 
 NICE_LOW_PRIORITY = ["nice", "-n", "19"]
+FINALIZE_THREADS = 4
 SHORT = os.getenv("SHORT") is not None
 
 # Workaround for the EON/termux build of Python having os.link removed.
@@ -169,11 +172,13 @@ def init_ovfs():
   remove_consistent_flag()
 
   dismount_ovfs()
-  if os.path.isdir(STAGING_ROOT):
-    shutil.rmtree(STAGING_ROOT)
+  # The finalized tree is kept, the next finalize only replaces what changed
+  for dirname in [OVERLAY_UPPER, OVERLAY_METADATA, OVERLAY_MERGED]:
+    if os.path.isdir(dirname):
+      shutil.rmtree(dirname)
 
   for dirname in [STAGING_ROOT, OVERLAY_UPPER, OVERLAY_METADATA, OVERLAY_MERGED, FINALIZED]:
-    os.mkdir(dirname, 0o755)
+    os.makedirs(dirname, 0o755, exist_ok=True)
   if not os.lstat(BASEDIR).st_dev == os.lstat(OVERLAY_MERGED).st_dev:
     raise RuntimeError("base and overlay merge directories are on different filesystems; not valid for overlay FS!")
 
@@ -205,68 +210,185 @@ def inodes_in_tree(search_dir):
   return inode_map
 
 
-def dup_ovfs_object(inode_map, source_obj, target_dir):
-  """Given a relative pathname to copy, and a new target root, duplicate the
-  source object in the target root, using hardlinks for regular files."""
+def _scan_dir(root, rel):
+  with os.scandir(os.path.join(root, rel)) as it:
+    return [(os.path.join(rel, entry.name), entry.stat(follow_symlinks=False)) for entry in it]
+
+
+def scan_tree(root, pool):
+  """Given a search root, produce a dictionary mapping of relative pathnames to
+  lstat() results of everything below it. Directories are listed in the pool."""
+  tree = {}
+  frontier = [""]
+  while len(frontier):
+    subdirs = []
+    for entries in pool.map(functools.partial(_scan_dir, root), frontier):
+      for rel, st in entries:
+        tree[rel] = st
+        if S_ISDIR(st.st_mode):
+          subdirs.append(rel)
+    frontier = subdirs
+  return tree
+
+
+class LayerInodes:
+  """Finds the upper or lower layer pathname of a regular file in the merged
+  view. The "copy" is done with hardlinks, but since the OverlayFS merge looks
+  like a different filesystem, and hardlinks can't cross filesystems, we have
+  to borrow a source pathname from the upper or lower layer."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.inode_map = None
 
+  def source(self, rel, st):
+    for layer in [OVERLAY_UPPER, BASEDIR]:
+      path = os.path.join(layer, rel)
+      try:
+        if os.lstat(path).st_ino == st.st_ino:
+          return path
+      except FileNotFoundError:
+        pass
+
+    # Renamed inside the overlay, fall back to searching both layers once
+    with self.lock:
+      if self.inode_map is None:
+        self.inode_map = inodes_in_tree(BASEDIR)
+        self.inode_map.update(inodes_in_tree(OVERLAY_UPPER))
+      return self.inode_map[st.st_ino]
+
+
+def is_unchanged(st, target_st, hardlink):
+  """Whether the finalized file or symlink is still a copy of the merged one."""
+  if target_st is None or S_IFMT(st.st_mode) != S_IFMT(target_st.st_mode):
+    return False
+  if hardlink and S_ISREG(st.st_mode):
+    return st.st_ino == target_st.st_ino and st.st_mtime_ns == target_st.st_mtime_ns
+  return st.st_size == target_st.st_size and st.st_mtime_ns == target_st.st_mtime_ns and \
+         S_IMODE(st.st_mode) == S_IMODE(target_st.st_mode)
+
+
+def dup_ovfs_object(layers, source_obj, st, target_exists, hardlink):
+  """Given a relative pathname to copy and its lstat() in the merged view,
+  replace the object in FINALIZED, using hardlinks for regular files if
+  hardlink is set."""
   source_full_path = os.path.join(OVERLAY_MERGED, source_obj)
-  st = os.lstat(source_full_path)
-  target_full_path = os.path.join(target_dir, source_obj)
-
-  if S_ISREG(st[ST_MODE]):
-    # Hardlink all regular files; ownership and permissions are shared.
-    link(inode_map[st[ST_INO]], target_full_path)
-  else:
-    # Recreate all directories and symlinks; copy ownership and permissions.
-    if S_ISDIR(st[ST_MODE]):
-      os.mkdir(os.path.join(FINALIZED, source_obj), S_IMODE(st[ST_MODE]))
-    elif S_ISLNK(st[ST_MODE]):
-      os.symlink(os.readlink(source_full_path), target_full_path)
-      os.chmod(target_full_path, S_IMODE(st[ST_MODE]), follow_symlinks=False)
+  target_full_path = os.path.join(FINALIZED, source_obj)
+  if target_exists:
+    os.unlink(target_full_path)
+
+  if S_ISREG(st.st_mode):
+    if hardlink:
+      # Hardlink all regular files; ownership and permissions are shared.
+      if link(layers.source(source_obj, st), target_full_path) != 0:
+        raise OSError(ffi.errno, os.strerror(ffi.errno), target_full_path)
     else:
-      # Ran into a FIFO, socket, etc. Should not happen in OP install dir.
-      # Ignore without copying for the time being; revisit later if needed.
-      cloudlog.error("can't copy this file type: %s" % source_full_path)
-    os.chown(target_full_path, st[ST_UID], st[ST_GID], follow_symlinks=False)
+      shutil.copy2(source_full_path, target_full_path, follow_symlinks=False)
+      return
+  elif S_ISLNK(st.st_mode):
+    # Recreate all symlinks; copy ownership and permissions.
+    os.symlink(os.readlink(source_full_path), target_full_path)
+    if hardlink:
+      os.chown(target_full_path, st.st_uid, st.st_gid, follow_symlinks=False)
+  else:
+    # Ran into a FIFO, socket, etc. Should not happen in OP install dir.
+    # Ignore without copying for the time being; revisit later if needed.
+    cloudlog.error("can't copy this file type: %s" % source_full_path)
+    return
 
   # Sync target mtimes to the cached lstat() value from each source object.
-  # Restores shared inode mtimes after linking, fixes symlinks and dirs.
-  os.utime(target_full_path, (st[ST_ATIME], st[ST_MTIME]), follow_symlinks=False)
+  # Restores shared inode mtimes after linking, fixes symlinks.
+  os.utime(target_full_path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
 
 
-def finalize_from_ovfs_hardlink():
-  """Take the current OverlayFS merged view and finalize a copy outside of
-  OverlayFS, ready to be swapped-in at BASEDIR. Copy using hardlinks"""
+def sync_ovfs_dir(source_obj, st, target_st, hardlink):
+  target_full_path = os.path.join(FINALIZED, source_obj)
+  if target_st is None or S_IMODE(st.st_mode) != S_IMODE(target_st.st_mode):
+    os.chmod(target_full_path, S_IMODE(st.st_mode))
+  if hardlink and (target_st is None or (st.st_uid, st.st_gid) != (target_st.st_uid, target_st.st_gid)):
+    os.chown(target_full_path, st.st_uid, st.st_gid)
+  os.utime(target_full_path, ns=(st.st_atime_ns, st.st_mtime_ns))
 
+
+def finalize_overlay(hardlink):
+  """Take the current OverlayFS merged view and bring the finalized copy
+  outside of OverlayFS up to date, ready to be swapped-in at BASEDIR.
+
+  The previous FINALIZED tree is reused, only objects whose type, inode (when
+  hardlinking) or size, mode and mtime (when copying) differ from the merged
+  view are replaced, and objects that are gone are removed. The directory
+  listing and the replacing are spread over a thread pool."""
   cloudlog.info("creating finalized version of the overlay")
+  t = time.monotonic()
+
+  # Hardlinked, the finalized tree is only accessible to us until it's swapped in.
+  # Copied, its root takes the mode of the merged view like shutil.copytree did.
+  if hardlink:
+    os.umask(0o077)
+  os.makedirs(FINALIZED, exist_ok=True)
+  os.chmod(FINALIZED, 0o700 if hardlink else S_IMODE(os.lstat(OVERLAY_MERGED).st_mode))
+  layers = LayerInodes()
+  with ThreadPoolExecutor(FINALIZE_THREADS) as pool:
+    merged = scan_tree(OVERLAY_MERGED, pool)
+    finalized = scan_tree(FINALIZED, pool)
+    scan_time = time.monotonic() - t
+
+    # Directories whose listing or metadata changes and need their mtime synced again
+    dirty_dirs = set()
+
+    # Remove what's gone from the merged view or changed type
+    removed = 0
+    gone = set()
+    for rel in sorted(finalized):
+      target_st = finalized[rel]
+      st = merged.get(rel)
+      if st is not None and S_IFMT(st.st_mode) == S_IFMT(target_st.st_mode):
+        continue
+      if os.path.dirname(rel) in gone:
+        # Went with its directory; parents sort before their children
+        gone.add(rel)
+        continue
+      if S_ISDIR(target_st.st_mode):
+        shutil.rmtree(os.path.join(FINALIZED, rel))
+      else:
+        os.unlink(os.path.join(FINALIZED, rel))
+      gone.add(rel)
+      dirty_dirs.add(os.path.dirname(rel))
+      removed += 1
+    finalized = {rel: st for rel, st in finalized.items() if rel not in gone}
+
+    created_dirs = 0
+    for rel in sorted(rel for rel, st in merged.items() if S_ISDIR(st.st_mode)):
+      st, target_st = merged[rel], finalized.get(rel)
+      if target_st is None:
+        os.mkdir(os.path.join(FINALIZED, rel))
+        dirty_dirs.add(os.path.dirname(rel))
+        created_dirs += 1
+        dirty_dirs.add(rel)
+      elif st.st_mtime_ns != target_st.st_mtime_ns or S_IMODE(st.st_mode) != S_IMODE(target_st.st_mode) or \
+           (hardlink and (st.st_uid, st.st_gid) != (target_st.st_uid, target_st.st_gid)):
+        dirty_dirs.add(rel)
+
+    changed = [rel for rel, st in merged.items() if not S_ISDIR(st.st_mode) and not is_unchanged(st, finalized.get(rel), hardlink)]
+    for rel in changed:
+      dirty_dirs.add(os.path.dirname(rel))
+    list(pool.map(lambda rel: dup_ovfs_object(layers, rel, merged[rel], rel in finalized, hardlink), changed))
+
+    dirty_dirs.discard("")
+    list(pool.map(lambda rel: sync_ovfs_dir(rel, merged[rel], finalized.get(rel), hardlink), dirty_dirs))
+
+  cloudlog.event("done finalizing overlay", hardlink=hardlink, objects=len(merged), changed=len(changed),
+                 removed=removed, created_dirs=created_dirs, synced_dirs=len(dirty_dirs),
+                 scan_time=scan_time, total_time=time.monotonic() - t)
+
 
-  # The "copy" is done with hardlinks, but since the OverlayFS merge looks
-  # like a different filesystem, and hardlinks can't cross filesystems, we
-  # have to borrow a source pathname from the upper or lower layer.
-  inode_map = inodes_in_tree(BASEDIR)
-  inode_map.update(inodes_in_tree(OVERLAY_UPPER))
-
-  shutil.rmtree(FINALIZED)
-  os.umask(0o077)
-  os.mkdir(FINALIZED)
-  for root, dirs, files in os.walk(OVERLAY_MERGED, topdown=True):
-    for obj_name in dirs:
-      relative_path_name = os.path.relpath(os.path.join(root, obj_name), OVERLAY_MERGED)
-      dup_ovfs_object(inode_map, relative_path_name, FINALIZED)
-    for obj_name in files:
-      relative_path_name = os.path.relpath(os.path.join(root, obj_name), OVERLAY_MERGED)
-      dup_ovfs_object(inode_map, relative_path_name, FINALIZED)
-  cloudlog.info("done finalizing overlay")
+def finalize_from_ovfs_hardlink():
+  """Finalize the overlay using hardlinks to the upper and lower layer files."""
+  finalize_overlay(hardlink=True)
 
 
 def finalize_from_ovfs_copy():
-  """Take the current OverlayFS merged view and finalize a copy outside of
-  OverlayFS, ready to be swapped-in at BASEDIR. Copy using shutil.copytree"""
-
-  cloudlog.info("creating finalized version of the overlay")
-  shutil.rmtree(FINALIZED)
-  shutil.copytree(OVERLAY_MERGED, FINALIZED, symlinks=True)
-  cloudlog.info("done finalizing overlay")
+  """Finalize the overlay copying the files that changed, like shutil.copytree."""
+  finalize_overlay(hardlink=False)
 
 
 def attempt_update():
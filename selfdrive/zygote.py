@@ -0,0 +1,240 @@
+"""Fork server for the manager's python processes.
+
+The zygote is forked from the manager before it starts any threads and imports
+the python processes' modules once. Every python process is then forked from
+the zygote with its imports already done, instead of paying for numpy, capnp and
+its own module on each car start."""
+import os
+import sys
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import importlib
+import traceback
+from multiprocessing import Process
+from setproctitle import setproctitle  # pylint: disable=no-name-in-module
+
+from common.import_profiler import start_from_env, dump_to_env
+from selfdrive.swaglog import cloudlog
+
+
+def exit_code(status):
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return os.WEXITSTATUS(status)
+
+
+def preload(modules):
+  profiler = start_from_env()
+  import_times = {}
+  for mod in modules:
+    t = time.monotonic()
+    try:
+      importlib.import_module(mod)
+    except Exception:
+      cloudlog.exception("zygote failed to preload %s" % mod)
+      continue
+    import_times[mod] = round(time.monotonic() - t, 4)
+
+  cloudlog.event("zygote_preload", import_times=import_times)
+  dump_to_env(profiler, "zygote")
+  return import_times
+
+
+def run_child(proc):
+  from selfdrive.launcher import launcher
+
+  code = 1
+  try:
+    launcher(proc)
+    code = 0
+  except SystemExit as e:
+    code = e.code if isinstance(e.code, int) else 1
+  except BaseException:
+    traceback.print_exc()
+  finally:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(code)
+
+
+def serve(sock, modules):
+  # ctrl-c is for the children, the zygote exits when the manager closes its socket
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  wakeup_r, wakeup_w = os.pipe()
+  os.set_blocking(wakeup_w, False)
+  signal.set_wakeup_fd(wakeup_w)
+  signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+  setproctitle("selfdrive.zygote")
+
+  preload(modules)
+
+  while True:
+    try:
+      readable, _, _ = select.select([sock, wakeup_r], [], [])
+    except InterruptedError:
+      continue
+
+    if wakeup_r in readable:
+      os.read(wakeup_r, 4096)
+      while True:
+        try:
+          pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+          break
+        if pid == 0:
+          break
+        sock.send(json.dumps({'exit': pid, 'code': exit_code(status)}).encode())
+
+    if sock in readable:
+      dat = sock.recv(4096)
+      if not dat:
+        os._exit(0)
+
+      req = json.loads(dat)
+      pid = os.fork()
+      if pid == 0:
+        sock.close()
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        run_child(req['proc'])
+      sock.send(json.dumps({'pid': pid}).encode())
+
+
+class Zygote():
+  def __init__(self, modules):
+    self.exit_codes = {}
+    self.children = set()  # spawned and not reported as exited yet
+    self.dead = False
+    self.sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    self.pid = os.fork()
+    if self.pid == 0:
+      self.sock.close()
+      try:
+        serve(child_sock, modules)
+      except BaseException:
+        traceback.print_exc()
+      os._exit(1)
+
+    child_sock.close()
+
+  def handle(self, msg):
+    msg = json.loads(msg)
+    if 'exit' in msg:
+      self.exit_codes[msg['exit']] = msg['code']
+      self.children.discard(msg['exit'])
+    return msg
+
+  def died(self):
+    """The zygote can't report exits anymore, kill what it forked and give it an exit code."""
+    if self.dead:
+      return
+    self.dead = True
+    cloudlog.error("zygote died with %d processes running" % len(self.children))
+    for pid in self.children:
+      try:
+        os.kill(pid, signal.SIGKILL)
+      except OSError:
+        pass
+      self.exit_codes[pid] = -signal.SIGKILL
+    self.children.clear()
+
+  def recv(self):
+    try:
+      dat = self.sock.recv(4096)
+    except OSError:
+      dat = b""
+    if not dat:
+      self.died()
+      return None
+    return self.handle(dat)
+
+  def spawn(self, proc):
+    if self.dead:
+      raise OSError(errno.EPIPE, "zygote died")
+    self.sock.setblocking(True)
+    try:
+      self.sock.send(json.dumps({'proc': proc}).encode())
+    except OSError:
+      self.died()
+      raise
+    while True:
+      msg = self.recv()
+      if msg is None:
+        raise OSError(errno.EPIPE, "zygote died")
+      if 'pid' in msg:
+        # forget an earlier process with the same pid
+        self.exit_codes.pop(msg['pid'], None)
+        self.children.add(msg['pid'])
+        return msg['pid']
+
+  def poll(self, timeout=0.):
+    """Collects exit codes sent by the zygote, waiting up to timeout for the first one. Returns
+    right away once the zygote is dead."""
+    while not self.dead and len(select.select([self.sock], [], [], timeout)[0]):
+      self.recv()
+      timeout = 0.
+
+  def close(self):
+    self.sock.close()
+    os.waitpid(self.pid, 0)
+
+
+class ZygoteProcess():
+  """The parts of multiprocessing.Process the manager uses, for a process forked by the zygote."""
+
+  def __init__(self, zygote, name, proc):
+    self.zygote = zygote
+    self.name = name
+    self.proc = proc
+    self.pid = None
+
+  def start(self):
+    self.pid = self.zygote.spawn(self.proc)
+
+  @property
+  def exitcode(self):
+    if self.pid not in self.zygote.exit_codes:
+      self.zygote.poll()
+    if self.zygote.dead:
+      return self.zygote.exit_codes.get(self.pid, -signal.SIGKILL)
+    return self.zygote.exit_codes.get(self.pid)
+
+  def is_alive(self):
+    return self.pid is not None and self.exitcode is None
+
+  def terminate(self):
+    os.kill(self.pid, signal.SIGTERM)
+
+  def join(self, timeout=None):
+    end = None if timeout is None else time.monotonic() + timeout
+    while self.exitcode is None and not self.zygote.dead:
+      remaining = None if end is None else end - time.monotonic()
+      if remaining is not None and remaining <= 0:
+        break
+      self.zygote.poll(remaining)
+
+
+def start_python_process(zygote, name, proc):
+  """Starts the python process proc, forked by the zygote while it's alive and from this process
+  otherwise, also when the zygote turns out to be dead only now."""
+  from selfdrive.launcher import launcher
+
+  if zygote is not None and not zygote.dead:
+    process = ZygoteProcess(zygote, name, proc)
+    try:
+      process.start()
+      return process
+    except OSError:
+      cloudlog.exception("zygote failed to start %s, starting it without" % name)
+
+  process = Process(name=name, target=launcher, args=(proc,))
+  process.start()
+  return process